@@ -1,5 +1,24 @@
+import array
+import Queue
+import threading
+import timeit
+
+import shared_board
+
 class AIController():
-    """Abstract/Base controller for AI."""
+    """Abstract/Base controller for AI.
+
+    AIs that take a while to decide should follow the anytime contract:
+    call propose_moves whenever they find a better set of moves, and return soon after should_stop() becomes True.
+    If the mission model has a time budget, it uses the last proposed moves (or 'W') when the AI runs out of time.
+    An AI that returns without setting any moves also gets its proposed moves.
+    A decision that is still running when the next one starts is stale. Whatever moves it sets or proposes are dropped.
+    Controllers whose determine_next_moves changes their own state, like consuming an instruction, should set
+    decides_at_once, so a stale decision never runs.
+    """
+    decides_at_once = False
+    """True if determine_next_moves returns right away. The mission model then decides on its own thread, even with a time budget."""
+
     def __init__ (self, mission_model, entity_id):
         """ Constructor. pass in the id of the entity to control."""
         self.mission_model = mission_model
@@ -8,6 +27,29 @@ class AIController():
 
         self.next_moves_by_entity_id = {}
 
+        # Count of the positions examined while deciding. Search based AIs should add to this.
+        self.nodes_evaluated = 0
+
+        # The anytime contract. See start_decision.
+        self.deadline = None
+        self.cancelled = False
+        self.best_moves_by_entity_id = {}
+        self.decision_token = 0
+        self.decision_finish_time = None
+
+        # Held while a decision's moves are stored or a new decision starts, so a stale decision cannot slip its moves in between.
+        self._decision_lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks can not be pickled. The copy gets a new one.
+        state = dict(self.__dict__)
+        del state['_decision_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._decision_lock = threading.Lock()
+
     def _init_entities(self,entity_id):
         """Internal method to set the internal entity ids. Can be overwritten."""
         self.entity_id = entity_id
@@ -22,6 +64,140 @@ class AIController():
         """
         return self.next_moves_by_entity_id
 
+    def get_next_moves_by_slot(self):
+        """Return the already stored moves, by the registry slot of each entity. See entity.EntityRegistry.
+        Subclasses that keep their entities' slots should overwrite this.
+        """
+        get_slot = self.mission_model.all_entities_by_id.get_slot
+        return dict([(get_slot(entity_id), direction) for entity_id, direction in self.next_moves_by_entity_id.items()])
+
+    def get_entity_ids(self):
+        """Return a list of the entity ids this AI controls.
+        Subclasses that control several entities should overwrite this.
+        """
+        return [self.entity_id]
+
+    def start_decision(self, deadline=None):
+        """Called before determine_next_moves. Forgets the last decision's moves.
+        deadline: The timeit.default_timer() time the moves are due by, or None if there is no limit.
+        """
+        with self._decision_lock:
+            self.decision_token += 1
+            self.deadline = deadline
+            self.cancelled = False
+            self.best_moves_by_entity_id = {}
+            self.next_moves_by_entity_id = {}
+            self.decision_finish_time = None
+
+    def decide_on_thread(self, decision_token):
+        """Thread target for deciding under a time budget. decision_token is the decision_token the thread decides for.
+        Records when the decision finished, unless a newer decision has started since.
+        """
+        threading.current_thread().ai_decision_token = decision_token
+        self.determine_next_moves()
+        with self._decision_lock:
+            if not self.is_stale_decision():
+                self.decision_finish_time = timeit.default_timer()
+
+    def is_stale_decision(self):
+        """Returns True if this is called from a decision thread that a newer decision has replaced.
+        """
+        decision_token = getattr(threading.current_thread(), 'ai_decision_token', None)
+        return decision_token is not None and decision_token != self.decision_token
+
+    def cancel(self):
+        """Ask determine_next_moves to stop as soon as it can.
+        """
+        self.cancelled = True
+
+    def should_stop(self):
+        """Returns True if determine_next_moves should stop looking and return.
+        """
+        return self.cancelled or self.is_stale_decision() or (self.deadline is not None and timeit.default_timer() >= self.deadline)
+
+    def time_left(self):
+        """Returns the seconds left before the deadline, or None if there is no deadline.
+        """
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - timeit.default_timer())
+
+    def propose_moves(self, moves_by_entity_id):
+        """Record the best moves found so far. They are used if the AI runs out of time.
+        """
+        with self._decision_lock:
+            if not self.is_stale_decision():
+                self.best_moves_by_entity_id = dict(moves_by_entity_id)
+
+    def finish_decision(self):
+        """Called after determine_next_moves returns. An AI that stopped early without setting moves gets its proposed moves.
+        """
+        if not self.next_moves_by_entity_id and self.best_moves_by_entity_id:
+            self.set_next_moves(self.get_fallback_moves())
+
+    def get_fallback_moves(self):
+        """Return the moves to use if the AI ran out of time: the best moves proposed so far, waiting for everything else.
+        """
+        fallback_moves = dict(self.best_moves_by_entity_id)
+        for entity_id in self.get_entity_ids():
+            fallback_moves.setdefault(entity_id, 'W')
+        return fallback_moves
+
+    def set_next_moves(self, next_moves_by_entity_id):
+        """Store moves decided elsewhere, like in decide_from_snapshot.
+        """
+        with self._decision_lock:
+            if not self.is_stale_decision():
+                self.next_moves_by_entity_id = next_moves_by_entity_id
+
+    def use_book_moves(self):
+        """If the mission's opening book has moves for this controller in the current state, store them and return True.
+        Call before determine_next_moves, which is not needed when this returns True. See opening_book.
+        """
+        opening_book = self.mission_model.opening_book
+        if opening_book is None:
+            return False
+        moves = opening_book.get_moves(self.mission_model, self)
+        if moves is None:
+            return False
+        self.set_next_moves(moves)
+        return True
+
+    def get_decision_snapshot(self):
+        """Return a picklable copy of everything decide_from_snapshot needs, so the decision can be made in another process.
+        Return None if this AI has to decide in this process with determine_next_moves.
+        Subclasses may overwrite this.
+        """
+        return None
+
+    @staticmethod
+    def decide_from_snapshot(snapshot):
+        """Return the next moves by entity id for the snapshot from get_decision_snapshot.
+        Must not use anything but the snapshot, and the mission's shared_board if the snapshot names it.
+        """
+        raise NotImplementedError
+
+    def get_moves_from_decision(self, decision):
+        """Return the moves by entity id for what decide_from_snapshot returned.
+        Subclasses whose decisions are not already moves by entity id should overwrite this.
+        """
+        return decision
+
+    def get_state(self):
+        """Return what is needed to rebuild this controller, as something json can encode. See mission_state.
+        'entity id' is passed to the constructor, then set_state gets the whole state.
+        Subclasses with more state should add to this.
+        """
+        return {
+            'entity id': self.entity_id,
+            'next moves': self.next_moves_by_entity_id,
+        }
+
+    def set_state(self, state):
+        """Restore the state from get_state.
+        """
+        self.next_moves_by_entity_id = dict(state['next moves'])
+
     def clear_all_ai_moves(self):
         """Clear all of the moves.
         """
@@ -33,15 +209,23 @@ class AIController():
         """
         pass
 
-class AlwaysWait(AIController):
-    """AI will always wait.
-    """
-    def determine_next_moves(self):
-        self.next_moves_by_entity_id[self.entity_id] = 'W'
+    def entities_moved(self, moved_entities):
+        """Called by the mission model with a list of Entities whose positions changed.
+        Subclasses that keep their own copy of positions should overwrite this.
+        """
+        pass
 
-class ChaseTheFox(AIController):
-    """AI will try to move one step closer to the fox.
+    def collect_nodes_evaluated(self):
+        """Returns the number of positions examined since the last call, and starts counting again.
+        """
+        nodes_evaluated = self.nodes_evaluated
+        self.nodes_evaluated = 0
+        return nodes_evaluated
+
+class AlwaysWait(AIController):
+    """AI will always wait. It can control one entity or a list of them.
     """
+    decides_at_once = True
 
     def _init_entities(self, entity_id):
         """Internal method to set the internal entity ids. Can be overwritten."""
@@ -52,57 +236,245 @@ class ChaseTheFox(AIController):
 
         self.entity_ids = entity_id
 
-    def determine_next_moves(self):
-        # Clear out previous round's instructions
-        self.next_moves_by_entity_id = {}
-
-        # Because you can move in eight directions, move towards the fox.
-        fox_entity = self.mission_model.all_entities_by_id['fox']
-
-        # Get the fox's position
-        fox_position_x = fox_entity.position_x
-        fox_position_y = fox_entity.position_y
+    def get_entity_ids(self):
+        return list(self.entity_ids)
 
-        # For each entity
-        for entity_id in self.entity_ids:
-            entity = self.mission_model.all_entities_by_id[entity_id]
+    def get_state(self):
+        return {
+            'entity id': list(self.entity_ids),
+            'next moves': self.next_moves_by_entity_id,
+        }
 
-            # Get the entity's position
-            entity_position_x = entity.position_x
-            entity_position_y = entity.position_y
+    def determine_next_moves(self):
+        self.set_next_moves(dict([(entity_id, 'W') for entity_id in self.entity_ids]))
 
-            entity_direction_x = ""
-            entity_direction_y = ""
+    def delete_entities(self, entity_ids_to_delete):
+        """Remove the given entities from consideration.
+        """
+        for id in entity_ids_to_delete:
+            if id in self.entity_ids:
+                self.entity_ids.remove(id)
+
+DIRECTIONS_BY_SIGN = {
+    (0, 0): 'W',
+    (-1, 0): 'L',
+    (1, 0): 'R',
+    (0, 1): 'U',
+    (0, -1): 'D',
+    (-1, 1): 'UL',
+    (1, 1): 'UR',
+    (-1, -1): 'DL',
+    (1, -1): 'DR',
+}
+"""Direction codes keyed by the signs of the x and y steps."""
+
+def get_chase_directions(target_x, target_y, positions_x, positions_y):
+    """Returns a list with the direction code that moves each position one step closer to the target.
+    positions_x and positions_y are sequences of the same length.
+    """
+    # The sign of (target - position) on each axis, for every position at once.
+    signs_x = map(target_x.__cmp__, positions_x)
+    signs_y = map(target_y.__cmp__, positions_y)
+    return map(DIRECTIONS_BY_SIGN.__getitem__, zip(signs_x, signs_y))
 
-            # Move towards the fox
-            if fox_position_x < entity_position_x:
-                entity_direction_x = 'L'
-            elif fox_position_x > entity_position_x:
-                entity_direction_x = 'R'
+class ChaseTheFox(AIController):
+    """AI will try to move one step closer to the fox.
+    Keeps the positions of its geese in arrays, updated as they move and die.
+    The geese are looked up the first time they are needed, so the controller can be made before they are added.
+    """
 
-            if fox_position_y < entity_position_y:
-                entity_direction_y = 'D'
-            elif fox_position_y > entity_position_y:
-                entity_direction_y = 'U'
+    def _init_entities(self, entity_id):
+        """Internal method to set the internal entity ids. Can be overwritten."""
 
-            final_direction = entity_direction_y + entity_direction_x
+        # If entity_ids is a single item, put it in a list
+        if isinstance(entity_id, basestring):
+            entity_id = [entity_id]
 
-            if final_direction == "":
-                final_direction = 'W'
+        # entity_ids, entities, slots, positions_x and positions_y are parallel. Index i of each is the same goose.
+        # All but entity_ids are None until _get_entities looks the geese up.
+        self.entity_ids = list(entity_id)
+        self.index_by_entity_id = dict([(id, index) for index, id in enumerate(self.entity_ids)])
+        self.entities = None
+        self.slots = None
+        self.positions_x = None
+        self.positions_y = None
+        self.index_by_entity = None
+        self.index_by_slot = None
+
+        self.fox_entity = None
+
+        # The entity ids of the last shared board snapshot. See get_moves_from_decision.
+        self.snapshot_entity_ids = []
+
+    def get_entity_ids(self):
+        return list(self.entity_ids)
+
+    def get_state(self):
+        return {
+            'entity id': list(self.entity_ids),
+            'next moves': self.next_moves_by_entity_id,
+        }
+
+    def _get_fox_entity(self):
+        if self.fox_entity is None:
+            self.fox_entity = self.mission_model.all_entities_by_id['fox']
+        return self.fox_entity
+
+    def _get_entities(self):
+        # Look the geese up, and copy their positions. From then on the copies follow entities_moved and the registry's
+        # position listeners.
+        if self.entities is None:
+            registry = self.mission_model.all_entities_by_id
+            entities = [registry[id] for id in self.entity_ids]
+            self.slots = [entity.slot for entity in entities]
+            self.positions_x = array.array('i', [entity.position_x for entity in entities])
+            self.positions_y = array.array('i', [entity.position_y for entity in entities])
+            self.index_by_entity = dict([(entity, index) for index, entity in enumerate(entities)])
+            self.index_by_slot = dict([(slot, index) for index, slot in enumerate(self.slots)])
+            self.entities = entities
+            registry.add_position_listener(self._position_changed)
+        return self.entities
+
+    def _position_changed(self, slot):
+        # Called by the registry when set_position moves the Entity in the slot, e.g. through Entity.position_x.
+        index = self.index_by_slot.get(slot)
+        if index is not None and self.entities[index].slot == slot:
+            registry = self.mission_model.all_entities_by_id
+            self.positions_x[index] = registry.positions_x[slot]
+            self.positions_y[index] = registry.positions_y[slot]
 
-            # Store this result for later.
-            self.next_moves_by_entity_id[entity_id] = final_direction
+    def determine_next_moves(self):
+        # Replace the previous round's instructions
+        self._get_entities()
+        fox_entity = self._get_fox_entity()
+        directions = get_chase_directions(fox_entity.position_x, fox_entity.position_y, self.positions_x, self.positions_y)
+
+        # Go around the terrain, keeping the straight direction when it is as good.
+        pathfinding = self.mission_model.pathfinding
+        if pathfinding is not None:
+            directions = pathfinding.get_directions(fox_entity.position_x, fox_entity.position_y, self.positions_x, self.positions_y, directions)
+
+        self.set_next_moves(dict(zip(self.entity_ids, directions)))
+
+    def set_next_moves(self, next_moves_by_entity_id):
+        AIController.set_next_moves(self, next_moves_by_entity_id)
+        self.nodes_evaluated += len(next_moves_by_entity_id)
+
+    def get_next_moves_by_slot(self):
+        # The geese's slots are already known once they are looked up.
+        if self.entities is None:
+            return AIController.get_next_moves_by_slot(self)
+        slots = self.slots
+        index_by_entity_id = self.index_by_entity_id
+        return dict([(slots[index_by_entity_id[entity_id]], direction) for entity_id, direction in self.next_moves_by_entity_id.items()])
+
+    def get_decision_snapshot(self):
+        """Only the positions of the fox and the geese are needed.
+        With terrain, decide here where the shared pathfinding cache is.
+        With a shared board, only the slots of the fox and the geese are sent. The worker reads their positions from the board.
+        """
+        if self.mission_model.pathfinding is not None:
+            return None
+
+        self._get_entities()
+        fox_entity = self._get_fox_entity()
+        board = self.mission_model.shared_board
+        if board is not None:
+            # The decision comes back as a list of directions in this order.
+            self.snapshot_entity_ids = list(self.entity_ids)
+            return {
+                'board path': board.path,
+                'board generation': board.generation,
+                'fox slot': fox_entity.slot,
+                'slots': array.array('i', self.slots).tostring(),
+            }
+
+        return {
+            'fox position': (fox_entity.position_x, fox_entity.position_y),
+            'entity positions': zip(self.entity_ids, self.positions_x, self.positions_y),
+        }
+
+    @staticmethod
+    def decide_from_snapshot(snapshot):
+        if 'board path' in snapshot:
+            # Read just the fox's slot and the geese's, the fox first.
+            slots = array.array('i', [snapshot['fox slot']])
+            slots.fromstring(snapshot['slots'])
+            board = shared_board.attach(snapshot['board path']).read_slots(slots, snapshot['board generation'])
+            positions_x = board['positions x']
+            positions_y = board['positions y']
+            return get_chase_directions(positions_x[0], positions_y[0], positions_x[1:], positions_y[1:])
+
+        fox_position_x, fox_position_y = snapshot['fox position']
+        entity_positions = snapshot['entity positions']
+        if not entity_positions:
+            return {}
+
+        entity_ids, positions_x, positions_y = zip(*entity_positions)
+        return dict(zip(entity_ids, get_chase_directions(fox_position_x, fox_position_y, positions_x, positions_y)))
+
+    def get_moves_from_decision(self, decision):
+        # Decisions made from the shared board are directions in the order of snapshot_entity_ids.
+        if isinstance(decision, list):
+            return dict(zip(self.snapshot_entity_ids, decision))
+        return decision
+
+    def entities_moved(self, moved_entities):
+        """Update the positions of the geese that moved.
+        """
+        # Nothing to update until the geese are looked up.
+        if self.entities is None:
+            return
+
+        # Read straight from the registry's position columns. See entity.EntityRegistry.
+        registry = self.mission_model.all_entities_by_id
+        registry_positions_x = registry.positions_x
+        registry_positions_y = registry.positions_y
+        positions_x = self.positions_x
+        positions_y = self.positions_y
+        index_by_entity = self.index_by_entity
+        for entity in moved_entities:
+            index = index_by_entity.get(entity)
+            if index is not None:
+                slot = entity.slot
+                positions_x[index] = registry_positions_x[slot]
+                positions_y[index] = registry_positions_y[slot]
 
     def delete_entities(self, entity_ids_to_delete):
         """Remove the given entities from consideration.
-        Subclasses should overwrite this.
+        The last goose takes the place of each deleted one, so no list has to shift.
         """
         for id in entity_ids_to_delete:
-            self.entity_ids.remove(id)
+            index = self.index_by_entity_id.pop(id, None)
+            if index is None:
+                continue
+            last_index = len(self.entity_ids) - 1
+            if index != last_index:
+                self.entity_ids[index] = self.entity_ids[last_index]
+                self.index_by_entity_id[self.entity_ids[index]] = index
+            self.entity_ids.pop()
+
+            if self.entities is None:
+                continue
+            del self.index_by_entity[self.entities[index]]
+            del self.index_by_slot[self.slots[index]]
+            if index != last_index:
+                self.entities[index] = self.entities[last_index]
+                self.slots[index] = self.slots[last_index]
+                self.positions_x[index] = self.positions_x[last_index]
+                self.positions_y[index] = self.positions_y[last_index]
+                self.index_by_entity[self.entities[index]] = index
+                self.index_by_slot[self.slots[index]] = index
+            self.entities.pop()
+            self.slots.pop()
+            self.positions_x.pop()
+            self.positions_y.pop()
 
 class ManualInstructions(AIController):
     """AI waits for an instruction.
     """
+    decides_at_once = True
+
     def __init__(self, *args, **kwargs):
         AIController.__init__(self, *args, **kwargs)
 
@@ -113,6 +485,15 @@ class ManualInstructions(AIController):
         """
         self.next_instruction = instruction
 
+    def get_state(self):
+        state = AIController.get_state(self)
+        state['next instruction'] = self.next_instruction
+        return state
+
+    def set_state(self, state):
+        AIController.set_state(self, state)
+        self.next_instruction = state['next instruction']
+
     def determine_next_moves(self):
         """Consume the next_instruction.
         """
@@ -123,11 +504,13 @@ class ManualInstructions(AIController):
             self.next_instruction = None
 
         # Store the id for this unit.
-        self.next_moves_by_entity_id[self.entity_id] = next_instruction
+        self.set_next_moves({self.entity_id: next_instruction})
 
 class ReplayInstructions(AIController):
     """AI maintains a queue of instructions and processes one per turn.
     """
+    decides_at_once = True
+
     def __init__(self, *args, **kwargs):
         AIController.__init__(self, *args, **kwargs)
 
@@ -138,6 +521,15 @@ class ReplayInstructions(AIController):
         """
         self.next_instructions += instructions
 
+    def get_state(self):
+        state = AIController.get_state(self)
+        state['next instructions'] = list(self.next_instructions)
+        return state
+
+    def set_state(self, state):
+        AIController.set_state(self, state)
+        self.next_instructions = list(state['next instructions'])
+
     def determine_next_moves(self):
         """Consume the next_instruction.
         """
@@ -147,4 +539,54 @@ class ReplayInstructions(AIController):
             next_instruction = self.next_instructions.pop(0)
 
         # Store the id for this unit.
-        self.next_moves_by_entity_id[self.entity_id] = next_instruction
+        self.set_next_moves({self.entity_id: next_instruction})
+
+class DecisionWorker(object):
+    """A daemon thread that makes one AI controller's decisions under a time budget, one after another.
+    The thread is started once and reused every turn. A decision that ignores its cancellation keeps the worker busy.
+    """
+    def __init__(self, ai_controller):
+        self.ai_controller = ai_controller
+        self.decision_tokens = Queue.Queue()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def is_busy(self):
+        """Returns True if the last decision has not returned yet.
+        """
+        return not self.idle.is_set()
+
+    def decide(self, decision_token):
+        """Start deciding for the controller's decision_token. Only call when the worker is not busy.
+        """
+        self.idle.clear()
+        self.decision_tokens.put(decision_token)
+
+    def join(self, timeout=None):
+        """Wait up to timeout seconds for the decision to return. Returns True if it did.
+        """
+        return self.idle.wait(timeout)
+
+    def stop(self):
+        """Let the thread exit once it is done with the decision it is on.
+        """
+        self.decision_tokens.put(None)
+
+    def _run(self):
+        while True:
+            decision_token = self.decision_tokens.get()
+            if decision_token is None:
+                return
+            try:
+                self.ai_controller.decide_on_thread(decision_token)
+            finally:
+                self.idle.set()
+
+def decide_from_snapshot_task(task):
+    """Process pool friendly wrapper. task is a tuple of (AIController class, snapshot).
+    """
+    ai_class, snapshot = task
+    return ai_class.decide_from_snapshot(snapshot)
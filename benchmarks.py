@@ -0,0 +1,458 @@
+"""Times the simulation hot paths over a sweep of map sizes and goose counts.
+
+Results are written as JSON. Pass a previous results file with --compare to flag regressions.
+
+Usage:
+    python benchmarks.py --output baseline.json
+    python benchmarks.py --output new.json --compare baseline.json --tolerance 0.25
+    python benchmarks.py --encoding
+    python benchmarks.py --serialization
+"""
+import argparse
+import cPickle
+import functools
+import json
+import platform
+import sys
+import time
+import timeit
+
+import ai_controllers
+from entity import Entity, FoxCollisionResolver, GooseCollisionResolver
+from mission import MissionModel, MissionController
+import mission_state
+from terrain import TerrainGrid
+from wire_protocol import TurnDeltaCodec
+
+DEFAULT_MAP_SIZES = [(10, 10), (50, 50), (100, 100)]
+DEFAULT_GOOSE_COUNTS = [3, 50, 500, 5000]
+DEFAULT_REPEAT = 3
+DEFAULT_ITERATIONS = 10
+"""Calls timed together in each run of a benchmark, so the timer's own overhead and resolution do not dominate."""
+DEFAULT_TOLERANCE = 0.25
+"""A benchmark regressed if it got slower than the baseline by more than this fraction."""
+
+def get_starting_positions(width, height, goose_count):
+    """Returns the fox position and a list of goose positions, as (x, y) tuples.
+    The fox is in the center. Geese fill the map row by row so they crowd each other and the fox.
+    """
+    fox_position = (width / 2, height / 2)
+    goose_positions = []
+    for y in xrange(height):
+        for x in xrange(width):
+            if len(goose_positions) == goose_count:
+                return fox_position, goose_positions
+            if (x, y) != fox_position:
+                goose_positions.append((x, y))
+    return fox_position, goose_positions
+
+def make_mission_yaml(width, height, goose_count, mission_id="benchmark"):
+    """Returns a campaign yaml document with one mission.
+    """
+    fox_position, goose_positions = get_starting_positions(width, height, goose_count)
+    lines = [
+        "campaign:",
+        "  mission ids:",
+        "    - %s" % mission_id,
+        "missions:",
+        "  %s:" % mission_id,
+        "    map height: %d" % height,
+        "    map width: %d" % width,
+        "    fox:",
+        "      position: {x: %d, y: %d}" % fox_position,
+        "    geese:",
+    ]
+    for goose_position in goose_positions:
+        lines.append("      - position: {x: %d, y: %d}" % goose_position)
+    return "\n".join(lines) + "\n"
+
+def make_terrain_rows(width, height):
+    """Returns terrain rows for a maze of walls. Every fourth column is a wall with one gap, at the top or the bottom in turn.
+    The fox's column is always open.
+    """
+    fox_position = (width / 2, height / 2)
+    columns = []
+    for x in xrange(width):
+        if x % 4 != 3 or x == fox_position[0]:
+            columns.append('.' * height)
+        elif x % 8 == 3:
+            columns.append('#' * (height - 1) + '.')
+        else:
+            columns.append('.' + '#' * (height - 1))
+
+    # Rows are listed top first.
+    return ["".join([column[y] for column in columns]) for y in reversed(xrange(height))]
+
+def make_mission_model(width, height, goose_count, terrain=False):
+    """Builds the same mission as make_mission_yaml without parsing yaml.
+    If terrain is True, the map gets the walls of make_terrain_rows.
+    """
+    fox_position, goose_positions = get_starting_positions(width, height, goose_count)
+    mission_model = MissionModel(width=width, height=height)
+    if terrain:
+        mission_model.set_terrain(TerrainGrid.from_rows(make_terrain_rows(width, height), width, height))
+
+    fox_entity = Entity(position={'x':fox_position[0], 'y':fox_position[1]}, entity_type='fox')
+    fox_entity.collision_behavior = FoxCollisionResolver(fox_entity)
+    fox_entity.resource_id = 'fox'
+    mission_model.all_entities_by_id['fox'] = fox_entity
+    mission_model.all_ai_by_id['fox'] = ai_controllers.AlwaysWait(mission_model, 'fox')
+
+    goose_ids = []
+    for goose_position in goose_positions:
+        goose_id = "goose_%d" % len(goose_ids)
+        goose_ids.append(goose_id)
+
+        goose = Entity(position={'x':goose_position[0], 'y':goose_position[1]}, entity_type='goose')
+        goose.collision_behavior = GooseCollisionResolver(goose)
+        goose.resource_id = 'goose'
+        mission_model.all_entities_by_id[goose_id] = goose
+
+    mission_model.all_ai_by_id['goose'] = ai_controllers.ChaseTheFox(mission_model, goose_ids)
+    return mission_model
+
+def _plan_moves(mission_model):
+    # Ask the AI for its moves. Returns them as a dictionary by registry slot.
+    mission_model.ask_all_ai_for_next_move()
+    moves_by_slot = {}
+    for ai_controller in mission_model.all_ai_by_id.values():
+        moves_by_slot.update(ai_controller.get_next_moves_by_slot())
+    return moves_by_slot
+
+def _try_to_move_all(mission_model, moves_by_slot):
+    mission_model.try_to_move_slots(moves_by_slot.keys(), moves_by_slot.values())
+
+def _prepare(width, height, goose_count, phase):
+    # Build a mission and play one turn up to (but not including) the given phase.
+    # Returns the function to time.
+    phases = ['determine_next_moves', 'try_to_move_entity', 'move_all_entities', 'find_collisions', 'resolve_collisions', 'delete_dead_entities']
+    mission_model = make_mission_model(width, height, goose_count)
+    goose_ai = mission_model.all_ai_by_id['goose']
+
+    if phase == 'determine_next_moves':
+        # The first decision looks the geese up. Time the ones after it.
+        goose_ai.determine_next_moves()
+        return goose_ai.determine_next_moves
+
+    if phase == 'pathfinding':
+        # The geese find their way around walls. The first turn fills the distance field cache.
+        mission_model = make_mission_model(width, height, goose_count, terrain=True)
+        return mission_model.all_ai_by_id['goose'].determine_next_moves
+
+    moves_by_slot = _plan_moves(mission_model)
+    if phase == 'try_to_move_entity':
+        return lambda: _try_to_move_all(mission_model, moves_by_slot)
+
+    _try_to_move_all(mission_model, moves_by_slot)
+    if phase == 'move_all_entities':
+        return mission_model.move_all_entities
+
+    mission_model.move_all_entities()
+    if phase == 'find_collisions':
+        return mission_model.find_collisions
+
+    mission_model.find_collisions()
+    if phase == 'resolve_collisions':
+        return mission_model.resolve_collisions
+
+    mission_model.resolve_collisions()
+    if phase == 'delete_dead_entities':
+        return mission_model.delete_dead_entities
+
+    raise ValueError("Unknown phase %s, expected one of %s" % (phase, phases + ['load_mission', 'pathfinding']))
+
+def time_benchmark(name, width, height, goose_count, repeat=DEFAULT_REPEAT, iterations=DEFAULT_ITERATIONS):
+    """Time one benchmark. Setup is not timed.
+    Each of the repeat runs times iterations calls in a row. Most phases change the mission they run on,
+    so every call gets its own mission, prepared before the run starts.
+    Returns a result dictionary. The times are per call.
+    """
+    if name == 'load_mission':
+        yaml_document = make_mission_yaml(width, height, goose_count)
+
+    timings = []
+    for i in xrange(repeat):
+        if name == 'load_mission':
+            benchmarks = [functools.partial(MissionModel().load_mission, "benchmark", yaml_document) for j in xrange(iterations)]
+        else:
+            benchmarks = [_prepare(width, height, goose_count, name) for j in xrange(iterations)]
+
+        start_time = timeit.default_timer()
+        for benchmark in benchmarks:
+            benchmark()
+        timings.append((timeit.default_timer() - start_time) / iterations)
+
+    timings.sort()
+    return {
+        'name': name,
+        'width': width,
+        'height': height,
+        'geese': goose_count,
+        'repeat': repeat,
+        'iterations': iterations,
+        'seconds': timings[0],
+        'median seconds': timings[len(timings) / 2],
+    }
+
+BENCHMARK_NAMES = [
+    'load_mission',
+    'determine_next_moves',
+    'pathfinding',
+    'try_to_move_entity',
+    'move_all_entities',
+    'find_collisions',
+    'resolve_collisions',
+    'delete_dead_entities',
+]
+
+def run_benchmarks(map_sizes=DEFAULT_MAP_SIZES, goose_counts=DEFAULT_GOOSE_COUNTS, names=BENCHMARK_NAMES, repeat=DEFAULT_REPEAT, iterations=DEFAULT_ITERATIONS, progress=None):
+    """Time every benchmark for every map size and goose count that fits on the map.
+    progress is called with each result as it finishes.
+    Returns a dictionary with 'meta' information and a list of 'results'.
+    """
+    results = []
+    for width, height in map_sizes:
+        for goose_count in goose_counts:
+            # Leave room for the fox.
+            if goose_count >= width * height:
+                continue
+            for name in names:
+                result = time_benchmark(name, width, height, goose_count, repeat, iterations)
+                results.append(result)
+                if progress:
+                    progress(result)
+
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time(),
+        },
+        'results': results,
+    }
+
+def time_encoding(width, height, goose_count, repeat=DEFAULT_REPEAT, iterations=100):
+    """Compare sending a turn as JSON of MissionController.get_status against the binary wire protocol.
+    Returns a result dictionary with the encoded sizes and the fastest encode and decode times per turn.
+    """
+    mission_model = make_mission_model(width, height, goose_count)
+    mission_controller = MissionController(mission_model=mission_model)
+    mission_controller.move_ai_entities()
+
+    status = mission_controller.get_status()
+    turn_delta = mission_controller.get_turn_delta()
+    codec = TurnDeltaCodec(mission_model.all_entities_by_id.keys())
+    buffer = codec.make_buffer()
+    decoded_turn_delta = {}
+
+    json_text = json.dumps(status)
+    binary_size = codec.encode_into(buffer, turn_delta)
+
+    def time_fastest(function):
+        timings = []
+        for i in xrange(repeat):
+            start_time = timeit.default_timer()
+            for j in xrange(iterations):
+                function()
+            timings.append((timeit.default_timer() - start_time) / iterations)
+        return min(timings)
+
+    return {
+        'name': 'encoding',
+        'width': width,
+        'height': height,
+        'geese': goose_count,
+        'moves': len(turn_delta['moves']),
+        'json bytes': len(json_text),
+        'binary bytes': binary_size,
+        'json encode seconds': time_fastest(lambda: json.dumps(status)),
+        'json decode seconds': time_fastest(lambda: json.loads(json_text)),
+        'binary encode seconds': time_fastest(lambda: codec.encode_into(buffer, turn_delta)),
+        'binary decode seconds': time_fastest(lambda: codec.decode_from(buffer, turn_delta=decoded_turn_delta)),
+    }
+
+def run_encoding_benchmarks(map_sizes=DEFAULT_MAP_SIZES, goose_counts=DEFAULT_GOOSE_COUNTS, repeat=DEFAULT_REPEAT, progress=None):
+    """Run time_encoding for every map size and goose count that fits on the map.
+    Returns a list of results.
+    """
+    results = []
+    for width, height in map_sizes:
+        for goose_count in goose_counts:
+            if goose_count >= width * height:
+                continue
+            result = time_encoding(width, height, goose_count, repeat)
+            results.append(result)
+            if progress:
+                progress(result)
+    return results
+
+def time_serialization(width, height, goose_count, repeat=DEFAULT_REPEAT):
+    """Compare shipping a mission with cPickle against mission_state.
+    Returns a result dictionary with the serialized sizes and the fastest serialize and deserialize times.
+    """
+    mission_model = make_mission_model(width, height, goose_count)
+    mission_controller = MissionController(mission_model=mission_model)
+    mission_controller.move_ai_entities()
+    mission_controller.reset_for_new_round()
+
+    pickled = cPickle.dumps(mission_model, cPickle.HIGHEST_PROTOCOL)
+    serialized = mission_state.serialize_mission(mission_model)
+
+    def time_fastest(function):
+        timings = []
+        for i in xrange(repeat):
+            start_time = timeit.default_timer()
+            function()
+            timings.append(timeit.default_timer() - start_time)
+        return min(timings)
+
+    return {
+        'name': 'serialization',
+        'width': width,
+        'height': height,
+        'geese': goose_count,
+        'pickle bytes': len(pickled),
+        'state bytes': len(serialized),
+        'pickle dump seconds': time_fastest(lambda: cPickle.dumps(mission_model, cPickle.HIGHEST_PROTOCOL)),
+        'pickle load seconds': time_fastest(lambda: cPickle.loads(pickled)),
+        'state serialize seconds': time_fastest(lambda: mission_state.serialize_mission(mission_model)),
+        'state deserialize seconds': time_fastest(lambda: mission_state.deserialize_mission(serialized)),
+    }
+
+def run_serialization_benchmarks(map_sizes=DEFAULT_MAP_SIZES, goose_counts=DEFAULT_GOOSE_COUNTS, repeat=DEFAULT_REPEAT, progress=None):
+    """Run time_serialization for every map size and goose count that fits on the map.
+    Returns a list of results.
+    """
+    results = []
+    for width, height in map_sizes:
+        for goose_count in goose_counts:
+            if goose_count >= width * height:
+                continue
+            result = time_serialization(width, height, goose_count, repeat)
+            results.append(result)
+            if progress:
+                progress(result)
+    return results
+
+def _result_key(result):
+    return (result['name'], result['width'], result['height'], result['geese'])
+
+def compare_results(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Compare two run_benchmarks outputs.
+    Returns a list of comparison dictionaries, one per benchmark found in both.
+    'regression' is True if the new time is slower than the baseline by more than tolerance.
+    """
+    baseline_by_key = dict([(_result_key(result), result) for result in baseline['results']])
+
+    comparisons = []
+    for result in results['results']:
+        key = _result_key(result)
+        if not key in baseline_by_key:
+            continue
+        baseline_seconds = baseline_by_key[key]['seconds']
+        ratio = result['seconds'] / baseline_seconds if baseline_seconds > 0 else 1.0
+        comparisons.append({
+            'name': result['name'],
+            'width': result['width'],
+            'height': result['height'],
+            'geese': result['geese'],
+            'seconds': result['seconds'],
+            'baseline seconds': baseline_seconds,
+            'ratio': ratio,
+            'regression': ratio > 1.0 + tolerance,
+        })
+    return comparisons
+
+def _parse_map_size(text):
+    width, height = text.lower().split('x')
+    return (int(width), int(height))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the Fox and Geese simulation hot paths.")
+    parser.add_argument('--output', help="Write the results to this JSON file.")
+    parser.add_argument('--compare', help="Compare against this baseline JSON file. Exits with 1 if anything regressed.")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help="Allowed slowdown before a benchmark counts as a regression.")
+    parser.add_argument('--map-size', action='append', type=_parse_map_size, dest='map_sizes', help="WIDTHxHEIGHT. May be repeated.")
+    parser.add_argument('--geese', action='append', type=int, dest='goose_counts', help="Number of geese. May be repeated.")
+    parser.add_argument('--benchmark', action='append', choices=BENCHMARK_NAMES, dest='names', help="Benchmark to run. May be repeated.")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="Runs per benchmark. The fastest one is reported.")
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS, help="Calls timed together in each run of a simulation benchmark.")
+    parser.add_argument('--encoding', action='store_true', help="Compare the turn encodings instead of timing the simulation.")
+    parser.add_argument('--serialization', action='store_true', help="Compare pickling a mission against mission_state instead of timing the simulation.")
+    args = parser.parse_args(argv)
+
+    if args.encoding:
+        print "%-12s %5s %6s %9s %9s %12s %12s %12s %12s" % (
+            "map", "geese", "moves", "json B", "binary B", "json enc", "json dec", "binary enc", "binary dec"
+        )
+        for result in run_encoding_benchmarks(
+            map_sizes=args.map_sizes or DEFAULT_MAP_SIZES,
+            goose_counts=args.goose_counts or DEFAULT_GOOSE_COUNTS,
+            repeat=args.repeat
+        ):
+            print "%4dx%-7d %5d %6d %9d %9d %11.2fus %11.2fus %11.2fus %11.2fus" % (
+                result['width'], result['height'], result['geese'], result['moves'],
+                result['json bytes'], result['binary bytes'],
+                result['json encode seconds'] * 1e6, result['json decode seconds'] * 1e6,
+                result['binary encode seconds'] * 1e6, result['binary decode seconds'] * 1e6
+            )
+        return 0
+
+    if args.serialization:
+        print "%-12s %5s %9s %9s %11s %11s %11s %11s" % (
+            "map", "geese", "pickle B", "state B", "pickle dump", "pickle load", "state ser", "state deser"
+        )
+        for result in run_serialization_benchmarks(
+            map_sizes=args.map_sizes or DEFAULT_MAP_SIZES,
+            goose_counts=args.goose_counts or DEFAULT_GOOSE_COUNTS,
+            repeat=args.repeat
+        ):
+            print "%4dx%-7d %5d %9d %9d %10.2fms %10.2fms %10.2fms %10.2fms" % (
+                result['width'], result['height'], result['geese'],
+                result['pickle bytes'], result['state bytes'],
+                result['pickle dump seconds'] * 1e3, result['pickle load seconds'] * 1e3,
+                result['state serialize seconds'] * 1e3, result['state deserialize seconds'] * 1e3
+            )
+        return 0
+
+    def print_result(result):
+        print "%-22s %4dx%-4d %5d geese %10.6fs" % (result['name'], result['width'], result['height'], result['geese'], result['seconds'])
+        sys.stdout.flush()
+
+    results = run_benchmarks(
+        map_sizes=args.map_sizes or DEFAULT_MAP_SIZES,
+        goose_counts=args.goose_counts or DEFAULT_GOOSE_COUNTS,
+        names=args.names or BENCHMARK_NAMES,
+        repeat=args.repeat,
+        iterations=args.iterations,
+        progress=print_result
+    )
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+
+    if not args.compare:
+        return 0
+
+    with open(args.compare) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    regressions = 0
+    for comparison in compare_results(results, baseline, args.tolerance):
+        flag = ""
+        if comparison['regression']:
+            flag = "REGRESSION"
+            regressions += 1
+        print "%-22s %4dx%-4d %5d geese %10.6fs vs %10.6fs %6.2fx %s" % (
+            comparison['name'], comparison['width'], comparison['height'], comparison['geese'],
+            comparison['seconds'], comparison['baseline seconds'], comparison['ratio'], flag
+        )
+
+    if regressions:
+        print "%d benchmarks regressed by more than %d%%." % (regressions, args.tolerance * 100)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,206 @@
+"""A sparse index of which Entity slots are on which cells, for maps of any size.
+
+The map is split into square chunks of chunk_size cells. A chunk is only allocated while something is on it, so memory
+grows with the number of occupied chunks and not with the map area. Each chunk tracks its own pending moves and crowded
+cells, so a turn only visits the chunks where something is going on.
+
+See EntityRegistry, which keeps its ChunkedGrid in step with the position columns.
+
+Only the Entities are indexed sparsely. Terrain is dense: terrain.TerrainGrid keeps two bytes per cell, its neighbor
+lists and distance fields (terrain.PathfindingService) a list and an int per cell, and the cell maps of
+symmetry.BoardTransform an int per cell. On very large maps, like 10,000 x 10,000, leave MissionModel.terrain None, and
+do not use MissionModel.get_symmetry or an opening book.
+"""
+
+DEFAULT_CHUNK_SIZE = 64
+
+class GridChunk(object):
+    """The slots on one chunk of the map.
+    """
+    def __init__(self, chunk_key):
+        self.chunk_key = chunk_key
+
+        self.slots_by_position = {}
+        """Lists of slots, keyed by (x, y). Only occupied cells have a key."""
+
+        self.crowded_positions = set()
+        """Cells with two or more slots on them."""
+
+        self.pending_slots = set()
+        """Slots on this chunk with a pending move."""
+
+        self.slot_count = 0
+
+    def is_empty(self):
+        return self.slot_count == 0 and not self.pending_slots
+
+class ChunkedGrid(object):
+    """Slots by position, stored in chunks that are allocated on demand.
+    Positions of None are not indexed.
+    """
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.chunks = {}
+
+        self.active_chunk_keys = set()
+        """Chunks with pending moves."""
+
+        self.crowded_chunk_keys = set()
+        """Chunks that may have crowded cells. Chunks that no longer do are dropped by get_crowded_cells."""
+
+    def get_chunk_key(self, x, y):
+        return (x // self.chunk_size, y // self.chunk_size)
+
+    def _get_chunk(self, x, y):
+        chunk_key = (x // self.chunk_size, y // self.chunk_size)
+        chunk = self.chunks.get(chunk_key)
+        if chunk is None:
+            chunk = GridChunk(chunk_key)
+            self.chunks[chunk_key] = chunk
+        return chunk
+
+    def _free_chunk_if_empty(self, chunk):
+        if chunk.is_empty():
+            del self.chunks[chunk.chunk_key]
+
+    def add(self, slot, x, y):
+        """Put the slot on the cell.
+        """
+        if x is None or y is None:
+            return
+        chunk = self._get_chunk(x, y)
+        position = (x, y)
+        slots = chunk.slots_by_position.get(position)
+        if slots is None:
+            chunk.slots_by_position[position] = [slot]
+        else:
+            slots.append(slot)
+            chunk.crowded_positions.add(position)
+            self.crowded_chunk_keys.add(chunk.chunk_key)
+        chunk.slot_count += 1
+
+    def remove(self, slot, x, y):
+        """Take the slot off the cell.
+        """
+        if x is None or y is None:
+            return
+        chunk = self.chunks[(x // self.chunk_size, y // self.chunk_size)]
+        position = (x, y)
+        slots = chunk.slots_by_position[position]
+        slots.remove(slot)
+        if not slots:
+            del chunk.slots_by_position[position]
+        elif len(slots) == 1:
+            chunk.crowded_positions.discard(position)
+        chunk.slot_count -= 1
+        self._free_chunk_if_empty(chunk)
+
+    def move(self, slot, x, y, new_x, new_y):
+        """Move the slot from one cell to another.
+        """
+        chunk_size = self.chunk_size
+        if x is None or y is None or new_x is None or new_y is None:
+            chunk_key = None
+        else:
+            chunk_key = (x // chunk_size, y // chunk_size)
+        if chunk_key is None or chunk_key != (new_x // chunk_size, new_y // chunk_size):
+            self.remove(slot, x, y)
+            self.add(slot, new_x, new_y)
+            return
+
+        # Most moves stay on the same chunk.
+        chunk = self.chunks[chunk_key]
+        slots_by_position = chunk.slots_by_position
+        position = (x, y)
+        slots = slots_by_position[position]
+        if len(slots) == 1:
+            del slots_by_position[position]
+        else:
+            slots.remove(slot)
+            if len(slots) == 1:
+                chunk.crowded_positions.discard(position)
+
+        new_position = (new_x, new_y)
+        new_slots = slots_by_position.get(new_position)
+        if new_slots is None:
+            slots_by_position[new_position] = [slot]
+        else:
+            new_slots.append(slot)
+            chunk.crowded_positions.add(new_position)
+            self.crowded_chunk_keys.add(chunk_key)
+
+    def get_slots_at(self, x, y):
+        """Returns a list of the slots on the cell.
+        """
+        chunk = self.chunks.get((x // self.chunk_size, y // self.chunk_size))
+        if chunk is None:
+            return []
+        return list(chunk.slots_by_position.get((x, y), []))
+
+    def get_slots_in_area(self, min_x, min_y, max_x, max_y):
+        """Returns a list of the slots on cells from (min_x, min_y) to (max_x, max_y), inclusive.
+        Only the allocated chunks overlapping the area are visited.
+        """
+        min_chunk_x, min_chunk_y = self.get_chunk_key(min_x, min_y)
+        max_chunk_x, max_chunk_y = self.get_chunk_key(max_x, max_y)
+
+        slots = []
+        for chunk_x in xrange(min_chunk_x, max_chunk_x + 1):
+            for chunk_y in xrange(min_chunk_y, max_chunk_y + 1):
+                chunk = self.chunks.get((chunk_x, chunk_y))
+                if chunk is None:
+                    continue
+                for (x, y), position_slots in chunk.slots_by_position.iteritems():
+                    if min_x <= x <= max_x and min_y <= y <= max_y:
+                        slots.extend(position_slots)
+        return slots
+
+    def get_crowded_cells(self):
+        """Returns a list of ((x, y), slots) for every cell with two or more slots. Cells and slots are sorted.
+        """
+        crowded_cells = []
+        for chunk_key in list(self.crowded_chunk_keys):
+            chunk = self.chunks.get(chunk_key)
+            if chunk is None or not chunk.crowded_positions:
+                self.crowded_chunk_keys.discard(chunk_key)
+                continue
+            for position in chunk.crowded_positions:
+                crowded_cells.append((position, sorted(chunk.slots_by_position[position])))
+        crowded_cells.sort()
+        return crowded_cells
+
+    def mark_pending(self, slot, x, y):
+        """Note the slot on the cell has a pending move, so its chunk is visited next turn.
+        """
+        if x is None or y is None:
+            return
+        chunk_key = (x // self.chunk_size, y // self.chunk_size)
+        chunk = self.chunks.get(chunk_key)
+        if chunk is None:
+            chunk = self._get_chunk(x, y)
+        chunk.pending_slots.add(slot)
+        self.active_chunk_keys.add(chunk_key)
+
+    def unmark_pending(self, slot, x, y):
+        if x is None or y is None:
+            return
+        chunk = self.chunks.get((x // self.chunk_size, y // self.chunk_size))
+        if chunk is None or not slot in chunk.pending_slots:
+            return
+        chunk.pending_slots.remove(slot)
+        if not chunk.pending_slots:
+            self.active_chunk_keys.discard(chunk.chunk_key)
+        self._free_chunk_if_empty(chunk)
+
+    def pop_pending_slots(self):
+        """Returns a sorted list of the slots with pending moves, and forgets them. Chunks without moves are skipped.
+        """
+        pending_slots = []
+        for chunk_key in self.active_chunk_keys:
+            chunk = self.chunks[chunk_key]
+            pending_slots.extend(chunk.pending_slots)
+            chunk.pending_slots.clear()
+            self._free_chunk_if_empty(chunk)
+        self.active_chunk_keys.clear()
+        pending_slots.sort()
+        return pending_slots
@@ -1,5 +1,113 @@
-class Entity:
+import array
+
+from chunked_grid import ChunkedGrid
+
+NO_TYPE = 0
+FOX = 1
+GOOSE = 2
+OTHER_TYPE = 3
+
+ENTITY_TYPE_CODES = {
+    None: NO_TYPE,
+    'fox': FOX,
+    'goose': GOOSE,
+}
+"""Small integer codes for entity types, so hot loops compare ints instead of strings.
+The codes are stored in shared boards and opening books, so they are fixed. Every other type has OTHER_TYPE."""
+
+def get_entity_type_code(entity_type):
+    """Returns the integer code of the entity type. OTHER_TYPE if it is not in ENTITY_TYPE_CODES.
+    """
+    return ENTITY_TYPE_CODES.get(entity_type, OTHER_TYPE)
+
+HANDLE_SLOT_BITS = 24
+HANDLE_SLOT_MASK = (1 << HANDLE_SLOT_BITS) - 1
+"""A handle is the slot number in the low HANDLE_SLOT_BITS bits and the slot's generation above them."""
+
+COMPONENTS = [
+    ('position_x', 'positions_x'),
+    ('position_y', 'positions_y'),
+    ('pending_position_x', 'pending_positions_x'),
+    ('pending_position_y', 'pending_positions_y'),
+    ('position_history', 'position_histories'),
+    ('resource_id', 'resource_ids'),
+    ('collision_behavior', 'collision_behaviors'),
+]
+"""Entity attributes stored in EntityRegistry columns while the Entity is registered, with the name of the column."""
+
+def _component_property(attribute_name, column_name):
+    # Reads and writes the registry's column while the Entity is registered, and the Entity's own copy otherwise.
+    local_name = '_' + attribute_name
+
+    def get_component(self):
+        registry = self.registry
+        if registry is None:
+            return self.__dict__[local_name]
+        return registry.__dict__[column_name][self.slot]
+
+    def set_component(self, value):
+        registry = self.registry
+        if registry is None:
+            self.__dict__[local_name] = value
+        else:
+            registry.__dict__[column_name][self.slot] = value
+
+    return property(get_component, set_component)
+
+def _position_property(attribute_name, column_name, x_column_name, y_column_name, setter_name):
+    # Like _component_property, but registered writes go through the registry's setter_name(slot, x, y),
+    # so it can keep its ChunkedGrid up to date.
+    local_name = '_' + attribute_name
+
+    def get_component(self):
+        registry = self.registry
+        if registry is None:
+            return self.__dict__[local_name]
+        return registry.__dict__[column_name][self.slot]
+
+    def set_component(self, value):
+        registry = self.registry
+        if registry is None:
+            self.__dict__[local_name] = value
+            return
+        x = registry.__dict__[x_column_name][self.slot]
+        y = registry.__dict__[y_column_name][self.slot]
+        if column_name == x_column_name:
+            x = value
+        else:
+            y = value
+        getattr(registry, setter_name)(self.slot, x, y)
+
+    return property(get_component, set_component)
+
+def _position_history_property():
+    # Reads through EntityRegistry.get_position_history, which fills in the turns the Entity stood still.
+    def get_position_history(self):
+        registry = self.registry
+        if registry is None:
+            return self.__dict__['_position_history']
+        return registry.get_position_history(self.slot)
+
+    def set_position_history(self, position_history):
+        registry = self.registry
+        if registry is None:
+            self.__dict__['_position_history'] = position_history
+        else:
+            registry.set_position_history(self.slot, position_history)
+
+    return property(get_position_history, set_position_history)
+
+class Entity(object):
+    """Something on the map.
+    While it is in an EntityRegistry its components live in the registry's columns, and this object is a view of its slot.
+    """
     def __init__(self, position={'x':None, 'y':None}, entity_type=None):
+        # The EntityRegistry holding this Entity, and where in it.
+        self.registry = None
+        self.registry_id = None
+        self.handle = None
+        self.slot = None
+
         self.position_x = position['x']
         self.position_y = position['y']
 
@@ -8,14 +116,72 @@ class Entity:
 
         self.position_history = []
 
-        self.is_dead = False
+        self._is_dead = False
 
         self.resource_id = None
+        self._entity_type = None
+        self._type_code = NO_TYPE
         self.entity_type = entity_type
 
         # This component controlls the behavior when the Entity collides with something else.
         self.collision_behavior = CollisionResolver(self)
 
+    position_x = _position_property('position_x', 'positions_x', 'positions_x', 'positions_y', 'set_position')
+    position_y = _position_property('position_y', 'positions_y', 'positions_x', 'positions_y', 'set_position')
+    pending_position_x = _position_property('pending_position_x', 'pending_positions_x', 'pending_positions_x', 'pending_positions_y', 'set_pending_position')
+    pending_position_y = _position_property('pending_position_y', 'pending_positions_y', 'pending_positions_x', 'pending_positions_y', 'set_pending_position')
+    position_history = _position_history_property()
+    resource_id = _component_property('resource_id', 'resource_ids')
+    collision_behavior = _component_property('collision_behavior', 'collision_behaviors')
+
+    @property
+    def type_code(self):
+        if self.registry is None:
+            return self._type_code
+        return self.registry.type_codes[self.slot]
+
+    @property
+    def entity_type(self):
+        return self._entity_type
+
+    @entity_type.setter
+    def entity_type(self, entity_type):
+        registry = self.registry
+        if registry is not None:
+            registry.count_entity(self, -1)
+        self._entity_type = entity_type
+        self._type_code = get_entity_type_code(entity_type)
+        if registry is not None:
+            registry.type_codes[self.slot] = self._type_code
+            registry.count_entity(self, 1)
+
+    @property
+    def is_dead(self):
+        if self.registry is None:
+            return self._is_dead
+        return self.registry.dead[self.slot] == 1
+
+    @is_dead.setter
+    def is_dead(self, is_dead):
+        is_dead = bool(is_dead)
+        if self.registry is None:
+            self._is_dead = is_dead
+        elif is_dead != self.is_dead:
+            self.registry.set_dead(self, is_dead)
+
+    def __getstate__(self):
+        # Pickle a copy with its own components, not a view of the registry. The registry adds it back.
+        state = dict(self.__dict__)
+        if self.registry is not None:
+            for attribute_name, column_name in COMPONENTS:
+                state['_' + attribute_name] = getattr(self, attribute_name)
+            state['_is_dead'] = self.is_dead
+            state['registry'] = None
+            state['registry_id'] = None
+            state['handle'] = None
+            state['slot'] = None
+        return state
+
     def resolve_collisions(self, collision_info):
         return self.collision_behavior.get_collision_resolution(
             colliding_entities = collision_info['colliding objects'],
@@ -23,6 +189,372 @@ class Entity:
             collision_y = collision_info['y']
         )
 
+class EntityRegistry(dict):
+    """A dictionary of Entities by id that stores their components in columns, one list per component.
+
+    Every Entity added gets a slot, and index slot of every column belongs to it. Systems like MissionModel.move_all_entities
+    loop over just the columns they need. Freed slots hold None in entity_ids_by_slot until they are reused.
+
+    The registry also counts the living and dead Entities of each type as they change.
+    Every Entity gets an integer handle. Handles of removed Entities go stale, so a slot can be reused safely.
+
+    grid indexes the slots by position, and knows which of them have pending moves. Change positions with set_position
+    and set_pending_position (the Entity properties do) so it stays up to date.
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self.grid = ChunkedGrid()
+
+        self.moved_slots = set()
+        """Slots that changed cell since the turn started. The dirty set of the turn."""
+
+        self.turn_count = 0
+        """Turns started with start_turn."""
+
+        self.live_count_by_type = {}
+        self.dead_count_by_type = {}
+
+        self.dead_entity_ids = set()
+        """Ids of the dead Entities that have not been deleted yet."""
+
+        self.position_listeners = []
+        """Called with the slot whenever set_position moves an Entity. See add_position_listener."""
+
+        # Component columns, indexed by slot. See COMPONENTS.
+        self.positions_x = []
+        self.positions_y = []
+        self.pending_positions_x = []
+        self.pending_positions_y = []
+        self.position_histories = []
+        self.resource_ids = []
+        self.collision_behaviors = []
+        self.type_codes = array.array('B')
+        self.dead = array.array('B')
+
+        self.entities_by_slot = []
+        self.entity_ids_by_slot = []
+        self.slot_generations = array.array('L')
+        self.free_slots = []
+
+        # Turns recorded in each slot's position history. Turns the Entity stood still are added when the history is read
+        # or the Entity moves, so a turn does not have to touch every Entity. See get_position_history.
+        self.history_turn_counts = array.array('L')
+
+        self.update(*args, **kwargs)
+
+    def __reduce__(self):
+        # Pickle as the Entities in slot order. Unpickling adds them to a new registry.
+        return (EntityRegistry, (), None, None, iter([(entity_id, self[entity_id]) for entity_id in self.get_entity_ids_in_order()]))
+
+    def get_occupied_slots(self):
+        """Returns a list of the slots that hold an Entity.
+        """
+        return [slot for slot, entity_id in enumerate(self.entity_ids_by_slot) if entity_id is not None]
+
+    def count_entity(self, entity, change):
+        """Add change to the living or dead count of the Entity's type.
+        """
+        if entity.is_dead:
+            count_by_type = self.dead_count_by_type
+        else:
+            count_by_type = self.live_count_by_type
+        count_by_type[entity.type_code] = count_by_type.get(entity.type_code, 0) + change
+
+    def __setitem__(self, entity_id, entity):
+        if entity_id in self:
+            del self[entity_id]
+
+        # An Entity can only be in one registry.
+        if entity.registry is not None:
+            del entity.registry[entity.registry_id]
+
+        # Read the components before the Entity becomes a view of this registry.
+        components = [getattr(entity, attribute_name) for attribute_name, column_name in COMPONENTS]
+        type_code = entity.type_code
+        is_dead = entity.is_dead
+
+        dict.__setitem__(self, entity_id, entity)
+
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.entities_by_slot[slot] = entity
+            self.entity_ids_by_slot[slot] = entity_id
+            for (attribute_name, column_name), value in zip(COMPONENTS, components):
+                self.__dict__[column_name][slot] = value
+            self.type_codes[slot] = type_code
+            self.dead[slot] = is_dead
+            self.history_turn_counts[slot] = self.turn_count
+        else:
+            slot = len(self.entities_by_slot)
+            self.entities_by_slot.append(entity)
+            self.entity_ids_by_slot.append(entity_id)
+            for (attribute_name, column_name), value in zip(COMPONENTS, components):
+                self.__dict__[column_name].append(value)
+            self.type_codes.append(type_code)
+            self.dead.append(is_dead)
+            self.slot_generations.append(0)
+            self.history_turn_counts.append(self.turn_count)
+
+        entity.registry = self
+        entity.registry_id = entity_id
+        entity.slot = slot
+        entity.handle = (self.slot_generations[slot] << HANDLE_SLOT_BITS) | slot
+
+        position_x = self.positions_x[slot]
+        position_y = self.positions_y[slot]
+        self.grid.add(slot, position_x, position_y)
+        if self.pending_positions_x[slot] is not None or self.pending_positions_y[slot] is not None:
+            self.grid.mark_pending(slot, position_x, position_y)
+        self.count_entity(entity, 1)
+        if is_dead:
+            self.dead_entity_ids.add(entity_id)
+
+    def __delitem__(self, entity_id):
+        entity = self[entity_id]
+        slot = entity.slot
+        self.count_entity(entity, -1)
+        self.dead_entity_ids.discard(entity_id)
+
+        position_x = self.positions_x[slot]
+        position_y = self.positions_y[slot]
+        self.grid.unmark_pending(slot, position_x, position_y)
+        self.grid.remove(slot, position_x, position_y)
+        self.moved_slots.discard(slot)
+
+        # Give the Entity its own copy of its components again, and empty the slot.
+        components = [getattr(entity, attribute_name) for attribute_name, column_name in COMPONENTS]
+        is_dead = entity.is_dead
+        entity.registry = None
+        for (attribute_name, column_name), value in zip(COMPONENTS, components):
+            setattr(entity, attribute_name, value)
+            self.__dict__[column_name][slot] = None
+        entity.is_dead = is_dead
+        entity.registry_id = None
+        entity.handle = None
+        entity.slot = None
+
+        dict.__delitem__(self, entity_id)
+
+        # Free the slot. The new generation makes old handles to it stale.
+        self.entities_by_slot[slot] = None
+        self.entity_ids_by_slot[slot] = None
+        self.slot_generations[slot] += 1
+        self.free_slots.append(slot)
+
+    def pop(self, entity_id, *default):
+        if not entity_id in self:
+            return dict.pop(self, entity_id, *default)
+        entity = self[entity_id]
+        del self[entity_id]
+        return entity
+
+    def setdefault(self, entity_id, entity=None):
+        if not entity_id in self:
+            self[entity_id] = entity
+        return self[entity_id]
+
+    def update(self, *args, **kwargs):
+        for entity_id, entity in dict(*args, **kwargs).iteritems():
+            self[entity_id] = entity
+
+    def clear(self):
+        for entity_id in self.keys():
+            del self[entity_id]
+
+    def start_turn(self):
+        """Start a new turn. Every Entity's position history gets its current position, and no slots have moved yet.
+        """
+        self.turn_count += 1
+        self.moved_slots.clear()
+
+    def get_position_history(self, slot):
+        """Returns the position history of the Entity in the slot, with one position for every turn it was registered.
+        """
+        position_history = self.position_histories[slot]
+        missing_turn_count = self.turn_count - self.history_turn_counts[slot]
+        if missing_turn_count > 0:
+            # The Entity has not moved since its history was last filled in.
+            x = self.positions_x[slot]
+            y = self.positions_y[slot]
+            position_history.extend([{'x': x, 'y': y} for turn in xrange(missing_turn_count)])
+            self.history_turn_counts[slot] = self.turn_count
+        return position_history
+
+    def set_position_history(self, slot, position_history):
+        self.position_histories[slot] = position_history
+        self.history_turn_counts[slot] = self.turn_count
+
+    def get_previous_position(self, slot):
+        """Returns the (x, y) the Entity in the slot had when the turn started, the same as its position_history[-1].
+        Does not fill in the history. Entities without a history return their current position.
+        """
+        if self.history_turn_counts[slot] < self.turn_count or not self.position_histories[slot]:
+            return (self.positions_x[slot], self.positions_y[slot])
+        previous_position = self.position_histories[slot][-1]
+        return (previous_position['x'], previous_position['y'])
+
+    def load(self, entity_ids, entity_types, positions_x, positions_y, resource_ids, dead):
+        """Fill an empty registry with new Entities, a column at a time. Much faster than adding them one by one.
+        The arguments are parallel sequences. Returns the new Entities in slot order.
+        Each Entity gets a plain CollisionResolver. Replace them as needed.
+        """
+        if self or self.entities_by_slot:
+            raise ValueError("Only an empty registry can be loaded.")
+
+        entity_count = len(entity_ids)
+        type_codes = [get_entity_type_code(entity_type) for entity_type in entity_types]
+
+        entities = []
+        for slot, entity_id in enumerate(entity_ids):
+            # The Entity is a view of its slot from the start, so it has no components of its own.
+            entity = Entity.__new__(Entity)
+            entity.__dict__.update({
+                'registry': self,
+                'registry_id': entity_id,
+                'handle': slot,
+                'slot': slot,
+                '_entity_type': entity_types[slot],
+                '_type_code': type_codes[slot],
+                '_is_dead': False,
+            })
+            entities.append(entity)
+
+        self.positions_x = list(positions_x)
+        self.positions_y = list(positions_y)
+        self.pending_positions_x = [None] * entity_count
+        self.pending_positions_y = [None] * entity_count
+        self.position_histories = [[] for slot in xrange(entity_count)]
+        self.resource_ids = list(resource_ids)
+        self.collision_behaviors = [CollisionResolver(entity) for entity in entities]
+        self.type_codes = array.array('B', type_codes)
+        self.dead = array.array('B', [1 if is_dead else 0 for is_dead in dead])
+        self.entities_by_slot = entities
+        self.entity_ids_by_slot = list(entity_ids)
+        self.slot_generations = array.array('L', [0]) * entity_count
+        self.history_turn_counts = array.array('L', [self.turn_count]) * entity_count
+        self.free_slots = []
+
+        dict.update(self, zip(entity_ids, entities))
+
+        for slot in xrange(entity_count):
+            self.grid.add(slot, self.positions_x[slot], self.positions_y[slot])
+            if self.dead[slot]:
+                count_by_type = self.dead_count_by_type
+                self.dead_entity_ids.add(entity_ids[slot])
+            else:
+                count_by_type = self.live_count_by_type
+            count_by_type[type_codes[slot]] = count_by_type.get(type_codes[slot], 0) + 1
+        return entities
+
+    def set_position(self, slot, x, y):
+        """Move the Entity in the slot to (x, y).
+        """
+        previous_x = self.positions_x[slot]
+        previous_y = self.positions_y[slot]
+        if x == previous_x and y == previous_y:
+            return
+
+        # Record where it stood before it moves.
+        self.get_position_history(slot)
+
+        # A pending move belongs to the chunk the Entity is on.
+        is_pending = self.pending_positions_x[slot] is not None or self.pending_positions_y[slot] is not None
+        if is_pending:
+            self.grid.unmark_pending(slot, previous_x, previous_y)
+
+        self.grid.move(slot, previous_x, previous_y, x, y)
+        self.positions_x[slot] = x
+        self.positions_y[slot] = y
+        self.moved_slots.add(slot)
+
+        if is_pending:
+            self.grid.mark_pending(slot, x, y)
+
+        for listener in self.position_listeners:
+            listener(slot)
+
+    def add_position_listener(self, listener):
+        """Call listener(slot) whenever set_position moves an Entity, as the Entity position properties do.
+        Systems that write the position columns directly, like MissionModel.move_all_entities, report their moves
+        with MissionModel.notify_entities_moved instead.
+        """
+        self.position_listeners.append(listener)
+
+    def remove_position_listener(self, listener):
+        """Stop calling listener when an Entity moves.
+        """
+        self.position_listeners.remove(listener)
+
+    def set_pending_position(self, slot, x, y):
+        """Set where the Entity in the slot moves next turn. None for both clears the pending move.
+        """
+        self.pending_positions_x[slot] = x
+        self.pending_positions_y[slot] = y
+        if x is None and y is None:
+            self.grid.unmark_pending(slot, self.positions_x[slot], self.positions_y[slot])
+        else:
+            self.grid.mark_pending(slot, self.positions_x[slot], self.positions_y[slot])
+
+    def set_dead(self, entity, is_dead):
+        """Mark the Entity in this registry dead or alive.
+        """
+        type_code = entity.type_code
+        self.dead[entity.slot] = is_dead
+        if is_dead:
+            self.live_count_by_type[type_code] -= 1
+            self.dead_count_by_type[type_code] = self.dead_count_by_type.get(type_code, 0) + 1
+            self.dead_entity_ids.add(entity.registry_id)
+        else:
+            self.dead_count_by_type[type_code] -= 1
+            self.live_count_by_type[type_code] = self.live_count_by_type.get(type_code, 0) + 1
+            self.dead_entity_ids.discard(entity.registry_id)
+
+    def count(self, entity_type, dead=None):
+        """Returns the number of Entities of the type, given as a name or a type code.
+        Types without a code of their own share OTHER_TYPE, and are counted together.
+        Set dead to True or False to count only dead or living ones.
+        """
+        type_code = entity_type
+        if not isinstance(entity_type, int):
+            type_code = get_entity_type_code(entity_type)
+
+        if dead is None:
+            return self.live_count_by_type.get(type_code, 0) + self.dead_count_by_type.get(type_code, 0)
+        if dead:
+            return self.dead_count_by_type.get(type_code, 0)
+        return self.live_count_by_type.get(type_code, 0)
+
+    def get_entity(self, handle):
+        """Returns the Entity with the handle, or None if it was removed.
+        """
+        slot = handle & HANDLE_SLOT_MASK
+        if slot >= len(self.entities_by_slot) or self.slot_generations[slot] != handle >> HANDLE_SLOT_BITS:
+            return None
+        return self.entities_by_slot[slot]
+
+    def get_entity_id(self, handle):
+        """Returns the id of the Entity with the handle, or None if it was removed.
+        """
+        if self.get_entity(handle) is None:
+            return None
+        return self.entity_ids_by_slot[handle & HANDLE_SLOT_MASK]
+
+    def get_handle(self, entity_id):
+        """Returns the handle of the Entity with the id.
+        """
+        return self[entity_id].handle
+
+    def get_slot(self, entity_id):
+        """Returns the slot of the Entity with the id. Sorting ids by slot is sorting them in the order they were added,
+        unless slots were reused.
+        """
+        return self[entity_id].slot
+
+    def get_entity_ids_in_order(self):
+        """Returns the ids of all Entities, sorted by handle slot.
+        """
+        return [entity_id for entity_id in self.entity_ids_by_slot if entity_id is not None]
+
 class CollisionResolver():
     # Abstract class for collision resolution. Figures out what it should do when it collides with other objects.
     def __init__(self, entity):
@@ -54,7 +586,7 @@ class FoxCollisionResolver(CollisionResolver):
                 continue
 
             # Count the living geese
-            if colliding_entity.entity_type == 'goose' and not colliding_entity.is_dead:
+            if colliding_entity.type_code == GOOSE and not colliding_entity.is_dead:
                 goose_count += 1
 
         # If there are 3 geese, You are dead
@@ -84,11 +616,11 @@ class GooseCollisionResolver(CollisionResolver):
                 continue
 
             # count the number of geese
-            if colliding_entity.entity_type == 'goose':
+            if colliding_entity.type_code == GOOSE:
                 goose_collisions.append(colliding_entity)
 
             # see if you bumped into a fox
-            if colliding_entity.entity_type == 'fox':
+            if colliding_entity.type_code == FOX:
                 collided_with_fox = True
 
         # If there is a fox and less than 3 geese, this goose should die.
@@ -0,0 +1,214 @@
+"""Draws and animates Entities as textured rectangles. Requires Kivy.
+
+All of the entity icons are packed into one texture and every sprite lives in a single InstructionGroup,
+so drawing hundreds of Entities does not need hundreds of widgets or texture binds.
+"""
+from array import array
+
+from kivy.clock import Clock
+from kivy.core.image import Image as CoreImage
+from kivy.event import EventDispatcher
+from kivy.graphics import Color, InstructionGroup, Rectangle
+from kivy.graphics.texture import Texture
+from kivy.properties import ListProperty, NumericProperty, ReferenceListProperty
+
+class TextureAtlas(object):
+    """Packs several images side by side into one texture.
+    """
+    def __init__(self, resources_by_id):
+        """resources_by_id: a dictionary. Keys are resource ids, values are image file paths.
+        """
+        textures_by_id = {}
+        for resource_id in resources_by_id:
+            textures_by_id[resource_id] = CoreImage(resources_by_id[resource_id]).texture
+
+        # Every image gets its own column.
+        atlas_width = sum([texture.width for texture in textures_by_id.values()])
+        atlas_height = max([texture.height for texture in textures_by_id.values()])
+        self.texture = Texture.create(size=(atlas_width, atlas_height), colorfmt='rgba')
+
+        # Copy each image into the atlas and remember where it went.
+        self.regions_by_id = {}
+        x = 0
+        for resource_id in sorted(textures_by_id):
+            texture = textures_by_id[resource_id]
+            self.texture.blit_buffer(
+                texture.pixels,
+                pos=(x, 0),
+                size=texture.size,
+                colorfmt='rgba',
+                bufferfmt='ubyte'
+            )
+            self.regions_by_id[resource_id] = self.texture.get_region(x, 0, texture.width, texture.height)
+            x += texture.width
+
+    def get_region(self, resource_id):
+        """Returns the part of the atlas texture that holds the given image.
+        """
+        return self.regions_by_id[resource_id]
+
+class EntitySprite(EventDispatcher):
+    """A textured rectangle that can be moved and faded like a widget.
+    """
+    x = NumericProperty(0)
+    y = NumericProperty(0)
+    pos = ReferenceListProperty(x, y)
+    size = ListProperty([0, 0])
+    opacity = NumericProperty(1.0)
+
+    def __init__(self, **kwargs):
+        self.color = Color(1, 1, 1, 1)
+        self.rectangle = Rectangle()
+        super(EntitySprite, self).__init__(**kwargs)
+
+    def on_pos(self, instance, value):
+        self.rectangle.pos = value
+
+    def on_size(self, instance, value):
+        self.rectangle.size = value
+
+    def on_opacity(self, instance, value):
+        self.color.a = value
+
+    def set_texture(self, texture):
+        self.rectangle.texture = texture
+
+class EntitySpriteRenderer(object):
+    """Hands out EntitySprites that all draw from one atlas in one InstructionGroup.
+    Released sprites are hidden and reused instead of being destroyed.
+    """
+    def __init__(self, canvas, resources_by_id):
+        """canvas: The canvas to draw on.
+        resources_by_id: a dictionary. Keys are resource ids, values are image file paths.
+        """
+        self.atlas = TextureAtlas(resources_by_id)
+
+        self.instructions = InstructionGroup()
+        canvas.add(self.instructions)
+
+        # Hidden sprites waiting to be reused.
+        self.free_sprites = []
+
+    def get_sprite(self, resource_id):
+        """Returns a visible sprite showing the given resource.
+        """
+        if self.free_sprites:
+            sprite = self.free_sprites.pop()
+        else:
+            sprite = EntitySprite()
+            self.instructions.add(sprite.color)
+            self.instructions.add(sprite.rectangle)
+
+        sprite.set_texture(self.atlas.get_region(resource_id))
+        sprite.opacity = 1.0
+        return sprite
+
+    def release_sprite(self, sprite):
+        """Hide the sprite and keep it for later.
+        """
+        sprite.opacity = 0.0
+        sprite.size = (0, 0)
+        self.free_sprites.append(sprite)
+
+class EntityAnimationDriver(object):
+    """Moves sprites to their destinations, then fades out the dead ones.
+    All sprites are interpolated from one Clock callback per frame instead of one Animation per sprite.
+    Every sprite moves at the same speed, so one that moves further takes longer.
+    """
+    def __init__(self, cell_size=(1.0, 1.0), move_duration=1.0, fade_duration=1.0):
+        """cell_size: The (width, height) of a map cell on screen.
+        move_duration: Seconds to move one cell. Diagonal steps count as one cell.
+        fade_duration: Seconds to fade out a dead sprite once it arrives.
+        """
+        self.cell_width, self.cell_height = cell_size
+        self.move_duration = move_duration
+        self.fade_duration = fade_duration
+
+        self.sprites = []
+        self.start_x = array('d')
+        self.start_y = array('d')
+        self.final_x = array('d')
+        self.final_y = array('d')
+        self.move_durations = array('d')
+
+        # Indexes into self.sprites of the sprites to fade, and the size they start fading from.
+        self.fading_sprite_indexes = []
+        self.fade_start_sizes = []
+
+        self.elapsed_time = 0.0
+        self.on_complete = None
+
+    def add_sprite(self, sprite, final_position, fade_out=False):
+        """Move sprite to final_position. If fade_out is True, shrink it away after it arrives.
+        """
+        if fade_out:
+            self.fading_sprite_indexes.append(len(self.sprites))
+            self.fade_start_sizes.append(tuple(sprite.size))
+
+        self.sprites.append(sprite)
+        self.start_x.append(sprite.x)
+        self.start_y.append(sprite.y)
+        self.final_x.append(final_position[0])
+        self.final_y.append(final_position[1])
+
+        # How many cells the sprite crosses, counting a diagonal step as one.
+        distance = max(
+            abs(final_position[0] - sprite.x) / self.cell_width,
+            abs(final_position[1] - sprite.y) / self.cell_height
+        )
+        self.move_durations.append(distance * self.move_duration)
+
+    def get_total_duration(self):
+        """Returns how long it takes for the last sprite to finish. 0 if there are no sprites.
+        """
+        total_duration = max(self.move_durations or [0.0])
+        for index in self.fading_sprite_indexes:
+            total_duration = max(total_duration, self.move_durations[index] + self.fade_duration)
+        return total_duration
+
+    def start(self, on_complete=None):
+        """Start animating. on_complete() is called as soon as the last sprite finishes, on the first frame if there
+        is nothing to animate.
+        """
+        self.on_complete = on_complete
+        self.elapsed_time = 0.0
+        self.total_duration = self.get_total_duration()
+        Clock.schedule_interval(self._tick, 0)
+
+    def _tick(self, dt):
+        # Called once per frame. Returns False to stop the Clock when finished.
+        self.elapsed_time += dt
+        elapsed_time = self.elapsed_time
+
+        # Move everyone at the same speed. Sprites that arrived stay put.
+        start_x = self.start_x
+        start_y = self.start_y
+        final_x = self.final_x
+        final_y = self.final_y
+        move_durations = self.move_durations
+        for index, sprite in enumerate(self.sprites):
+            move_duration = move_durations[index]
+            if elapsed_time >= move_duration:
+                move_progress = 1.0
+            else:
+                move_progress = elapsed_time / move_duration
+            sprite.pos = (
+                start_x[index] + (final_x[index] - start_x[index]) * move_progress,
+                start_y[index] + (final_y[index] - start_y[index]) * move_progress
+            )
+
+        # Once they arrive, shrink the dead ones away.
+        for index, start_size in zip(self.fading_sprite_indexes, self.fade_start_sizes):
+            fade_time = elapsed_time - move_durations[index]
+            if fade_time <= 0:
+                continue
+            fade_progress = min(fade_time / self.fade_duration, 1.0)
+            scale = 1.0 - (fade_progress * fade_progress)
+            self.sprites[index].size = (start_size[0] * scale, start_size[1] * scale)
+
+        if elapsed_time < self.total_duration:
+            return True
+
+        if self.on_complete:
+            self.on_complete()
+        return False
@@ -6,42 +6,16 @@ from functools import partial
 from kivy.animation import Animation
 from kivy.app import App
 from kivy.clock import Clock
-from kivy.graphics import Color, Ellipse, Rectangle
+from kivy.graphics import Color, Ellipse, InstructionGroup, Rectangle
 from kivy.uix.button import Button
 from kivy.uix.floatlayout import FloatLayout
-from kivy.uix.image import Image
 from kivy.uix.label import Label
 
-from mission import MissionModel, MissionController, MissionView
+from mission import MissionModel, MissionController, MissionView, read_campaign
 from entity import Entity, FoxCollisionResolver, GooseCollisionResolver
+from entity_renderer import EntityAnimationDriver, EntitySpriteRenderer
 import ai_controllers
-
-mission_yaml_file = """
-campaign:
-  mission ids:
-    - mission 1
-missions:
-  mission 1:
-    map height: 4
-    map width: 5
-    fox:
-      position:
-        x: 2
-        y: 0
-    geese:
-      -
-        position:
-          x: 1
-          y: 0
-      -
-        position:
-          x: 3
-          y: 0
-      -
-        position:
-          x: 2
-          y: 1
-"""
+from opening_book import load_campaign_book
 
 class TitleScreen(FloatLayout):
     def on_release_go_to_mission(self):
@@ -116,15 +90,24 @@ class KivyMissionView(FloatLayout):
         self.image_info_by_id['goose'] = {
             'resource': 'g_icon.png'
         }
+        self.sprite_renderer = EntitySpriteRenderer(
+            self.canvas,
+            dict([(image_id, self.image_info_by_id[image_id]['resource']) for image_id in self.image_info_by_id])
+        )
         self.sprite_info_by_id = {}
         self.started_moving_sprites = False
 
+        # The background and grid are built once and resized in place.
+        self.grid_instructions = None
+
     def setup_mission(self):
         """Creates the underlying MissionView.
         """
         # Make a mission model.
+        yaml_document = read_campaign()
         self.mission_model = MissionModel()
-        self.mission_model.load_mission("mission 1", mission_yaml_file)
+        self.mission_model.load_mission("mission 1", yaml_document)
+        self.mission_model.opening_book = load_campaign_book(yaml_document=yaml_document)
 
         # Make a new mission controller
         self.mission_controller = MissionController(mission_model = self.mission_model)
@@ -169,19 +152,16 @@ class KivyMissionView(FloatLayout):
         self.redraw()
 
     def redraw(self):
-        """Clear and redraw the canvas.
+        """Resize the background and grid and reposition the sprites.
         """
-        # Clear the canvas.
-        with self.canvas:
-            Color(self.background_color[0], self.background_color[1], self.background_color[2], mode='hsv')
-            Rectangle(
-                pos=(0,0),
-                size=(self.window_width, self.bar_height)
-            )
+        # Build the background and grid the first time (or if the map changed size), then update them in place.
+        if self.grid_instructions is None \
+            or self.grid_size != (self.mission_model.grid_width, self.mission_model.grid_height):
+            self.build_grid(self.mission_model)
 
-        self.draw_grid(self.mission_model)
+        self.layout_grid(self.mission_model)
 
-        # Draw each entity onto the grid.
+        # Move each entity to its place on the grid.
         for entity_id in self.mission_model.all_entities_by_id:
             self.draw_entity(entity_id)
 
@@ -192,11 +172,8 @@ class KivyMissionView(FloatLayout):
         """Updates the mission view so we know what to do next.
         """
 
-        # Tell the mission view to update. The mission_view may call functions in this class.
-        self.mission_view.update()
-
-        # Get the status from the mission view.
-        mission_view_status = self.mission_view.get_status()
+        # Tell the mission view to advance until it waits for an animation or player input. The mission_view may call functions in this class.
+        self.mission_view.advance()
 
     def draw_entity(self, entity_id):
         """ Draw the entity's icon on top of the grid.
@@ -211,22 +188,13 @@ class KivyMissionView(FloatLayout):
             )
             # Figure out the size the image should be.
             image_size = self.get_grid_cell_size(self.mission_model)
-            # If the image doesn't exist, create it
+            # If the sprite doesn't exist, take one from the renderer
             if not (entity_id in self.sprite_info_by_id and self.sprite_info_by_id[entity_id]):
-                new_image = Image(
-	            source = self.image_info_by_id[entity.resource_id]['resource'],
-	            pos = image_position,
-                    size_hint_x = None,
-                    size_hint_y = None,
-                    size = image_size,
-                    allow_stretch = True
-                )
-                self.add_widget(new_image)
-                self.sprite_info_by_id[entity_id] = new_image
-            else:
-                # Otherwise, move the image to its destination
-                self.sprite_info_by_id[entity_id].pos = image_position
-                self.sprite_info_by_id[entity_id].size = image_size
+                self.sprite_info_by_id[entity_id] = self.sprite_renderer.get_sprite(entity.resource_id)
+
+            # Move the sprite to its destination
+            self.sprite_info_by_id[entity_id].pos = image_position
+            self.sprite_info_by_id[entity_id].size = image_size
 
     def on_release_return_to_title(self):
         """Time to return to the title screen.
@@ -248,32 +216,63 @@ class KivyMissionView(FloatLayout):
             return 7
         return 10
 
-    def draw_grid(self, mission_model):
+    def build_grid(self, mission_model):
+        """Create the background and grid line instructions. Use layout_grid to place them.
+        """
         grid_width = mission_model.grid_width
         grid_height = mission_model.grid_height
-        line_thickness = self.get_grid_line_thickness(grid_width, grid_height)
+
+        # Remove the old grid if the map changed.
+        if self.grid_instructions is not None:
+            self.canvas.remove(self.grid_instructions)
+
+        # Keep the grid underneath the entity sprites.
+        grid_index = self.canvas.indexof(self.sprite_renderer.instructions)
+
+        self.grid_instructions = InstructionGroup()
+        self.grid_size = (grid_width, grid_height)
+
+        # Draw the background.
+        self.grid_instructions.add(
+            Color(self.background_color[0], self.background_color[1], self.background_color[2], mode='hsv')
+        )
+        self.grid_background = Rectangle()
+        self.grid_instructions.add(self.grid_background)
 
         # Draw the grid.
-        with self.canvas:
-            Color(0.0, 0.0, 0.2, mode='hsv')
-
-            # Draw vertical lines of the grid.
-            for i in xrange(grid_width+1):
-                x = (self.window_width * i / (grid_width * 1.0)) - (line_thickness/2)
-                y = 0
-                Rectangle(
-                    pos=(x, y),
-                    size=(line_thickness, self.height)
-                )
-
-            # Draw horizontal lines of the grid.
-            for i in xrange(grid_height+1):
-                x = 0
-                y = (self.bar_height * i / (grid_height * 1.0)) - (line_thickness/2)
-                Rectangle(
-                    pos=(x, y),
-                    size=(self.window_width, line_thickness)
-                )
+        self.grid_instructions.add(Color(0.0, 0.0, 0.2, mode='hsv'))
+
+        # One line on each side of every column and row.
+        self.grid_vertical_lines = [Rectangle() for i in xrange(grid_width+1)]
+        self.grid_horizontal_lines = [Rectangle() for i in xrange(grid_height+1)]
+        for line in self.grid_vertical_lines + self.grid_horizontal_lines:
+            self.grid_instructions.add(line)
+
+        self.canvas.insert(grid_index, self.grid_instructions)
+
+    def layout_grid(self, mission_model):
+        """Move and resize the background and grid lines to fit the window.
+        """
+        grid_width = mission_model.grid_width
+        grid_height = mission_model.grid_height
+        line_thickness = self.get_grid_line_thickness(grid_width, grid_height)
+
+        self.grid_background.pos = (0,0)
+        self.grid_background.size = (self.window_width, self.bar_height)
+
+        # Place vertical lines of the grid.
+        for i, line in enumerate(self.grid_vertical_lines):
+            x = (self.window_width * i / (grid_width * 1.0)) - (line_thickness/2)
+            y = 0
+            line.pos = (x, y)
+            line.size = (line_thickness, self.height)
+
+        # Place horizontal lines of the grid.
+        for i, line in enumerate(self.grid_horizontal_lines):
+            x = 0
+            y = (self.bar_height * i / (grid_height * 1.0)) - (line_thickness/2)
+            line.pos = (x, y)
+            line.size = (self.window_width, line_thickness)
 
     def get_grid_cell_size(self, mission_model):
         # Returns the size of each cell on the grid.
@@ -304,47 +303,32 @@ class KivyMissionView(FloatLayout):
         self.add_widget(self.mission_start_widget)
         mission_start_widget = self.mission_start_widget
 
-        # Center the Mission Start widget on the page.
-        # Setup Animation object
-        scroll_animation = Animation(x=0, y=0)
+        # Center the Mission Start widget on the page, then hold it there for a second.
+        scroll_animation = Animation(x=0, y=0) + Animation(duration=1.0)
+
+        # Announce when it's done.
+        scroll_animation.bind(on_complete=self.draw_mission_start_callback)
+
         # Use it on widget
         scroll_animation.start(mission_start_widget)
 
         # Set the mission view to in progress.
         self.mission_view.mission_start_status = "in progress"
 
-        # Make a callback to announce that it's done.
-        Clock.schedule_once(
-            partial(
-                KivyMissionView.draw_mission_start_callback,
-                self
-            ),
-            2.0
-        )
-
     def make_mission_start_widget(self):
         """Creates a Widget to show the mission start.
         """
         return Label(text='Hello world')
 
-    def draw_mission_start_callback(self, dt):
+    def draw_mission_start_callback(self, *args):
         """Call back function when the mission start banner has finished.
         """
 
-        # Declare the mission view's mission start status complete.
-        self.mission_view.mission_start_status = "complete"
-
         # Remove the mission start banner.
         self.remove_widget(self.mission_start_widget)
 
-        # Tell the layout to update.
-        Clock.schedule_once(
-            partial(
-                KivyMissionView.update_mission_view,
-                self
-            ),
-            0.5
-        )
+        # Declare the mission view's mission start status complete. It will wait for player input.
+        self.mission_view.finish_mission_start()
 
     def accept_player_input(self, player_input):
         """Callback to accept player input. player_input is a string indicating which direction the player wants to move in.
@@ -355,28 +339,8 @@ class KivyMissionView(FloatLayout):
         if not status["waiting for player input"]:
             return
 
-        # Pass in the input using mission_view.apply_player_input()
-        self.mission_view.apply_player_input(player_input)
-
-        # Tell the mission_view to update
-
-        # Update once to apply input and figure out how the units moved.
-        Clock.schedule_once(
-            partial(
-                KivyMissionView.update_mission_view,
-                self
-            ),
-            0.2
-        )
-
-        # Now actually move the units.
-        Clock.schedule_once(
-            partial(
-                KivyMissionView.update_mission_view,
-                self
-            ),
-            0.2
-        )
+        # Pass in the input. The mission view applies it, figures out how the units moved and starts moving them.
+        self.mission_view.submit_player_input(player_input)
 
     def move_entities_impl(self):
         """Animate the entities moving across the map.
@@ -389,51 +353,29 @@ class KivyMissionView(FloatLayout):
         # Get the mission_view status.
         status = self.mission_view.get_status()
 
-        # Read which units moved, and where.
-        max_animation_time = 2.0
+        # Read which units moved, and where. One driver animates all of them, a cell per second.
+        cell_size = (
+            self.window_width / (self.mission_model.grid_width * 1.0),
+            self.bar_height / (self.mission_model.grid_height * 1.0),
+        )
+        entity_animation = EntityAnimationDriver(cell_size=cell_size)
         for entity_id in status["entity moves"]:
-            entity_animation = None
-
-            # Start moving them.
-            the_sprite = self.sprite_info_by_id[entity_id]
-
             final_position = self.get_screen_coordinates_from_grid(
                 self.mission_model,
                 status["entity moves"][entity_id]['x'],
                 status["entity moves"][entity_id]['y'],
             )
 
-            # Scroll the unit moving over
-            scroll_animation = Animation(
-                x=final_position[0],
-                y=final_position[1]
+            # Scroll the unit moving over. If any units died, fade them out.
+            entity_animation.add_sprite(
+                self.sprite_info_by_id[entity_id],
+                final_position,
+                fade_out=status["entity moves"][entity_id]['is dead']
             )
-            # Use it on widget
-            if entity_animation == None:
-                entity_animation = scroll_animation
-            else:
-                entity_animation += scroll_animation
-
-            # If any units died, fade them out.
-            if status["entity moves"][entity_id]['is dead']:
-                fade_animation = Animation(size=(0,0), t='in_quad')
-                if entity_animation == None:
-                    entity_animation = fade_animation
-                else:
-                    entity_animation += fade_animation
-
-            entity_animation.start(the_sprite)
-
-        # Make a callback when the units finished moving.
-        self.started_moving_sprites = True
 
-        Clock.schedule_once(
-            partial(
-                KivyMissionView.move_entities_finished_callback,
-                self
-            ),
-            max_animation_time
-        )
+        # Make a callback when the last unit finished moving.
+        self.started_moving_sprites = True
+        entity_animation.start(on_complete=self.move_entities_finished_callback)
 
     def move_entities_finished_callback(self, dt=0.0):
         """Call back function when the entities have finished moving.
@@ -444,48 +386,22 @@ class KivyMissionView(FloatLayout):
             print "Sprites haven't finished moving. Why was this called?"
             return
 
-        # Tell the mission view we finished moving.
-        self.mission_view.finished_moving_entities = True
+        self.started_moving_sprites = False
 
-        # Set up a callback to update the status.
-        Clock.schedule_once(
-            partial(
-                KivyMissionView.update_mission_view,
-                self
-            ),
-            0.1
-        )
+        # Tell the mission view we finished moving. It will start a new round or show the mission complete message.
+        self.mission_view.finish_moving_entities()
 
-        # Set up another callback to see if the round should be reset.
-        Clock.schedule_once(
-            partial(
-                KivyMissionView.reset_for_new_round,
-                self
-            ),
-            0.2
-        )
+        # Delete any sprites that correspond to non existent units.
+        self.remove_deleted_sprites()
 
-    def reset_for_new_round(self, dt=0.0):
-        """Reset the mission view for a new round if the mission is not yet complete.
+    def remove_deleted_sprites(self):
+        """Remove the sprites of units that were deleted at the end of the round.
         """
-
-        # If the mission is complete, return
-        mission_view_status = self.mission_view.get_status()
-        if mission_view_status["mission complete message id"]:
-            return
-
-        # If the mission isn't complete, call mission_view.reset_for_new_round() and wait for more player input.
-        status = self.mission_view.get_status()
-
-        self.mission_view.reset_for_new_round()
-        self.started_moving_sprites = False
-
-        # Delete any sprites that correspond to non existent units.
         sprites_to_delete = [id for id in self.sprite_info_by_id if not id in self.mission_model.all_entities_by_id]
 
         for sprite_id in sprites_to_delete:
-            sprite_to_delete = self.sprite_info_by_id[sprite_id]
-            self.remove_widget(sprite_to_delete)
+            # Hide the sprite so it can be reused.
+            self.sprite_renderer.release_sprite(self.sprite_info_by_id[sprite_id])
             del self.sprite_info_by_id[sprite_id]
 
     def animate_mission_complete_impl(self):
@@ -509,28 +425,22 @@ class KivyMissionView(FloatLayout):
         self.add_widget(self.mission_complete_widget)
         mission_complete_widget = self.mission_complete_widget
 
-        # Move the mission complete message to its proper location.
-        scroll_animation = Animation(x=0, y=0)
+        # Move the mission complete message to its proper location, then hold it there for a second.
+        scroll_animation = Animation(x=0, y=0) + Animation(duration=1.0)
+
+        # Finish the animation when it's done.
+        scroll_animation.bind(on_complete=self.animate_mission_complete_finished_callback)
         scroll_animation.start(mission_complete_widget)
 
         # Tell the mission view the banner is now in progress.
         self.mission_view.mission_complete_display_progress = "in progress"
 
-        # Set up a callback to finish the animation.
-        Clock.schedule_once(
-            partial(
-                KivyMissionView.animate_mission_complete_finished_callback,
-                self
-            ),
-            2.0
-        )
-
     def make_mission_complete_widget(self, message):
         """Creates a Widget to show the mission start.
         """
         return Label(text=message)
 
-    def animate_mission_complete_finished_callback(self, dt=0.0):
+    def animate_mission_complete_finished_callback(self, *args):
         """Callback when the Mission Complete banner finishes.
         """
         # If the banner is complete, return (and print an error message)
@@ -539,17 +449,10 @@ class KivyMissionView(FloatLayout):
             print "We played the mission complete finished callback. Why?"
             return
 
-        self.mission_view.mission_complete_display_progress = "complete"
         self.remove_widget(self.mission_complete_widget)
 
-        # Update the mission view.
-        Clock.schedule_once(
-            partial(
-                KivyMissionView.update_mission_view,
-                self
-            ),
-            0.1
-        )
+        # Tell the mission view the banner is complete.
+        self.mission_view.finish_mission_complete()
 
 class FoxAndGeeseApp(App):
     def build(self):
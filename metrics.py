@@ -0,0 +1,267 @@
+"""Throughput and latency metrics for headless simulation workers.
+
+Each worker process keeps a SimulationMetrics and watches its MissionControllers.
+Workers write snapshots to a shared directory with MetricsFileWriter, and a scraper reads them as Prometheus text:
+
+    python metrics.py --directory /tmp/fox_and_geese_metrics --port 9100
+    curl http://127.0.0.1:9100/metrics
+
+Everything runs locally. Nothing is sent anywhere unless you scrape it.
+"""
+import BaseHTTPServer
+import argparse
+import glob
+import json
+import os
+import sys
+import threading
+import time
+
+from profiling import TurnProfiler, TURN_PHASES
+
+MISSION_RESULTS = ['player win', 'player lose', 'not finished']
+"""The results a game can end with. See MissionModel.get_mission_status"""
+
+REPORTED_QUANTILES = [0.5, 0.9, 0.99]
+
+class SimulationMetrics(object):
+    """Counts turns, games, AI nodes and results for one process, and keeps recent phase latencies.
+    """
+    def __init__(self, history_length=1000, clock=time.time):
+        self.clock = clock
+        self.start_time = clock()
+
+        self.turns = 0
+        self.games = 0
+        self.ai_nodes = 0
+        self.games_by_result = dict([(result, 0) for result in MISSION_RESULTS])
+
+        # Totals of every phase sample since the start, not just the recent ones, for the summaries' _sum and _count.
+        self.phase_seconds = dict([(phase, 0.0) for phase in TURN_PHASES + ['turn']])
+        self.phase_counts = dict([(phase, 0) for phase in TURN_PHASES + ['turn']])
+
+        # Phase latencies come from a TurnProfiler shared by every watched controller.
+        self.turn_profiler = TurnProfiler(history_length=history_length)
+        self.turn_profiler.record_listeners.append(self.record_turn)
+
+    def watch(self, mission_controller):
+        """Count every turn the mission controller plays.
+        """
+        mission_controller.turn_profiler = self.turn_profiler
+        mission_controller.add_turn_listener(
+            lambda turn_delta: self.record_ai_nodes(mission_controller.mission_model)
+        )
+
+    def record_turn(self, turn_record):
+        """Count a turn. Called with each TurnProfiler record.
+        """
+        self.turns += 1
+        phase_seconds = dict(turn_record['phases'])
+        phase_seconds['turn'] = turn_record['seconds']
+        for phase in phase_seconds:
+            self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + phase_seconds[phase]
+            self.phase_counts[phase] = self.phase_counts.get(phase, 0) + 1
+
+    def record_ai_nodes(self, mission_model):
+        """Count the positions the mission's AI controllers examined.
+        """
+        for ai_controller in mission_model.all_ai_by_id.values():
+            self.ai_nodes += ai_controller.collect_nodes_evaluated()
+
+    def record_game(self, result):
+        """Count a finished game. result is one of MISSION_RESULTS.
+        """
+        self.games += 1
+        self.games_by_result[result] = self.games_by_result.get(result, 0) + 1
+
+    def snapshot(self):
+        """Returns the metrics as a dictionary that can be saved as JSON or merged with other snapshots.
+        """
+        return {
+            'processes': 1,
+            'elapsed seconds': self.clock() - self.start_time,
+            'turns': self.turns,
+            'games': self.games,
+            'ai nodes': self.ai_nodes,
+            'games by result': dict(self.games_by_result),
+            'phase samples': dict([
+                (phase, list(self.turn_profiler.samples_by_phase[phase]))
+                for phase in self.turn_profiler.samples_by_phase
+            ]),
+            'phase seconds': dict(self.phase_seconds),
+            'phase counts': dict(self.phase_counts),
+        }
+
+def merge_snapshots(snapshots):
+    """Combine the snapshots of several processes into one.
+    The processes run side by side, so the elapsed time is the longest one and the counts add up.
+    """
+    merged = {
+        'processes': 0,
+        'elapsed seconds': 0.0,
+        'turns': 0,
+        'games': 0,
+        'ai nodes': 0,
+        'games by result': dict([(result, 0) for result in MISSION_RESULTS]),
+        'phase samples': dict([(phase, []) for phase in TURN_PHASES + ['turn']]),
+        'phase seconds': dict([(phase, 0.0) for phase in TURN_PHASES + ['turn']]),
+        'phase counts': dict([(phase, 0) for phase in TURN_PHASES + ['turn']]),
+    }
+    for snapshot in snapshots:
+        merged['processes'] += snapshot['processes']
+        merged['elapsed seconds'] = max(merged['elapsed seconds'], snapshot['elapsed seconds'])
+        merged['turns'] += snapshot['turns']
+        merged['games'] += snapshot['games']
+        merged['ai nodes'] += snapshot['ai nodes']
+        for result in snapshot['games by result']:
+            merged['games by result'][result] = merged['games by result'].get(result, 0) + snapshot['games by result'][result]
+        for phase in snapshot['phase samples']:
+            merged['phase samples'].setdefault(phase, []).extend(snapshot['phase samples'][phase])
+        for phase in snapshot['phase seconds']:
+            merged['phase seconds'][phase] = merged['phase seconds'].get(phase, 0.0) + snapshot['phase seconds'][phase]
+            merged['phase counts'][phase] = merged['phase counts'].get(phase, 0) + snapshot['phase counts'][phase]
+    return merged
+
+def _quantile(sorted_samples, quantile):
+    if not sorted_samples:
+        return float('nan')
+    return sorted_samples[int(round((len(sorted_samples) - 1) * quantile))]
+
+def _rate(count, seconds):
+    if seconds <= 0:
+        return 0.0
+    return count / float(seconds)
+
+def render_prometheus(snapshot, prefix='fox_and_geese'):
+    """Returns the snapshot in the Prometheus text exposition format.
+    """
+    elapsed_seconds = snapshot['elapsed seconds']
+    lines = []
+
+    def add_metric(name, metric_type, help_text, samples):
+        # samples is a list of (labels string, value). A labels string may start with a suffix for the name, like _sum.
+        lines.append("# HELP %s_%s %s" % (prefix, name, help_text))
+        lines.append("# TYPE %s_%s %s" % (prefix, name, metric_type))
+        for labels, value in samples:
+            lines.append("%s_%s%s %r" % (prefix, name, labels, float(value)))
+
+    add_metric('processes', 'gauge', "Worker processes reporting.", [("", snapshot['processes'])])
+    add_metric('turns_total', 'counter', "Turns played.", [("", snapshot['turns'])])
+    add_metric('games_total', 'counter', "Games finished, by result.", [
+        ('{result="%s"}' % result, snapshot['games by result'][result])
+        for result in sorted(snapshot['games by result'])
+    ])
+    add_metric('ai_nodes_total', 'counter', "Positions examined by the AI.", [("", snapshot['ai nodes'])])
+    add_metric('turns_per_second', 'gauge', "Turns played per second.", [("", _rate(snapshot['turns'], elapsed_seconds))])
+    add_metric('games_per_second', 'gauge', "Games finished per second.", [("", _rate(snapshot['games'], elapsed_seconds))])
+    add_metric('ai_nodes_per_second', 'gauge', "Positions examined by the AI per second.", [("", _rate(snapshot['ai nodes'], elapsed_seconds))])
+
+    # The fox is the player, so a player win is a fox win.
+    decided_games = snapshot['games by result'].get('player win', 0) + snapshot['games by result'].get('player lose', 0)
+    win_ratio = 0.0
+    if decided_games:
+        win_ratio = snapshot['games by result'].get('player win', 0) / float(decided_games)
+    add_metric('fox_win_ratio', 'gauge', "Fraction of decided games the fox won.", [("", win_ratio)])
+
+    phase_samples = []
+    for phase in sorted(snapshot['phase samples']):
+        samples = sorted(snapshot['phase samples'][phase])
+        for quantile in REPORTED_QUANTILES:
+            phase_samples.append(('{phase="%s",quantile="%s"}' % (phase, quantile), _quantile(samples, quantile)))
+        phase_samples.append(('_sum{phase="%s"}' % phase, snapshot['phase seconds'].get(phase, 0.0)))
+        phase_samples.append(('_count{phase="%s"}' % phase, snapshot['phase counts'].get(phase, 0)))
+    add_metric('turn_phase_seconds', 'summary', "Turn phase latencies. The quantiles are of recent turns, the sum and count of every turn.", phase_samples)
+
+    return "\n".join(lines) + "\n"
+
+class MetricsFileWriter(object):
+    """Writes a process's metrics snapshot to a directory at most once per interval.
+    Call maybe_write() from the simulation loop.
+    """
+    def __init__(self, metrics, directory, interval_seconds=5.0):
+        self.metrics = metrics
+        self.interval_seconds = interval_seconds
+        self.path = os.path.join(directory, "worker-%d.json" % os.getpid())
+        self.last_write_time = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def maybe_write(self):
+        """Write the snapshot if the interval has passed. Returns True if it wrote.
+        """
+        now = time.time()
+        if self.last_write_time is not None and now - self.last_write_time < self.interval_seconds:
+            return False
+        self.write()
+        return True
+
+    def write(self):
+        """Write the snapshot now. Readers never see a half written file.
+        """
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, 'w') as snapshot_file:
+            json.dump(self.metrics.snapshot(), snapshot_file)
+        os.rename(temporary_path, self.path)
+        self.last_write_time = time.time()
+
+def read_metrics_directory(directory):
+    """Returns the merged snapshot of every worker that wrote to the directory.
+    """
+    snapshots = []
+    for path in sorted(glob.glob(os.path.join(directory, "worker-*.json"))):
+        with open(path) as snapshot_file:
+            snapshots.append(json.load(snapshot_file))
+    return merge_snapshots(snapshots)
+
+class _MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus(self.server.get_snapshot())
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent. Do not log them.
+        pass
+
+def start_metrics_server(get_snapshot, host='127.0.0.1', port=0):
+    """Serve get_snapshot() as Prometheus text at http://host:port/metrics from a background thread.
+    Port 0 picks a free port. Returns the server. Its address is server.server_address. Stop it with server.shutdown().
+    """
+    server = BaseHTTPServer.HTTPServer((host, port), _MetricsRequestHandler)
+    server.get_snapshot = get_snapshot
+
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the merged metrics of the simulation workers writing to a directory.")
+    parser.add_argument('--directory', required=True, help="The directory the workers write their metrics to.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--once', action='store_true', help="Print the metrics once instead of serving them.")
+    args = parser.parse_args(argv)
+
+    if args.once:
+        sys.stdout.write(render_prometheus(read_metrics_directory(args.directory)))
+        return 0
+
+    server = start_metrics_server(lambda: read_metrics_directory(args.directory), args.host, args.port)
+    print "Serving metrics at http://%s:%d/metrics" % server.server_address
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
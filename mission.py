@@ -4,12 +4,44 @@ class_data = open('classData.yaml')
 classes_yaml = yaml.load(class_data)
 
 """
+import multiprocessing
+import os
 import random
+import timeit
 
 import yaml
 
 import ai_controllers
-from entity import Entity, FoxCollisionResolver, GooseCollisionResolver
+from entity import Entity, EntityRegistry, FoxCollisionResolver, GooseCollisionResolver, FOX, GOOSE
+from shared_board import SharedBoard
+from symmetry import BoardSymmetry
+from terrain import TerrainGrid, PathfindingService
+
+DEFAULT_CAMPAIGN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'campaign.yaml')
+
+def read_campaign(campaign_file=DEFAULT_CAMPAIGN_FILE):
+    """Returns the yaml document describing the campaign and its missions.
+    """
+    with open(campaign_file) as campaign:
+        return campaign.read()
+
+def get_campaign_mission_ids(yaml_document):
+    """Returns the mission ids of the campaign, in order.
+    """
+    return yaml.load(yaml_document)['campaign']['mission ids']
+
+STEPS_BY_DIRECTION_CODE = {
+    'UL': (-1, 1),
+    'U': (None, 1),
+    'UR': (1, 1),
+    'L': (-1, None),
+    'W': (0, 0),
+    'R': (1, None),
+    'DL': (-1, -1),
+    'D': (None, -1),
+    'DR': (1, -1),
+}
+"""How far each direction code moves an Entity in x and y. None leaves that axis alone."""
 
 class MissionModel:
     # Information needed to track the status of a mission.
@@ -18,24 +50,66 @@ class MissionModel:
         self.grid_width = width
         self.grid_height = height
 
+        self.ai_time_budget_seconds = None
+        """If set, every AI controller gets this many seconds per turn to decide. Late AIs get their fallback moves."""
+
+        self.ai_executor = None
+        """If set, a multiprocessing.Pool or ThreadPool. AI controllers that support decision snapshots decide there in parallel."""
+
+        self.shared_board = None
+        """If set, a shared_board.SharedBoard published before the ai_executor decides, so snapshots can refer to it. See share_board."""
+
+        self.random = random.Random()
+        """Random choices the mission makes, like which goose advances. Its state is saved with the mission. See mission_state."""
+
+        self.opening_book = None
+        """If set, an opening_book.OpeningBook. AI controllers it has moves for use them instead of deciding."""
+
     def reset(self):
         """Reset all variables.
         """
+        # The shared board indexes the old registry's slots.
+        self.close_shared_board()
+        self.stop_decision_workers()
+
         self.fox_entity = None
 
-        self.all_entities_by_id = {}
+        self.mission_id = None
+        """The campaign mission id load_mission loaded, or None."""
+
+        self.all_entities_by_id = EntityRegistry()
+        """Counts living and dead Entities by type as they change. See EntityRegistry."""
 
         self.collisions = []
         """Stores all collisions calculated."""
 
+        self.retreat_count = 0
+        """How many Entities retreated the last time collisions were resolved."""
+
         self.all_ai_by_id = {}
         """All of the entity AI. Note these ids are different from the entity_id."""
 
+        self.terrain = None
+        """A terrain.TerrainGrid, or None if every cell is open."""
+
+        self.pathfinding = None
+        """A terrain.PathfindingService the AI controllers share, or None without terrain."""
+
+        self.timed_out_ai_ids = []
+        """The ids of the AI controllers that ran out of time on the last turn."""
+
+        self._symmetry = None
+
+        self._decision_workers_by_ai_id = {}
+        self._deciding_ai_ids = []
+        self._decision_deadline = None
+
     def load_mission(self, mission_id, yaml_document):
         """Populate the mission model based on the mission_id and the provided yaml_document.
         """
         # Clear all fields that maintain state.
         self.reset()
+        self.mission_id = mission_id
 
         # Find the mission yaml located in the document.
         yaml_object = yaml.load(yaml_document)
@@ -45,13 +119,17 @@ class MissionModel:
         self.grid_height = mission_data['map height']
         self.grid_width = mission_data['map width']
 
+        # Add the terrain, if any.
+        if 'terrain' in mission_data:
+            self.set_terrain(TerrainGrid.from_rows(mission_data['terrain']['rows'], self.grid_width, self.grid_height))
+
         # Find the Fox's starting position.
         fox_data = mission_data['fox']
         fox_position_x = fox_data['position']['x']
         fox_position_y = fox_data['position']['y']
 
         # Add a Fox.
-        fox_entity = Entity(position={'x':2, 'y':0}, entity_type='fox')
+        fox_entity = Entity(position={'x':fox_position_x, 'y':fox_position_y}, entity_type='fox')
         fox_entity.collision_behavior = FoxCollisionResolver(fox_entity)
         self.all_entities_by_id['fox'] = fox_entity
         self.all_entities_by_id['fox'].resource_id = 'fox'
@@ -64,7 +142,7 @@ class MissionModel:
         goose_ids = []
 
         for goose_data in all_goose_data:
-            goose_id = "goose_%03d" % len(goose_ids)
+            goose_id = "goose_%d" % len(goose_ids)
             goose_ids.append(goose_id)
 
             # Get their starting positions.
@@ -80,11 +158,46 @@ class MissionModel:
         # Give them AI controllers.
         self.all_ai_by_id['goose'] = ai_controllers.ChaseTheFox(self, goose_ids)
 
+    def set_terrain(self, terrain_grid):
+        """Use the terrain.TerrainGrid for this map. Entities cannot move into its impassable cells.
+        """
+        self.terrain = terrain_grid
+        self.pathfinding = PathfindingService(terrain_grid)
+        self._symmetry = None
+
+    def get_symmetry(self):
+        """Returns the symmetry.BoardSymmetry of the map and its terrain. Built once, until the map changes.
+        """
+        symmetry = self._symmetry
+        if symmetry is None or symmetry.width != self.grid_width or symmetry.height != self.grid_height:
+            symmetry = BoardSymmetry(self.grid_width, self.grid_height, self.terrain)
+            self._symmetry = symmetry
+        return symmetry
+
+    def share_board(self, capacity=None):
+        """Keep a copy of the board in shared memory for the ai_executor's worker processes to read.
+        capacity: The registry slots the board holds at first. Defaults to twice the Entities there are now. It grows as needed.
+        Returns the shared_board.SharedBoard. It is closed by close_shared_board, reset, load_mission, or at exit.
+        """
+        self.close_shared_board()
+        if capacity is None:
+            capacity = max(1, 2 * len(self.all_entities_by_id.entities_by_slot))
+        self.shared_board = SharedBoard(capacity)
+        return self.shared_board
+
+    def close_shared_board(self):
+        """Close the shared board, if there is one, and remove its file.
+        """
+        shared_board = getattr(self, 'shared_board', None)
+        if shared_board is not None:
+            shared_board.close()
+        self.shared_board = None
+
     def delete_dead_entities(self):
         """Look at all entities and remove the dead ones.
         Return a list of the deleted entites
         """
-        dead_entities = [e for e in self.all_entities_by_id if self.all_entities_by_id[e].is_dead]
+        dead_entities = list(self.all_entities_by_id.dead_entity_ids)
 
         # Tell the ai_controllers to delete their entities.
         for ai in self.all_ai_by_id:
@@ -98,70 +211,166 @@ class MissionModel:
     def try_to_move_entity(self, id, direction):
         # Set up a pending move for the given Entity.
         # Does not actually move all units until you call move_all_units()
-        entity_to_move = self.all_entities_by_id[id]
-        direction_code = direction.upper()
-        code_valid = False
-
-        # Move left if possible.
-        if direction_code in ['UL', 'L', 'DL']:
-            entity_to_move.pending_position_x = entity_to_move.position_x - 1
-            code_valid = True
-
-        # Move right if possible.
-        if direction_code in ['UR', 'R', 'DR']:
-            entity_to_move.pending_position_x = entity_to_move.position_x + 1
-            code_valid = True
-
-        # Move up if possible.
-        if direction_code in ['UL', 'U', 'UR']:
-            entity_to_move.pending_position_y = entity_to_move.position_y + 1
-            code_valid = True
-
-        # Move down if possible.
-        if direction_code in ['DL', 'D', 'DR']:
-            entity_to_move.pending_position_y = entity_to_move.position_y - 1
-            code_valid = True
-
-        # If the unit wants to wait, do not move.
-        if direction_code == 'W':
-            entity_to_move.pending_position_x = entity_to_move.position_x
-            entity_to_move.pending_position_y = entity_to_move.position_y
-            code_valid = True
-
-        # If you recieved a valid movement direction, make sure each pending direction is set.
-        if code_valid:
-            if entity_to_move.pending_position_x == None:
-                entity_to_move.pending_position_x = entity_to_move.position_x
-            if entity_to_move.pending_position_y == None:
-                entity_to_move.pending_position_y = entity_to_move.position_y
+        step = STEPS_BY_DIRECTION_CODE.get(direction.upper())
+
+        # Ignore invalid movement directions.
+        if step is None:
+            return
+
+        registry = self.all_entities_by_id
+        slot = registry[id].slot
+        step_x, step_y = step
+
+        # Move left or right, and up or down if possible. Make sure each pending direction is set.
+        if step_x is not None:
+            registry.pending_positions_x[slot] = registry.positions_x[slot] + step_x
+        elif registry.pending_positions_x[slot] == None:
+            registry.pending_positions_x[slot] = registry.positions_x[slot]
+
+        if step_y is not None:
+            registry.pending_positions_y[slot] = registry.positions_y[slot] + step_y
+        elif registry.pending_positions_y[slot] == None:
+            registry.pending_positions_y[slot] = registry.positions_y[slot]
+
+        # A move that ends where the Entity stands is no move at all, so its chunk need not be visited next turn.
+        if self._stays_in_place(slot):
+            registry.set_pending_position(slot, None, None)
+        else:
+            registry.grid.mark_pending(slot, registry.positions_x[slot], registry.positions_y[slot])
+
+    def _stays_in_place(self, slot):
+        # True if the pending move of the Entity in the slot would leave it where it is, once move_all_entities clamps
+        # it to the map and keeps it out of walls and water.
+        registry = self.all_entities_by_id
+        position_x = registry.positions_x[slot]
+        position_y = registry.positions_y[slot]
+        pending_x = min(max(registry.pending_positions_x[slot], 0), self.grid_width - 1)
+        pending_y = min(max(registry.pending_positions_y[slot], 0), self.grid_height - 1)
+        if pending_x == position_x and pending_y == position_y:
+            return True
+        return self.terrain is not None and not self.terrain.passable[pending_y * self.grid_width + pending_x]
+
+    def try_to_move_entities(self, entity_ids, directions):
+        """try_to_move_entity for many Entities at once. entity_ids and directions are parallel lists.
+        """
+        get_slot = self.all_entities_by_id.get_slot
+        self.try_to_move_slots([get_slot(entity_id) for entity_id in entity_ids], directions)
+
+    def try_to_move_slots(self, slots, directions):
+        """try_to_move_entities for Entities given by their registry slots. slots and directions are parallel lists.
+        """
+        registry = self.all_entities_by_id
+        positions_x = registry.positions_x
+        positions_y = registry.positions_y
+        pending_positions_x = registry.pending_positions_x
+        pending_positions_y = registry.pending_positions_y
+        mark_pending = registry.grid.mark_pending
+        set_pending_position = registry.set_pending_position
+        stays_in_place = self._stays_in_place
+        get_step = STEPS_BY_DIRECTION_CODE.get
+
+        for slot, direction in zip(slots, directions):
+            step = get_step(direction) or get_step(direction.upper())
+            if step is None:
+                continue
+
+            step_x, step_y = step
+            if step_x is not None:
+                pending_positions_x[slot] = positions_x[slot] + step_x
+            elif pending_positions_x[slot] == None:
+                pending_positions_x[slot] = positions_x[slot]
+
+            if step_y is not None:
+                pending_positions_y[slot] = positions_y[slot] + step_y
+            elif pending_positions_y[slot] == None:
+                pending_positions_y[slot] = positions_y[slot]
+
+            if stays_in_place(slot):
+                set_pending_position(slot, None, None)
+            else:
+                mark_pending(slot, positions_x[slot], positions_y[slot])
+
+    def notify_entities_moved(self, moved_entities):
+        """Tell the ai_controllers these Entities changed position.
+        """
+        if not moved_entities:
+            return
+        for ai_controller in self.all_ai_by_id.values():
+            ai_controller.entities_moved(moved_entities)
 
     def move_all_entities(self):
         # All Entities with a pending move are moved.
-        for entity_id in self.all_entities_by_id:
-            entity = self.all_entities_by_id[entity_id]
-
-            # Push the previous position to the history
-            entity.position_history.append({'x': entity.position_x, 'y': entity.position_y})
+        # Works on the registry's component columns directly. See EntityRegistry.
+        # Only the chunks of the map with pending moves are visited. See ChunkedGrid.
+        registry = self.all_entities_by_id
+        positions_x = registry.positions_x
+        positions_y = registry.positions_y
+        pending_positions_x = registry.pending_positions_x
+        pending_positions_y = registry.pending_positions_y
+        position_histories = registry.position_histories
+        history_turn_counts = registry.history_turn_counts
+        get_position_history = registry.get_position_history
+        move_in_grid = registry.grid.move
+        moved_slots = registry.moved_slots
+        max_x = self.grid_width - 1
+        max_y = self.grid_height - 1
+        grid_width = self.grid_width
+        passable = None
+        if self.terrain is not None:
+            passable = self.terrain.passable
+
+        # A new turn starts. Every Entity's position goes in its history, but only the ones that move are touched.
+        registry.start_turn()
+        turn_count = registry.turn_count
+
+        moved_this_turn = []
+        for slot in registry.grid.pop_pending_slots():
+            previous_position_x = position_x = positions_x[slot]
+            previous_position_y = position_y = positions_y[slot]
 
             # If a pending position was set, move the Entity to the new location.
-            if entity.pending_position_x != None \
-                and entity.pending_position_y != None:
-                entity.position_x = entity.pending_position_x
-                entity.position_y = entity.pending_position_y
+            pending_position_x = pending_positions_x[slot]
+            pending_position_y = pending_positions_y[slot]
+            if pending_position_x != None \
+                and pending_position_y != None:
+                position_x = pending_position_x
+                position_y = pending_position_y
 
             # Ensure the Entity is on the map.
-            if entity.position_x < 0:
-                entity.position_x = 0
-            if entity.position_y < 0:
-                entity.position_y = 0
-            if entity.position_x >= self.grid_width:
-                entity.position_x = self.grid_width-1
-            if entity.position_y >= self.grid_height:
-                entity.position_y = self.grid_height-1
+            if position_x < 0:
+                position_x = 0
+            if position_y < 0:
+                position_y = 0
+            if position_x > max_x:
+                position_x = max_x
+            if position_y > max_y:
+                position_y = max_y
+
+            # Entities cannot move into walls and water.
+            if passable is not None and not passable[position_y * grid_width + position_x]:
+                position_x = previous_position_x
+                position_y = previous_position_y
 
             # Clear the pending position.
-            entity.pending_position_x = None
-            entity.pending_position_y = None
+            pending_positions_x[slot] = None
+            pending_positions_y[slot] = None
+
+            if position_x != previous_position_x or position_y != previous_position_y:
+                # Push the previous position to the history, with any turns it stood still before this one.
+                missing_turn_count = turn_count - history_turn_counts[slot]
+                if missing_turn_count == 1:
+                    position_histories[slot].append({'x': previous_position_x, 'y': previous_position_y})
+                    history_turn_counts[slot] = turn_count
+                elif missing_turn_count > 1:
+                    get_position_history(slot)
+                move_in_grid(slot, previous_position_x, previous_position_y, position_x, position_y)
+                positions_x[slot] = position_x
+                positions_y[slot] = position_y
+                moved_slots.add(slot)
+                moved_this_turn.append(slot)
+
+        entities_by_slot = registry.entities_by_slot
+        self.notify_entities_moved([entities_by_slot[slot] for slot in moved_this_turn])
 
     def find_collisions(self):
         # Looks at all objects (most are Entities) to find any that are at the same location.
@@ -169,67 +378,57 @@ class MissionModel:
         # 'colliding objects' : a tuple of colliding objects, usually an Entity
         # 'x': x coordinate of the collision
         # 'y': y coordinate of the collision
-
-        all_objects_by_x_y = {}
-
-        # Record each object's location in a dictionary
-        for entity_id in self.all_entities_by_id:
-            entity = self.all_entities_by_id[entity_id]
-            pos_x = entity.position_x
-            pos_y = entity.position_y
-
-            if not pos_x in all_objects_by_x_y:
-                all_objects_by_x_y[pos_x] = {}
-            if not pos_y in all_objects_by_x_y[pos_x]:
-                all_objects_by_x_y[pos_x][pos_y] = []
-            all_objects_by_x_y[pos_x][pos_y].append(entity)
-
-        # For each location, see if there are multiple entities on the same spot.
-        for pos_x in all_objects_by_x_y:
-            for pos_y in all_objects_by_x_y[pos_x]:
-                # If there are 2 or more items there
-                if len(all_objects_by_x_y[pos_x][pos_y]) >= 2:
-                    # Create a new collision
-                    new_collision = {
-                        'colliding objects':all_objects_by_x_y[pos_x][pos_y],
-                        'x':pos_x,
-                        'y':pos_y
-                    }
-                    # Add new collision to existing ones
-                    self.collisions.append(new_collision)
+        # Only the crowded cells and the Entities that moved this turn are looked at. See ChunkedGrid.
+        registry = self.all_entities_by_id
+        positions_x = registry.positions_x
+        positions_y = registry.positions_y
+        get_previous_position = registry.get_previous_position
+        entities_by_slot = registry.entities_by_slot
+
+        # For each location with multiple entities on the same spot, create a new collision
+        crowded_cells = registry.grid.get_crowded_cells()
+        for position, slots in crowded_cells:
+            new_collision = {
+                'colliding objects':[entities_by_slot[slot] for slot in slots],
+                'x':position[0],
+                'y':position[1]
+            }
+            # Add new collision to existing ones
+            self.collisions.append(new_collision)
 
         # For each entity, see if it switched positions with another entity.
-        for entity_a_id in self.all_entities_by_id:
-            for entity_b_id in self.all_entities_by_id:
+        # Only Entities that moved can switch. Entities waiting on a crowded cell match each other too.
+        candidate_slots = set(registry.moved_slots)
+        for position, slots in crowded_cells:
+            candidate_slots.update(slots)
+        candidate_slots = sorted(candidate_slots)
+
+        # Index every entity by where it was and where it is, then look up the entities that made the opposite move.
+        moves = []
+        slots_by_move = {}
+        for slot in candidate_slots:
+            move = get_previous_position(slot) + (positions_x[slot], positions_y[slot])
+            moves.append(move)
+            if move in slots_by_move:
+                slots_by_move[move].append(slot)
+            else:
+                slots_by_move[move] = [slot]
+
+        for slot_a, (a_previous_x, a_previous_y, a_pos_x, a_pos_y) in zip(candidate_slots, moves):
+            # If A's old pos is B's current pos and B's old pos is A's current pos, they switched.
+            opposite_move = (a_pos_x, a_pos_y, a_previous_x, a_previous_y)
+            for slot_b in slots_by_move.get(opposite_move, []):
                 # You can't cross yourself
-                if entity_a_id == entity_b_id:
+                if slot_a == slot_b:
                     continue
-                # Check the previous positions
-                a_pos_x = self.all_entities_by_id[entity_a_id].position_x
-                a_pos_y = self.all_entities_by_id[entity_a_id].position_y
-                a_previous_pos_x = self.all_entities_by_id[entity_a_id].position_history[-1]['x']
-                a_previous_pos_y = self.all_entities_by_id[entity_a_id].position_history[-1]['y']
-
-                b_pos_x = self.all_entities_by_id[entity_b_id].position_x
-                b_pos_y = self.all_entities_by_id[entity_b_id].position_y
-                b_previous_pos_x = self.all_entities_by_id[entity_b_id].position_history[-1]['x']
-                b_previous_pos_y = self.all_entities_by_id[entity_b_id].position_history[-1]['y']
-
-                # If A's old pos is B's current pos and B's old pos is A's current pos, they switched.
-                if (
-                        a_previous_pos_x == b_pos_x \
-                        and a_previous_pos_y == b_pos_y \
-                        and a_pos_x == b_previous_pos_x \
-                        and a_pos_y == b_previous_pos_y \
-                ):
-                    # Add this to the collisions.
-                    new_collision = {
-                        'colliding objects':[self.all_entities_by_id[entity_b_id], self.all_entities_by_id[entity_a_id]],
-                        'x':a_pos_x,
-                        'y':a_pos_y
-                    }
-                    # Add new collision to existing ones
-                    self.collisions.append(new_collision)
+                # Add this to the collisions.
+                new_collision = {
+                    'colliding objects':[entities_by_slot[slot_b], entities_by_slot[slot_a]],
+                    'x':a_pos_x,
+                    'y':a_pos_y
+                }
+                # Add new collision to existing ones
+                self.collisions.append(new_collision)
 
     def clear_collisions(self):
         # Clear the collision data.
@@ -237,22 +436,28 @@ class MissionModel:
 
     def resolve_collisions(self):
         # Based on self.collisions, each object that collided is asked to interact with the objects it collided with.
+        self.retreat_count = 0
 
+        # Resolutions are keyed by slot and visited in slot order, so the same collisions always play out the same way.
         collision_resolutions = {}
+        entities_by_slot = {}
         # For each collision,
         for collision_info in self.collisions:
             # For each entity in the collision,
             for entity in collision_info['colliding objects']:
                 # Ask the entity to resolve its collision and collect the results
+                slot = entity.slot
+                entities_by_slot[slot] = entity
                 if not entity in collision_info:
-                    collision_resolutions[entity] = []
+                    collision_resolutions[slot] = []
                 results = entity.resolve_collisions(collision_info)
-                collision_resolutions[entity] += (results)
+                collision_resolutions[slot] += (results)
 
         # For each entity with a resolution
         retreat_collisions = {}
-        for entity in collision_resolutions:
-            for resolution in collision_resolutions[entity]:
+        for slot in sorted(collision_resolutions):
+            entity = entities_by_slot[slot]
+            for resolution in collision_resolutions[slot]:
                 if not resolution:
                     continue
                 # If the entity wants to die, mark it as dead
@@ -270,8 +475,10 @@ class MissionModel:
 
         # Some results say units need to retreat.
         # For each result resolution
-        for x in retreat_collisions:
-            for y in retreat_collisions[x]:
+        registry = self.all_entities_by_id
+        retreating_entities = []
+        for x in sorted(retreat_collisions):
+            for y in sorted(retreat_collisions[x]):
                 # One Entity should NOT retreat.
                 advancing_entity = self._get_retreating_entity_that_should_stay(retreat_collisions[x][y]['entities'])
 
@@ -281,9 +488,14 @@ class MissionModel:
                     if entity == advancing_entity:
                         continue
 
-                    # The Entity should move back one space.
-                    entity.position_x = entity.position_history[-1]['x']
-                    entity.position_y = entity.position_history[-1]['y']
+                    # The Entity should move back one space, in one step.
+                    slot = entity.slot
+                    previous_x, previous_y = registry.get_previous_position(slot)
+                    registry.set_position(slot, previous_x, previous_y)
+                    self.retreat_count += 1
+                    retreating_entities.append(entity)
+
+        self.notify_entities_moved(retreating_entities)
 
     def _get_retreating_entity_that_should_stay(self, retreating_entities):
         # Given information on Entities that want to retreat, return the Entity that should NOT retreat.
@@ -304,13 +516,129 @@ class MissionModel:
 
     def _get_random_entity(self, entities):
         # Just choose a random entity
-        return random.choice(entities)
+        return self.random.choice(entities)
 
     def ask_all_ai_for_next_move(self):
         """Ask for all ai controllers to process and figure out their next moves.
+        If there is an ai_time_budget_seconds, the controllers decide at the same time and late ones are cancelled.
+        Controllers the opening_book has moves for do not decide at all.
         """
-        for ai_controller in self.all_ai_by_id.values():
-            ai_controller.determine_next_moves()
+        if self.ai_executor is not None:
+            self._ask_ai_executor_for_next_move(self._get_deciding_ai_ids())
+            return
+
+        if self.ai_time_budget_seconds is None:
+            for ai_id in self._get_deciding_ai_ids():
+                ai_controller = self.all_ai_by_id[ai_id]
+                ai_controller.start_decision()
+                ai_controller.determine_next_moves()
+                ai_controller.finish_decision()
+            return
+
+        self.start_ai_decisions(timeit.default_timer() + self.ai_time_budget_seconds)
+        self.finish_ai_decisions()
+
+    def _get_deciding_ai_ids(self):
+        # The ids of the controllers that have to decide this turn, in order. The rest have book moves.
+        return [ai_id for ai_id in sorted(self.all_ai_by_id) if not self.all_ai_by_id[ai_id].use_book_moves()]
+
+    def start_ai_decisions(self, deadline):
+        """Start every AI controller deciding on its own thread, to be done by deadline, a timeit.default_timer() time.
+        finish_ai_decisions collects the moves. Starting several missions before finishing any lets them all decide at
+        once under one deadline.
+        Controllers that decide at once do so here, on this thread.
+        """
+        self._deciding_ai_ids = []
+        self._decision_deadline = deadline
+        self.timed_out_ai_ids = []
+
+        # Start every controller on its own thread.
+        for ai_id in self._get_deciding_ai_ids():
+            ai_controller = self.all_ai_by_id[ai_id]
+
+            # Every turn is a new decision, even for a controller still busy with an old one. The old one is now stale.
+            ai_controller.start_decision(deadline)
+            if ai_controller.decides_at_once:
+                ai_controller.determine_next_moves()
+                ai_controller.finish_decision()
+                continue
+            self._deciding_ai_ids.append(ai_id)
+
+            # Each controller keeps its worker thread, unless the controller was replaced or the thread died.
+            decision_worker = self._decision_workers_by_ai_id.get(ai_id)
+            if decision_worker is not None and (decision_worker.ai_controller is not ai_controller or not decision_worker.thread.is_alive()):
+                decision_worker.stop()
+                decision_worker = None
+            if decision_worker is None:
+                decision_worker = ai_controllers.DecisionWorker(ai_controller)
+                self._decision_workers_by_ai_id[ai_id] = decision_worker
+
+            # A controller that ignored its last cancellation is still busy. Do not pile up more work on it.
+            if not decision_worker.is_busy():
+                decision_worker.decide(ai_controller.decision_token)
+
+    def finish_ai_decisions(self):
+        """Wait for the decisions start_ai_decisions started, until their deadline.
+        Controllers that did not finish before it get their fallback moves, and their ids go in timed_out_ai_ids.
+        """
+        deadline = self._decision_deadline
+        for ai_id in self._deciding_ai_ids:
+            ai_controller = self.all_ai_by_id[ai_id]
+            self._decision_workers_by_ai_id[ai_id].join(max(0.0, deadline - timeit.default_timer()))
+            finish_time = ai_controller.decision_finish_time
+            if finish_time is None or finish_time >= deadline:
+                ai_controller.cancel()
+                ai_controller.set_next_moves(ai_controller.get_fallback_moves())
+                self.timed_out_ai_ids.append(ai_id)
+            else:
+                ai_controller.finish_decision()
+
+    def stop_decision_workers(self):
+        """Let the threads start_ai_decisions started exit. Busy ones exit once their decision returns.
+        """
+        for decision_worker in getattr(self, '_decision_workers_by_ai_id', {}).values():
+            decision_worker.stop()
+        self._decision_workers_by_ai_id = {}
+
+    def _ask_ai_executor_for_next_move(self, ai_ids):
+        # Every controller decides from a snapshot of the same board, so they can all decide at once.
+        deadline = None
+        if self.ai_time_budget_seconds is not None:
+            deadline = timeit.default_timer() + self.ai_time_budget_seconds
+        self.timed_out_ai_ids = []
+
+        if self.shared_board is not None:
+            self.shared_board.publish(self)
+
+        pending_decisions = []
+        local_ai_ids = []
+        for ai_id in ai_ids:
+            ai_controller = self.all_ai_by_id[ai_id]
+            ai_controller.start_decision(deadline)
+            snapshot = ai_controller.get_decision_snapshot()
+            if snapshot is None:
+                local_ai_ids.append(ai_id)
+            else:
+                pending_decisions.append((ai_id, self.ai_executor.apply_async(
+                    ai_controllers.decide_from_snapshot_task,
+                    ((ai_controller.__class__, snapshot),)
+                )))
+
+        # Controllers without snapshots decide here while the executor works.
+        for ai_id in local_ai_ids:
+            self.all_ai_by_id[ai_id].determine_next_moves()
+            self.all_ai_by_id[ai_id].finish_decision()
+
+        for ai_id, pending_decision in pending_decisions:
+            ai_controller = self.all_ai_by_id[ai_id]
+            timeout = None
+            if deadline is not None:
+                timeout = max(0.0, deadline - timeit.default_timer())
+            try:
+                ai_controller.set_next_moves(ai_controller.get_moves_from_decision(pending_decision.get(timeout)))
+            except multiprocessing.TimeoutError:
+                ai_controller.set_next_moves(ai_controller.get_fallback_moves())
+                self.timed_out_ai_ids.append(ai_id)
 
     def clear_all_ai_for_moves(self):
         """Clear all AI moves.
@@ -327,19 +655,11 @@ class MissionModel:
         not_finished_string = 'not finished'
 
         # Count the number of Foxes and Geese on the map. Also count how many of them are dead.
-        fox_count = 0
-        dead_fox_count = 0
-        goose_count = 0
-        dead_goose_count = 0
-        for entity in self.all_entities_by_id.values():
-            if entity.entity_type == "fox":
-                fox_count += 1
-                if entity.is_dead:
-                    dead_fox_count += 1
-            if entity.entity_type == "goose":
-                goose_count += 1
-                if entity.is_dead:
-                    dead_goose_count += 1
+        all_entities_by_id = self.all_entities_by_id
+        fox_count = all_entities_by_id.count(FOX)
+        dead_fox_count = all_entities_by_id.count(FOX, dead=True)
+        goose_count = all_entities_by_id.count(GOOSE)
+        dead_goose_count = all_entities_by_id.count(GOOSE, dead=True)
 
         # If there are no Fox or Geese, the mission cannot end.
         if fox_count == 0 or goose_count == 0:
@@ -356,42 +676,91 @@ class MissionModel:
         # Otherwise the fox and at least 1 goose is alive. It's not finished.
         return not_finished_string
 
-class MissionController():
+class MissionController(object):
     """Uses a mission controller and processes actions. Keeps track of a state.
     """
     def __init__(self, mission_model=None):
 
         # The mission model will track the map and any entities inside.
-        self.mission_model = mission_model
+        self._mission_model = mission_model
 
         self.fox_moved = False
         self.other_entity_move_results = {}
         self.player_desired_direction = None
         self.mission_complete_status = None
 
+        # Count the turns so clients can order the deltas they receive.
+        self.turn_number = 0
+        self.last_turn_delta = None
+
+        # Functions to call with the turn delta after every turn.
+        self.turn_listeners = []
+
+        # Set to a profiling.TurnProfiler to time each phase of move_ai_entities.
+        self.turn_profiler = None
+
+        # get_status() is cached until the state changes.
+        self._status = None
+
+    @property
+    def mission_model(self):
+        return self._mission_model
+
+    @mission_model.setter
+    def mission_model(self, mission_model):
+        self._mission_model = mission_model
+        self.invalidate_status()
+
+    def invalidate_status(self):
+        """Forget the cached status. Call this whenever the state changes.
+        """
+        self._status = None
+
     def get_status(self):
         """Returns a dictionary giving the status of the last action.
 
         map initialized: Boolean that tells you if it's ok to draw the map and entities.
         mission complete: string that is one of 3 values. See MissionModel.get_mission_status
         fox moved: A boolean.
-        other entities moves: A dictionary containing the result of the other Entity movements. Keys are the entity_id, the values are dictionaries:
+        other entities moves: A dictionary containing the Entities that moved or died during the last turn. Keys are the entity_id, the values are dictionaries:
                 x: x coordinate of the entity
                 y: y coordinate of the entity
                 is dead: Boolean indicating if the entity died.
         player input: A string indicating the player's movement (w is wait, u d l r may be combined to form the 8 cardinal directions)
+
+        The dictionary is shared between calls until the state changes, so do not modify it.
+        """
+        if self._status is None:
+            # If there is no mission model, return False.
+            map_initialized = self.mission_model != None
+
+            self._status = {
+                'map initialized': map_initialized,
+                'mission complete': self.mission_complete_status,
+                'fox moved': self.fox_moved,
+                'other entities moves' : self.other_entity_move_results,
+                'player input': self.player_desired_direction,
+            }
+        return self._status
+
+    def add_turn_listener(self, listener):
+        """Call listener(turn_delta) after every turn. See get_turn_delta for the format.
         """
+        self.turn_listeners.append(listener)
 
-        # If there is no mission model, return False.
-        map_initialized = self.mission_model != None
+    def remove_turn_listener(self, listener):
+        """Stop calling listener after every turn.
+        """
+        self.turn_listeners.remove(listener)
 
-        return {
-            'map initialized': map_initialized,
-            'mission complete': self.mission_complete_status,
-            'fox moved': self.fox_moved,
-            'other entities moves' : self.other_entity_move_results,
-            'player input': self.player_desired_direction,
-        }
+    def get_turn_delta(self):
+        """Returns the changes made by the last turn, or None if no turn was played yet.
+
+        turn: The number of the turn, starting at 1.
+        moves: The Entities that moved or died this turn. Same format as 'other entities moves' in get_status.
+        mission complete: The mission status after the turn. See MissionModel.get_mission_status
+        """
+        return self.last_turn_delta
 
     def player_input(self, player_desired_direction):
         """Player has chosen to move in a given direction. Update the model and the status.
@@ -409,43 +778,94 @@ class MissionController():
         #Note the fox tried to move.
         self.fox_moved = True
         self.player_desired_direction = player_desired_direction
+        self.invalidate_status()
 
-    def move_ai_entities(self):
+    def move_ai_entities(self, ask_ai_for_moves=True):
         """Tells the mission model to move all AI controlled Entities.
+        Set ask_ai_for_moves to False if the AI controllers' next moves were already set, e.g. by a process pool.
         """
+        profiler = self.turn_profiler
+        if profiler:
+            profiler.start_turn()
+
         # Tell the ai to figure out their next move.
-        self.mission_model.ask_all_ai_for_next_move()
+        if ask_ai_for_moves:
+            self.mission_model.ask_all_ai_for_next_move()
 
-        # Collect the moves the ai wants to do.
-        entity_moves = {}
+        # Collect the moves the ai wants to do, by registry slot.
+        # Merge them in AI id order, so the result does not depend on which AI finished first.
+        moves_by_slot = {}
 
-        for ai_controller in self.mission_model.all_ai_by_id.values():
-            entity_moves.update(ai_controller.get_next_moves())
+        all_ai_by_id = self.mission_model.all_ai_by_id
+        for ai_id in sorted(all_ai_by_id):
+            moves_by_slot.update(all_ai_by_id[ai_id].get_next_moves_by_slot())
+
+        if profiler:
+            profiler.end_phase('ai decision')
+
+        # Move all units on the map, in the order they were added so the same moves always play out the same way.
+        slots = sorted(moves_by_slot)
+        self.mission_model.try_to_move_slots(slots, [moves_by_slot[slot] for slot in slots])
+        if profiler:
+            profiler.end_phase('try to move')
 
-        # Move all units on the map.
-        for entity_id, direction in entity_moves.iteritems():
-            self.mission_model.try_to_move_entity(
-                id=entity_id,
-                direction=direction
-            )
         self.mission_model.move_all_entities()
+        if profiler:
+            profiler.end_phase('move all entities')
 
         # Resolve collisions
         self.mission_model.clear_collisions()
         self.mission_model.find_collisions()
-        self.mission_model.resolve_collisions()
+        if profiler:
+            profiler.end_phase('find collisions')
 
-        # Record all of the units position and status.
-        for entity_id in self.mission_model.all_entities_by_id:
-            entity = self.mission_model.all_entities_by_id[entity_id]
+        self.mission_model.resolve_collisions()
+        if profiler:
+            profiler.end_phase('resolve collisions')
+
+        # Record the units that moved or died. Units that waited are left out.
+        # Dead units are deleted at the end of every round, so any dead unit died this turn.
+        # Only the units that changed cell this turn can have moved.
+        registry = self.mission_model.all_entities_by_id
+        changed_entity_ids = set(registry.dead_entity_ids)
+        for slot in registry.moved_slots:
+            if registry.get_previous_position(slot) != (registry.positions_x[slot], registry.positions_y[slot]):
+                changed_entity_ids.add(registry.entity_ids_by_slot[slot])
+
+        for entity_id in changed_entity_ids:
+            entity = registry[entity_id]
             self.other_entity_move_results[entity_id] = {
                 'x': entity.position_x,
                 'y': entity.position_y,
                 'is dead': entity.is_dead
             }
+        if profiler:
+            profiler.end_phase('record results')
 
         # Check the mission status.
         self.mission_complete_status = self.mission_model.get_mission_status()
+        if profiler:
+            profiler.end_phase('mission status')
+
+        self.turn_number += 1
+        self.last_turn_delta = {
+            'turn': self.turn_number,
+            'moves': self.other_entity_move_results,
+            'mission complete': self.mission_complete_status,
+        }
+        self.invalidate_status()
+
+        if profiler:
+            profiler.end_turn(
+                turn_number=self.turn_number,
+                collision_count=len(self.mission_model.collisions),
+                retreat_count=self.mission_model.retreat_count,
+                kill_count=len([move for move in self.other_entity_move_results.values() if move['is dead']])
+            )
+
+        # Tell everyone who is listening what changed.
+        for listener in self.turn_listeners:
+            listener(self.last_turn_delta)
 
     def reset_for_new_round(self):
         """Reset the status at the end of the round.
@@ -456,11 +876,24 @@ class MissionController():
 
         # Remove all dead units.
         self.dead_entities = self.mission_model.delete_dead_entities()
+        self.invalidate_status()
 
 class MissionView(object):
     """Visual representation of the mission.
     This class has some function pointers that need to be set by a subclass.
     """
+
+    # advance() stops in these states until something outside the mission view happens.
+    states_waiting_for_events = [
+        "not initialized",
+        "showing mission start",
+        "waiting for player input",
+        "animating entities",
+        "entities moved",
+        "showing mission complete",
+        "mission over",
+    ]
+
     def __init__(self):
         self.mission_controller = None
 
@@ -474,6 +907,7 @@ class MissionView(object):
         self.other_entity_move_results = None
 
         # Sense if othe runits have moved.
+        self.started_moving_entities = False
         self.finished_moving_entities = False
 
         # Track the state of the mission complete message. It should have 3 states: "not started", "in progress" or "complete".
@@ -484,6 +918,9 @@ class MissionView(object):
         self.move_entities = lambda s: None
         self.animate_mission_complete = lambda s: None
 
+        # Functions to call with (old state, new state) whenever advance() changes the state.
+        self.state_listeners = []
+
     def update(self):
         """This function will be called periodically to update the state or wait for animation to complete.
         """
@@ -500,7 +937,7 @@ class MissionView(object):
             return
 
         # If the player passed input, move the entities.
-        if self.player_input != None and not self.other_entity_move_results:
+        if self.player_input != None and self.other_entity_move_results is None:
             # Move all of the AI entities
             self.mission_controller.move_ai_entities()
             # Record the other entity moves
@@ -509,7 +946,8 @@ class MissionView(object):
             return
 
         # If we know how the entities want to move this turn but we haven't moved them yet, move them now.
-        if self.other_entity_move_results and not self.finished_moving_entities:
+        if self.other_entity_move_results is not None and not self.finished_moving_entities:
+            self.started_moving_entities = True
             self.move_entities()
             return
 
@@ -557,9 +995,8 @@ class MissionView(object):
 
         # If the mission is completed, note this.
         mission_complete_message_id = None
-        controller_state = self.mission_controller.get_status()
-        if controller_state["mission complete"] in ["player win", "player lose"]:
-            if controller_state["mission complete"] == "player win":
+        if mission_controller_status["mission complete"] in ["player win", "player lose"]:
+            if mission_controller_status["mission complete"] == "player win":
                 mission_complete_message_id = "win"
             else:
                 mission_complete_message_id = "lose"
@@ -599,6 +1036,7 @@ class MissionView(object):
         # Reset!
         self.player_input = None
         self.other_entity_move_results = None
+        self.started_moving_entities = False
         self.finished_moving_entities = False
 
     def apply_player_input(self, player_input):
@@ -612,3 +1050,104 @@ class MissionView(object):
             # Pass the player input to the controller.
             self.mission_controller.player_input(player_input)
 
+    def get_state(self):
+        """Returns a string naming the state of the mission view. One of:
+        "not initialized": There is no mission controller yet.
+        "mission start": The mission start banner should be shown.
+        "showing mission start": Waiting for the mission start banner to finish.
+        "waiting for player input": Waiting for the player to choose a move.
+        "moving entities": The mission controller should move the AI entities.
+        "entities ready to move": The entities should be animated.
+        "animating entities": Waiting for the entities to finish animating.
+        "entities moved": The entities finished moving and the mission is not complete.
+        "mission complete": The mission complete message should be shown.
+        "showing mission complete": Waiting for the mission complete message to finish.
+        "mission over": Nothing else will happen.
+        """
+        if not self.mission_controller:
+            return "not initialized"
+
+        if self.mission_start_status == "not started":
+            return "mission start"
+        if self.mission_start_status == "in progress":
+            return "showing mission start"
+
+        if self.player_input == None:
+            return "waiting for player input"
+        if self.other_entity_move_results is None:
+            return "moving entities"
+
+        if not self.finished_moving_entities:
+            if self.started_moving_entities:
+                return "animating entities"
+            return "entities ready to move"
+
+        if self.mission_controller.get_status()["mission complete"] not in ["player win", "player lose"]:
+            return "entities moved"
+
+        if self.mission_complete_display_progress == "not started":
+            return "mission complete"
+        if self.mission_complete_display_progress == "in progress":
+            return "showing mission complete"
+        return "mission over"
+
+    def add_state_listener(self, listener):
+        """Call listener(old_state, new_state) whenever the state changes.
+        """
+        self.state_listeners.append(listener)
+
+    def _notify_state_listeners(self, old_state):
+        # Tell the listeners if the state changed since old_state.
+        new_state = self.get_state()
+        if new_state != old_state:
+            for listener in self.state_listeners:
+                listener(old_state, new_state)
+        return new_state
+
+    def advance(self):
+        """Update until the mission view has to wait for something outside of it, like an animation or player input.
+        Call this instead of polling update() on a timer.
+        """
+        state = self.get_state()
+        while state not in self.states_waiting_for_events:
+            self.update()
+
+            new_state = self._notify_state_listeners(state)
+            if new_state == state:
+                break
+            state = new_state
+
+    def finish_mission_start(self):
+        """Call when the mission start banner has finished.
+        """
+        old_state = self.get_state()
+        self.mission_start_status = "complete"
+        self._notify_state_listeners(old_state)
+        self.advance()
+
+    def submit_player_input(self, player_input):
+        """Pass in the player's input and immediately move the entities.
+        """
+        old_state = self.get_state()
+        self.apply_player_input(player_input)
+        self._notify_state_listeners(old_state)
+        self.advance()
+
+    def finish_moving_entities(self):
+        """Call when the entities have finished animating.
+        Starts the next round unless the mission is complete.
+        """
+        old_state = self.get_state()
+        self.finished_moving_entities = True
+        if self.get_state() == "entities moved":
+            self.reset_for_new_round()
+        self._notify_state_listeners(old_state)
+        self.advance()
+
+    def finish_mission_complete(self):
+        """Call when the mission complete message has finished.
+        """
+        old_state = self.get_state()
+        self.mission_complete_display_progress = "complete"
+        self._notify_state_listeners(old_state)
+        self.advance()
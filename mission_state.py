@@ -0,0 +1,199 @@
+"""Compact serialization of a mission's state, for shipping missions between processes.
+
+Pickling a MissionModel copies every Entity object, its collision resolver and its whole position history.
+serialize_mission packs only what is needed to play on:
+
+    header: See HEADER.
+    metadata: JSON with the entity ids, the entity type and resource id names, and each AI controller's class and state.
+    positions_x, positions_y: An int32 per Entity.
+    type indexes, resource indexes: A uint16 per Entity, indexing the metadata names.
+    dead bits: One bit per Entity.
+    random state: The MissionModel's random number generator, if FLAG_RANDOM_STATE is set.
+    terrain: A byte per cell, if FLAG_TERRAIN is set. See terrain.TerrainGrid.
+
+Entities are stored in slot order. Collisions are resolved in slot order too, so a deserialized mission plays the same
+turns as the original, as long as its AI controllers decide from the mission alone.
+Pending moves and position histories are not kept. Serialize between turns, after MissionController.reset_for_new_round.
+"""
+import array
+import importlib
+import json
+import struct
+
+from entity import FoxCollisionResolver, GooseCollisionResolver
+from mission import MissionModel
+from terrain import TerrainGrid
+
+STATE_FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<4sBIIIIB')
+"""magic, version, map width, map height, entity count, metadata size, flags"""
+
+MAGIC = 'FGMS'
+
+FLAG_RANDOM_STATE = 1
+FLAG_TERRAIN = 2
+
+RANDOM_STATE = struct.Struct('<I625IBd')
+"""random.Random state: version, the Mersenne Twister state and position, then whether there is a gauss_next and its value."""
+
+COLLISION_RESOLVERS_BY_TYPE = {
+    'fox': FoxCollisionResolver,
+    'goose': GooseCollisionResolver,
+}
+"""The collision resolver each entity type gets, like in MissionModel.load_mission. Other types keep a CollisionResolver."""
+
+def get_class_path(cls):
+    """Returns the module.ClassName of the class, as get_class takes it.
+    """
+    return "%s.%s" % (cls.__module__, cls.__name__)
+
+def get_class(class_path):
+    """Returns the class named by get_class_path.
+    """
+    module_name, class_name = class_path.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+def _to_str(value):
+    # json gives back unicode. Ids are str everywhere else, and comparing the two is slow.
+    if isinstance(value, unicode):
+        try:
+            return str(value)
+        except UnicodeEncodeError:
+            return value
+    if isinstance(value, list):
+        return [_to_str(item) for item in value]
+    if isinstance(value, dict):
+        return dict([(_to_str(key), _to_str(item)) for key, item in value.iteritems()])
+    return value
+
+def _get_name_indexes(names, index_by_name, all_names):
+    # Returns an array with the index of each name in all_names, adding new names as they are found.
+    indexes = array.array('H')
+    for name in names:
+        index = index_by_name.get(name)
+        if index is None:
+            index = len(all_names)
+            index_by_name[name] = index
+            all_names.append(name)
+        indexes.append(index)
+    return indexes
+
+def serialize_mission(mission_model):
+    """Returns a string with the state of the mission. See deserialize_mission.
+    """
+    registry = mission_model.all_entities_by_id
+    slots = [slot for slot, entity_id in enumerate(registry.entity_ids_by_slot) if entity_id is not None]
+    entity_count = len(slots)
+
+    entity_types = []
+    resource_ids = []
+    type_indexes = _get_name_indexes([registry.entities_by_slot[slot].entity_type for slot in slots], {}, entity_types)
+    resource_indexes = _get_name_indexes([registry.resource_ids[slot] for slot in slots], {}, resource_ids)
+
+    positions_x = array.array('i', [registry.positions_x[slot] for slot in slots])
+    positions_y = array.array('i', [registry.positions_y[slot] for slot in slots])
+
+    dead_bits = bytearray((entity_count + 7) / 8)
+    registry_dead = registry.dead
+    for index, slot in enumerate(slots):
+        if registry_dead[slot]:
+            dead_bits[index / 8] |= 1 << (index % 8)
+
+    metadata = json.dumps({
+        'entity ids': [registry.entity_ids_by_slot[slot] for slot in slots],
+        'entity types': entity_types,
+        'resource ids': resource_ids,
+        'ai': [
+            [ai_id, get_class_path(ai_controller.__class__), ai_controller.get_state()]
+            for ai_id, ai_controller in sorted(mission_model.all_ai_by_id.items())
+        ],
+    }, separators=(",", ":"), sort_keys=True)
+
+    flags = 0
+    parts = [None, metadata, positions_x.tostring(), positions_y.tostring(), type_indexes.tostring(), resource_indexes.tostring(), str(dead_bits)]
+
+    random_generator = getattr(mission_model, 'random', None)
+    if random_generator is not None:
+        flags |= FLAG_RANDOM_STATE
+        version, internal_state, gauss_next = random_generator.getstate()
+        parts.append(RANDOM_STATE.pack(version, *(internal_state + (gauss_next is not None, gauss_next or 0.0))))
+
+    if mission_model.terrain is not None:
+        flags |= FLAG_TERRAIN
+        parts.append(str(mission_model.terrain.terrain))
+
+    parts[0] = HEADER.pack(MAGIC, STATE_FORMAT_VERSION, mission_model.grid_width, mission_model.grid_height, entity_count, len(metadata), flags)
+    return "".join(parts)
+
+def deserialize_mission(data):
+    """Returns a new MissionModel with the state from serialize_mission.
+    Raises ValueError if data is not a serialized mission of this version.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("Serialized mission is too short.")
+    magic, version, width, height, entity_count, metadata_size, flags = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a serialized mission.")
+    if version != STATE_FORMAT_VERSION:
+        raise ValueError("Serialized mission version %d, expected %d." % (version, STATE_FORMAT_VERSION))
+
+    offset = HEADER.size
+    metadata = _to_str(json.loads(data[offset:offset + metadata_size]))
+    offset += metadata_size
+
+    def read_array(typecode):
+        values = array.array(typecode)
+        size = values.itemsize * entity_count
+        values.fromstring(data[offset:offset + size])
+        return values, offset + size
+
+    positions_x, offset = read_array('i')
+    positions_y, offset = read_array('i')
+    type_indexes, offset = read_array('H')
+    resource_indexes, offset = read_array('H')
+    dead_bits = bytearray(data[offset:offset + (entity_count + 7) / 8])
+    offset += len(dead_bits)
+
+    mission_model = MissionModel(width=width, height=height)
+    registry = mission_model.all_entities_by_id
+    entity_type_names = metadata['entity types']
+    resource_id_names = metadata['resource ids']
+    entity_types = [entity_type_names[type_index] for type_index in type_indexes]
+    entities = registry.load(
+        metadata['entity ids'],
+        entity_types,
+        positions_x,
+        positions_y,
+        [resource_id_names[resource_index] for resource_index in resource_indexes],
+        [(dead_bits[index / 8] >> (index % 8)) & 1 for index in xrange(entity_count)]
+    )
+    collision_behaviors = registry.collision_behaviors
+    for slot, entity in enumerate(entities):
+        resolver_class = COLLISION_RESOLVERS_BY_TYPE.get(entity_types[slot])
+        if resolver_class is not None:
+            collision_behaviors[slot] = resolver_class(entity)
+
+    if flags & FLAG_RANDOM_STATE:
+        random_state = RANDOM_STATE.unpack_from(data, offset)
+        offset += RANDOM_STATE.size
+        gauss_next = None
+        if random_state[626]:
+            gauss_next = random_state[627]
+        mission_model.random.setstate((random_state[0], random_state[1:626], gauss_next))
+
+    if flags & FLAG_TERRAIN:
+        terrain_grid = TerrainGrid(width, height)
+        for cell, terrain in enumerate(bytearray(data[offset:offset + width * height])):
+            if terrain:
+                terrain_grid.set_terrain(cell % width, cell / width, terrain)
+        offset += width * height
+        mission_model.set_terrain(terrain_grid)
+
+    # The controllers look up their Entities, so they come last.
+    for ai_id, class_path, state in metadata['ai']:
+        ai_controller = get_class(class_path)(mission_model, state['entity id'])
+        ai_controller.set_state(state)
+        mission_model.all_ai_by_id[ai_id] = ai_controller
+
+    return mission_model
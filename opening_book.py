@@ -0,0 +1,366 @@
+"""Precomputed moves for the first turns of every mission in a campaign.
+
+Every mission starts from the same positions, so the goose AI decides the same first turns over and over. build_book
+plays the first plies of each mission offline, trying every fox move each turn, and records the goose AI's moves for
+every state it reaches. States are stored once for all their mirror images. See symmetry.py.
+
+The book is kept next to the campaign (campaign.book for campaign.yaml) and laid out as:
+    header: See HEADER.
+    metadata: JSON with the campaign digest, the AI controller class and id, the plies and the mission ids.
+    table: table size entries of TABLE_ENTRY, (state hash, record offset + 1). 0 marks an empty entry.
+    records: RECORD_HEADER (mission index, entity count), the canonical state key as uint32s, then a direction index
+        byte per key. See DIRECTION_CODES.
+
+The table is an open addressed hash table, so finding a state takes one probe or a few. OpeningBook maps the file
+instead of reading it, so every process playing the campaign shares one copy.
+
+Collisions can be won at random, so each mission is played out from a random state seeded with BOOK_SEED. A game
+seeded the same way stays in the book along the fox moves it tried. Other games can leave it after a random collision,
+and decide live from then on.
+
+AI controllers consult the book with AIController.use_book_moves before deciding. A book built for another campaign,
+or another AI controller class, is never used.
+
+Usage:
+    python opening_book.py --plies 6
+    python opening_book.py --campaign my_campaign.yaml --goose-ai my_ai.LookAhead --plies 8 --processes 8
+"""
+import argparse
+import bisect
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import timeit
+
+from mission import MissionModel, MissionController, read_campaign, get_campaign_mission_ids, DEFAULT_CAMPAIGN_FILE
+from mission_state import serialize_mission, deserialize_mission, get_class_path
+from simulation import get_ai_class
+
+BOOK_FORMAT_VERSION = 1
+
+MAGIC = 'FGOB'
+
+HEADER = struct.Struct('<4sBIII')
+"""magic, version, metadata size, table size, records size"""
+
+TABLE_ENTRY = struct.Struct('<QI')
+"""state hash, record offset + 1"""
+
+RECORD_HEADER = struct.Struct('<HH')
+"""mission index, entity count"""
+
+DIRECTION_CODES = ['W', 'UL', 'U', 'UR', 'L', 'R', 'DL', 'D', 'DR']
+"""The direction code of each direction index in a record."""
+
+DIRECTION_INDEXES = dict([(direction, index) for index, direction in enumerate(DIRECTION_CODES)])
+
+BOOK_AI_ID = 'goose'
+"""The AI controller the book is built for. The fox's moves are the ones tried."""
+
+FOX_ID = 'fox'
+
+DEFAULT_PLIES = 6
+
+BOOK_SEED = 0
+"""The seed of each mission's random state when the book is built."""
+
+def get_book_path(campaign_file):
+    """Returns the path of the opening book for the campaign file.
+    """
+    return os.path.splitext(campaign_file)[0] + '.book'
+
+def get_campaign_digest(yaml_document):
+    return hashlib.md5(yaml_document).hexdigest()
+
+def hash_state(mission_index, state_key):
+    """Returns a 64 bit hash of the state, the same in every process.
+    """
+    packed = struct.pack('<H%dI' % len(state_key), mission_index, *state_key)
+    return struct.unpack_from('<Q', hashlib.md5(packed).digest())[0]
+
+class OpeningBook(object):
+    """A read only opening book file.
+    """
+    def __init__(self, path):
+        self.path = path
+        file_descriptor = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(file_descriptor).st_size
+            if size < HEADER.size:
+                raise ValueError("%s is too short to be an opening book." % path)
+            self.memory = mmap.mmap(file_descriptor, size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(file_descriptor)
+
+        magic, version, metadata_size, self.table_size, records_size = HEADER.unpack_from(self.memory, 0)
+        if magic != MAGIC:
+            self.memory.close()
+            raise ValueError("%s is not an opening book." % path)
+        if version != BOOK_FORMAT_VERSION:
+            self.memory.close()
+            raise ValueError("Opening book version %d, expected %d." % (version, BOOK_FORMAT_VERSION))
+
+        metadata = json.loads(self.memory[HEADER.size:HEADER.size + metadata_size])
+        self.campaign_digest = str(metadata['campaign digest'])
+        self.ai_id = str(metadata['ai id'])
+        self.ai_class_path = str(metadata['ai class'])
+        self.plies = metadata['plies']
+        self.mission_indexes = dict([(mission_id, index) for index, mission_id in enumerate(metadata['mission ids'])])
+
+        self.table_offset = HEADER.size + metadata_size
+        self.records_offset = self.table_offset + self.table_size * TABLE_ENTRY.size
+
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.memory.close()
+
+    def find(self, mission_index, state_key):
+        """Returns the direction indexes recorded for the canonical state, as a string, or None if it is not in the book.
+        """
+        if not self.table_size:
+            return None
+        memory = self.memory
+        state_hash = hash_state(mission_index, state_key)
+        mask = self.table_size - 1
+        index = state_hash & mask
+        while True:
+            entry_hash, record_reference = TABLE_ENTRY.unpack_from(memory, self.table_offset + index * TABLE_ENTRY.size)
+            if record_reference == 0:
+                return None
+            if entry_hash == state_hash:
+                record_offset = self.records_offset + record_reference - 1
+                record_mission_index, entity_count = RECORD_HEADER.unpack_from(memory, record_offset)
+                keys_offset = record_offset + RECORD_HEADER.size
+                if record_mission_index == mission_index and entity_count == len(state_key) \
+                    and struct.unpack_from('<%dI' % entity_count, memory, keys_offset) == state_key:
+                    directions_offset = keys_offset + 4 * entity_count
+                    return memory[directions_offset:directions_offset + entity_count]
+            index = (index + 1) & mask
+
+    def get_moves(self, mission_model, ai_controller):
+        """Returns the book's moves by entity id for the AI controller in the mission's current state, or None.
+        Only the controller with the book's ai id gets moves. Entities on the same cell get the same move.
+        """
+        if mission_model.all_ai_by_id.get(self.ai_id) is not ai_controller:
+            return None
+        if get_class_path(ai_controller.__class__) != self.ai_class_path:
+            return None
+        mission_index = self.mission_indexes.get(mission_model.mission_id)
+        if mission_index is None:
+            return None
+        registry = mission_model.all_entities_by_id
+        if registry.turn_count >= self.plies:
+            return None
+
+        symmetry = mission_model.get_symmetry()
+        state_key, transform = symmetry.canonicalize(mission_model)
+        directions = self.find(mission_index, state_key)
+        if directions is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        # Find each Entity in the canonical state by its cell, and turn its move back.
+        cell_map = transform.get_cell_map()
+        restore_direction = transform.inverse().apply_direction
+        cell_count = symmetry.cell_count
+        width = symmetry.width
+        moves = {}
+        for entity_id in ai_controller.get_entity_ids():
+            slot = registry[entity_id].slot
+            if registry.dead[slot]:
+                continue
+            code = registry.type_codes[slot] * cell_count + cell_map[registry.positions_y[slot] * width + registry.positions_x[slot]]
+            index = bisect.bisect_left(state_key, code)
+            if index < len(state_key) and state_key[index] == code:
+                moves[entity_id] = restore_direction(DIRECTION_CODES[ord(directions[index])])
+        return moves
+
+def load_campaign_book(campaign_file=DEFAULT_CAMPAIGN_FILE, yaml_document=None):
+    """Returns the OpeningBook next to the campaign file, or None if there is none or it was built for another campaign.
+    """
+    path = get_book_path(campaign_file)
+    if not os.path.exists(path):
+        return None
+    if yaml_document is None:
+        yaml_document = read_campaign(campaign_file)
+    opening_book = OpeningBook(path)
+    if opening_book.campaign_digest != get_campaign_digest(yaml_document):
+        opening_book.close()
+        return None
+    return opening_book
+
+def _encode_moves(mission_model, transform, moves_by_entity_id):
+    # Returns the direction index byte of every living Entity, in the order of the canonical state key.
+    symmetry = mission_model.get_symmetry()
+    cell_map = transform.get_cell_map()
+    cell_count = symmetry.cell_count
+    width = symmetry.width
+    registry = mission_model.all_entities_by_id
+
+    coded_moves = []
+    for slot in registry.get_occupied_slots():
+        if registry.dead[slot]:
+            continue
+        code = registry.type_codes[slot] * cell_count + cell_map[registry.positions_y[slot] * width + registry.positions_x[slot]]
+        direction = moves_by_entity_id.get(registry.entity_ids_by_slot[slot], 'W')
+        coded_moves.append((code, DIRECTION_INDEXES[transform.apply_direction(direction)]))
+    coded_moves.sort()
+    return "".join([chr(direction_index) for code, direction_index in coded_moves])
+
+def analyze_state(task):
+    """Decide the book AI's moves for one state, and play out every fox move from it.
+    task is a tuple of (mission index, AI class name, serialized mission, whether to play out the fox moves).
+    Returns a tuple of (mission index, state key, direction indexes, [(child state key, serialized child), ...]).
+    """
+    mission_index, ai_class_name, data, expand = task
+    mission_model = deserialize_mission(data)
+    ai_controller = get_ai_class(ai_class_name)(mission_model, mission_model.all_ai_by_id[BOOK_AI_ID].get_entity_ids())
+    mission_model.all_ai_by_id[BOOK_AI_ID] = ai_controller
+
+    ai_controller.start_decision()
+    ai_controller.determine_next_moves()
+    ai_controller.finish_decision()
+    moves = dict(ai_controller.get_next_moves())
+
+    state_key, transform = mission_model.get_symmetry().canonicalize(mission_model)
+    directions = _encode_moves(mission_model, transform, moves)
+
+    children = []
+    if expand:
+        for fox_direction in DIRECTION_CODES:
+            child_model = deserialize_mission(data)
+            for child_ai_controller in child_model.all_ai_by_id.values():
+                child_ai_controller.set_next_moves({})
+            child_model.all_ai_by_id[BOOK_AI_ID].set_next_moves(dict(moves))
+            child_model.all_ai_by_id[FOX_ID].set_next_moves({FOX_ID: fox_direction})
+
+            child_controller = MissionController(mission_model=child_model)
+            child_controller.move_ai_entities(ask_ai_for_moves=False)
+            if child_controller.get_status()['mission complete'] in ['player win', 'player lose']:
+                continue
+            child_controller.reset_for_new_round()
+            children.append((child_model.get_symmetry().canonicalize(child_model)[0], serialize_mission(child_model)))
+
+    return mission_index, state_key, directions, children
+
+def build_book(yaml_document, mission_ids, plies=DEFAULT_PLIES, ai_class_name='ChaseTheFox', processes=None, progress=None):
+    """Play the first plies of every mission, trying every fox move, and decide the book AI's moves in every state.
+    processes: Worker processes to use. Defaults to one per CPU. 0 works in this process.
+    progress: Called with (ply, states) after each ply.
+    Returns a dictionary of direction index strings keyed by (mission index, canonical state key).
+    """
+    frontier = []
+    seen_states = set()
+    for mission_index, mission_id in enumerate(mission_ids):
+        mission_model = MissionModel()
+        mission_model.load_mission(mission_id, yaml_document)
+        mission_model.random.seed(BOOK_SEED)
+        state_key = mission_model.get_symmetry().canonicalize(mission_model)[0]
+        seen_states.add((mission_index, state_key))
+        frontier.append((mission_index, serialize_mission(mission_model)))
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = None
+    if processes > 0:
+        pool = multiprocessing.Pool(processes)
+
+    directions_by_state = {}
+    try:
+        for ply in xrange(plies):
+            tasks = [(mission_index, ai_class_name, data, ply < plies - 1) for mission_index, data in frontier]
+            if pool:
+                chunk_size = max(1, len(tasks) / (processes * 4))
+                results = pool.imap_unordered(analyze_state, tasks, chunk_size)
+            else:
+                results = (analyze_state(task) for task in tasks)
+
+            frontier = []
+            for mission_index, state_key, directions, children in results:
+                directions_by_state[(mission_index, state_key)] = directions
+                for child_state_key, child_data in children:
+                    if not (mission_index, child_state_key) in seen_states:
+                        seen_states.add((mission_index, child_state_key))
+                        frontier.append((mission_index, child_data))
+
+            if progress:
+                progress(ply, len(tasks))
+            if not frontier:
+                break
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    return directions_by_state
+
+def write_book(path, yaml_document, mission_ids, ai_class, plies, directions_by_state):
+    """Write the states from build_book to an opening book file.
+    """
+    table_size = 1
+    while table_size < 2 * len(directions_by_state):
+        table_size *= 2
+    table = [None] * table_size
+
+    records = []
+    records_size = 0
+    for (mission_index, state_key), directions in sorted(directions_by_state.items()):
+        record = RECORD_HEADER.pack(mission_index, len(state_key)) + struct.pack('<%dI' % len(state_key), *state_key) + directions
+        state_hash = hash_state(mission_index, state_key)
+        index = state_hash & (table_size - 1)
+        while table[index] is not None:
+            index = (index + 1) & (table_size - 1)
+        table[index] = (state_hash, records_size + 1)
+        records.append(record)
+        records_size += len(record)
+
+    metadata = json.dumps({
+        'campaign digest': get_campaign_digest(yaml_document),
+        'ai id': BOOK_AI_ID,
+        'ai class': get_class_path(ai_class),
+        'plies': plies,
+        'mission ids': list(mission_ids),
+    }, separators=(",", ":"), sort_keys=True)
+
+    with open(path, 'wb') as book_file:
+        book_file.write(HEADER.pack(MAGIC, BOOK_FORMAT_VERSION, len(metadata), table_size, records_size))
+        book_file.write(metadata)
+        book_file.write("".join([TABLE_ENTRY.pack(*(entry or (0, 0))) for entry in table]))
+        book_file.write("".join(records))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precompute the goose AI's opening moves for every mission of a campaign.")
+    parser.add_argument('--campaign', default=DEFAULT_CAMPAIGN_FILE, help="The campaign yaml file.")
+    parser.add_argument('--mission', action='append', dest='mission_ids', help="Mission id to include. Defaults to every mission in the campaign.")
+    parser.add_argument('--plies', type=int, default=DEFAULT_PLIES, help="Turns from the start of each mission to cover.")
+    parser.add_argument('--goose-ai', default='ChaseTheFox', help="Name of the AIController the book is for.")
+    parser.add_argument('--processes', type=int, help="Worker processes. Defaults to one per CPU.")
+    parser.add_argument('--output', help="The book file. Defaults to the campaign file with a .book extension.")
+    args = parser.parse_args(argv)
+
+    ai_class = get_ai_class(args.goose_ai)
+    yaml_document = read_campaign(args.campaign)
+    mission_ids = args.mission_ids or get_campaign_mission_ids(yaml_document)
+
+    def print_progress(ply, states):
+        print "ply %d: %d states" % (ply + 1, states)
+        sys.stdout.flush()
+
+    start_time = timeit.default_timer()
+    directions_by_state = build_book(yaml_document, mission_ids, args.plies, args.goose_ai, args.processes, print_progress)
+    path = args.output or get_book_path(args.campaign)
+    write_book(path, yaml_document, mission_ids, ai_class, args.plies, directions_by_state)
+    print "%d states in %.3fs, %d bytes written to %s" % (
+        len(directions_by_state), timeit.default_timer() - start_time, os.path.getsize(path), path
+    )
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
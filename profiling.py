@@ -0,0 +1,129 @@
+"""Optional timing hooks for the phases of a turn.
+
+Give a MissionController a TurnProfiler to time each phase of move_ai_entities:
+
+    mission_controller.turn_profiler = TurnProfiler()
+    mission_controller.move_ai_entities()
+    print mission_controller.turn_profiler.last_turn_record
+
+Without a profiler the controller skips all timing.
+"""
+import collections
+import timeit
+
+TURN_PHASES = [
+    'ai decision',
+    'try to move',
+    'move all entities',
+    'find collisions',
+    'resolve collisions',
+    'record results',
+    'mission status',
+]
+"""The phases of MissionController.move_ai_entities, in order."""
+
+DEFAULT_BUCKET_EDGES = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0]
+"""Upper edges in seconds of the histogram buckets. Anything slower goes in a final overflow bucket."""
+
+class TurnProfiler(object):
+    """Times the phases of each turn and counts collisions, retreats and kills.
+    Keeps the last history_length turns for histograms and percentiles.
+    """
+    def __init__(self, history_length=1000, clock=timeit.default_timer):
+        self.clock = clock
+
+        # Recent samples for each phase, plus 'turn' for the whole turn.
+        self.samples_by_phase = {}
+        for phase in TURN_PHASES + ['turn']:
+            self.samples_by_phase[phase] = collections.deque(maxlen=history_length)
+
+        self.turn_records = collections.deque(maxlen=history_length)
+        self.last_turn_record = None
+
+        # Functions to call with each turn record.
+        self.record_listeners = []
+
+        self._turn_start_time = None
+        self._phase_start_time = None
+        self._seconds_by_phase = None
+
+    def start_turn(self):
+        """Call at the start of the turn.
+        """
+        self._seconds_by_phase = {}
+        self._turn_start_time = self._phase_start_time = self.clock()
+
+    def end_phase(self, phase):
+        """Call when the phase ends. The next phase starts immediately.
+        """
+        now = self.clock()
+        self._seconds_by_phase[phase] = now - self._phase_start_time
+        self._phase_start_time = now
+
+    def end_turn(self, turn_number, collision_count, retreat_count, kill_count):
+        """Call at the end of the turn. Returns the turn record:
+        turn: The turn number.
+        seconds: How long the whole turn took.
+        phases: A dictionary. Keys are phases, values are how long the phase took in seconds.
+        collisions, retreats, kills: Counts for the turn.
+        """
+        turn_seconds = self.clock() - self._turn_start_time
+
+        record = {
+            'turn': turn_number,
+            'seconds': turn_seconds,
+            'phases': self._seconds_by_phase,
+            'collisions': collision_count,
+            'retreats': retreat_count,
+            'kills': kill_count,
+        }
+
+        for phase in self._seconds_by_phase:
+            self.samples_by_phase[phase].append(self._seconds_by_phase[phase])
+        self.samples_by_phase['turn'].append(turn_seconds)
+
+        self.turn_records.append(record)
+        self.last_turn_record = record
+
+        for listener in self.record_listeners:
+            listener(record)
+        return record
+
+    def get_percentile(self, phase, percentile):
+        """Returns the given percentile (0 to 100) of the recent samples for the phase, or None if there are none.
+        """
+        samples = sorted(self.samples_by_phase[phase])
+        if not samples:
+            return None
+        index = int(round((len(samples) - 1) * percentile / 100.0))
+        return samples[index]
+
+    def get_histogram(self, phase, bucket_edges=DEFAULT_BUCKET_EDGES):
+        """Returns a list of counts of the recent samples for the phase.
+        There is one count per bucket edge (samples up to and including the edge) plus one for slower samples.
+        """
+        counts = [0] * (len(bucket_edges) + 1)
+        for sample in self.samples_by_phase[phase]:
+            bucket = len(bucket_edges)
+            for index, edge in enumerate(bucket_edges):
+                if sample <= edge:
+                    bucket = index
+                    break
+            counts[bucket] += 1
+        return counts
+
+    def get_phases_over_budget(self, budget_seconds_by_phase, record=None):
+        """Returns the phases of the turn record (the last turn by default) that took longer than their budget, slowest first.
+        budget_seconds_by_phase: A dictionary. Keys are phases, values are the most seconds the phase should take.
+        """
+        if record is None:
+            record = self.last_turn_record
+        if record is None:
+            return []
+
+        phases_over_budget = [
+            phase for phase in record['phases']
+            if phase in budget_seconds_by_phase and record['phases'][phase] > budget_seconds_by_phase[phase]
+        ]
+        phases_over_budget.sort(key=lambda phase: record['phases'][phase], reverse=True)
+        return phases_over_budget
@@ -0,0 +1,474 @@
+"""Hosts many missions at once for clients connecting over TCP.
+
+Every connection gets its own mission. The protocol is one JSON object per line:
+    Server -> client, on connect: {"type": "welcome", "session": 1, "mission id": ..., "map width": ..., "map height": ..., "entities": {...}}
+    Client -> server: a fox move per line, using the codes KivyMissionView.accept_player_input accepts (UL, U, UR, L, W, R, DL, D, DR).
+    Server -> client, after every turn: {"type": "turn", "turn": 1, "moves": {...}, "mission complete": ...}
+    Server -> client, on a bad move: {"type": "error", "message": ...}
+
+The server runs a single threaded event loop (epoll where available). All the turns that are ready in one loop tick are played together,
+and the AI decisions for the whole batch can be handed to a process pool.
+Clients that do not read their turns stop being read from until they catch up.
+Clients that send lines that are too long, or more input than the server will hold, are disconnected.
+
+Usage:
+    python server.py --port 7777 --ai-processes 4
+"""
+import argparse
+import errno
+import json
+import multiprocessing
+import select
+import socket
+import sys
+import timeit
+
+import ai_controllers
+from mission import MissionModel, MissionController, read_campaign
+from opening_book import load_campaign_book
+
+VALID_MOVES = ['UL', 'U', 'UR', 'L', 'W', 'R', 'DL', 'D', 'DR']
+
+READ_SIZE = 4096
+
+class _Poller(object):
+    """Waits for sockets to become readable or writable. Uses epoll when available, select otherwise.
+    """
+    def __init__(self):
+        self.events_by_fd = {}
+        self.epoll = None
+        if hasattr(select, 'epoll'):
+            self.epoll = select.epoll()
+
+    def _event_mask(self, read, write):
+        mask = 0
+        if read:
+            mask |= select.EPOLLIN
+        if write:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def register(self, fd, read, write):
+        if fd in self.events_by_fd:
+            if self.events_by_fd[fd] == (read, write):
+                return
+            if self.epoll:
+                self.epoll.modify(fd, self._event_mask(read, write))
+        elif self.epoll:
+            self.epoll.register(fd, self._event_mask(read, write))
+        self.events_by_fd[fd] = (read, write)
+
+    def unregister(self, fd):
+        if fd in self.events_by_fd:
+            del self.events_by_fd[fd]
+            if self.epoll:
+                self.epoll.unregister(fd)
+
+    def poll(self, timeout):
+        """Returns a list of (fd, readable, writable).
+        """
+        if self.epoll:
+            try:
+                events = self.epoll.poll(timeout)
+            except IOError as error:
+                if error.errno == errno.EINTR:
+                    return []
+                raise
+            return [
+                (fd, bool(mask & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR)), bool(mask & select.EPOLLOUT))
+                for fd, mask in events
+            ]
+
+        read_fds = [fd for fd in self.events_by_fd if self.events_by_fd[fd][0]]
+        write_fds = [fd for fd in self.events_by_fd if self.events_by_fd[fd][1]]
+        readable, writable, _ = select.select(read_fds, write_fds, [], timeout)
+        ready = set(readable) | set(writable)
+        readable = set(readable)
+        writable = set(writable)
+        return [(fd, fd in readable, fd in writable) for fd in ready]
+
+    def close(self):
+        if self.epoll:
+            self.epoll.close()
+
+class ClientSession(object):
+    """One client connection and the mission it is playing.
+    """
+    def __init__(self, session_id, client_socket, mission_model, mission_controller):
+        self.session_id = session_id
+        self.socket = client_socket
+        self.mission_model = mission_model
+        self.mission_controller = mission_controller
+
+        self.input_buffer = ""
+        self.output_chunks = []
+        self.output_size = 0
+
+        # Fox moves waiting for their turn.
+        self.pending_moves = []
+
+        # Pool decisions that missed their deadline and may still be running, by AI id.
+        self.late_decisions_by_ai_id = {}
+
+        self.mission_complete = False
+        self.closed = False
+
+    def send_message(self, message):
+        """Queue a message to send to the client.
+        """
+        data = json.dumps(message, sort_keys=True) + "\n"
+        self.output_chunks.append(data)
+        self.output_size += len(data)
+
+class GameServer(object):
+    """Hosts a mission per connected client.
+    """
+    def __init__(
+            self,
+            host='127.0.0.1',
+            port=0,
+            mission_id="mission 1",
+            yaml_document=None,
+            ai_pool=None,
+            max_output_size=64 * 1024,
+            max_pending_moves=4,
+            max_line_size=64,
+            max_input_size=2 * READ_SIZE,
+            listen_backlog=1024,
+            ai_time_budget_seconds=None,
+            opening_book=None,
+    ):
+        """ai_pool: Anything with a multiprocessing.Pool style map(). The AI decisions of each batch of turns are made there.
+        max_output_size: Stop reading from a client when this many bytes are waiting to be sent to it.
+        max_pending_moves: Stop reading from a client when it has sent this many moves that have not been played yet.
+            Further moves already read wait in its input buffer.
+        max_line_size: Disconnect a client that sends a line longer than this.
+        max_input_size: Disconnect a client with more than this many bytes of input waiting to be played.
+        ai_time_budget_seconds: If set, the AI of a batch of turns gets this long to decide. Late AIs wait this turn.
+        opening_book: An opening_book.OpeningBook for the mission, shared by every session.
+        """
+        self.mission_id = mission_id
+        self.yaml_document = yaml_document or read_campaign()
+        self.ai_pool = ai_pool
+        self.max_output_size = max_output_size
+        self.max_pending_moves = max_pending_moves
+        self.max_line_size = max_line_size
+        self.max_input_size = max_input_size
+        self.ai_time_budget_seconds = ai_time_budget_seconds
+        self.opening_book = opening_book
+
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind((host, port))
+        self.listen_socket.listen(listen_backlog)
+        self.listen_socket.setblocking(0)
+        self.server_address = self.listen_socket.getsockname()
+
+        self.poller = _Poller()
+        self.poller.register(self.listen_socket.fileno(), True, False)
+
+        self.sessions_by_fd = {}
+        self.next_session_id = 1
+        self.turns_played = 0
+        self.running = False
+
+    def create_session(self, client_socket):
+        """Load a new mission for the client.
+        """
+        mission_model = MissionModel()
+        mission_model.load_mission(self.mission_id, self.yaml_document)
+        mission_model.ai_time_budget_seconds = self.ai_time_budget_seconds
+        mission_model.opening_book = self.opening_book
+        mission_controller = MissionController(mission_model=mission_model)
+
+        session = ClientSession(self.next_session_id, client_socket, mission_model, mission_controller)
+        self.next_session_id += 1
+
+        entities = {}
+        for entity_id in mission_model.all_entities_by_id:
+            entity = mission_model.all_entities_by_id[entity_id]
+            entities[entity_id] = {'x': entity.position_x, 'y': entity.position_y, 'type': entity.entity_type}
+
+        session.send_message({
+            'type': 'welcome',
+            'session': session.session_id,
+            'mission id': self.mission_id,
+            'map width': mission_model.grid_width,
+            'map height': mission_model.grid_height,
+            'entities': entities,
+        })
+        return session
+
+    def _accept_clients(self):
+        while True:
+            try:
+                client_socket, address = self.listen_socket.accept()
+            except socket.error as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            client_socket.setblocking(0)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = self.create_session(client_socket)
+            self.sessions_by_fd[client_socket.fileno()] = session
+
+    def _is_backed_up(self, session):
+        # A slow client should not be read from until it catches up.
+        return session.output_size >= self.max_output_size \
+            or len(session.pending_moves) >= self.max_pending_moves
+
+    def _read_client(self, session):
+        try:
+            data = session.socket.recv(READ_SIZE)
+        except socket.error as error:
+            if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.close_session(session)
+            return
+
+        if not data:
+            self.close_session(session)
+            return
+
+        session.input_buffer += data
+        if len(session.input_buffer) > self.max_input_size:
+            self.close_session(session)
+            return
+        self._read_moves(session)
+
+    def _read_moves(self, session):
+        # Turn complete lines of input into pending moves, until the client has max_pending_moves of them.
+        while len(session.pending_moves) < self.max_pending_moves and "\n" in session.input_buffer:
+            line, session.input_buffer = session.input_buffer.split("\n", 1)
+            if len(line) > self.max_line_size:
+                self.close_session(session)
+                return
+            move = line.strip().upper()
+            if not move:
+                continue
+            if session.mission_complete:
+                session.send_message({'type': 'error', 'message': "The mission is complete."})
+            elif move not in VALID_MOVES:
+                session.send_message({'type': 'error', 'message': "Unknown move %s. Expected one of %s." % (move, ", ".join(VALID_MOVES))})
+            else:
+                session.pending_moves.append(move)
+
+        # No move is this long. Do not wait for the rest of the line.
+        if len(session.input_buffer) > self.max_line_size and not "\n" in session.input_buffer:
+            self.close_session(session)
+
+    def _write_client(self, session):
+        while session.output_chunks:
+            data = session.output_chunks[0]
+            try:
+                sent = session.socket.send(data)
+            except socket.error as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self.close_session(session)
+                return
+            session.output_size -= sent
+            if sent < len(data):
+                session.output_chunks[0] = data[sent:]
+                return
+            session.output_chunks.pop(0)
+
+    def close_session(self, session):
+        """Disconnect the client and forget its mission.
+        """
+        if session.closed:
+            return
+        session.closed = True
+        session.mission_model.stop_decision_workers()
+        fd = session.socket.fileno()
+        self.poller.unregister(fd)
+        del self.sessions_by_fd[fd]
+        session.socket.close()
+
+    def play_turns(self, sessions):
+        """Play one turn for each session, using the first of its pending moves.
+        """
+        # Give every fox its move.
+        for session in sessions:
+            session.mission_controller.player_input(session.pending_moves.pop(0))
+
+        if self.ai_pool is None and self.ai_time_budget_seconds is None:
+            for session in sessions:
+                session.mission_controller.move_ai_entities()
+        elif self.ai_pool is None:
+            # Every session's AI decides at once under one deadline, so a batch takes one budget and not one per session.
+            deadline = timeit.default_timer() + self.ai_time_budget_seconds
+            for session in sessions:
+                session.mission_model.start_ai_decisions(deadline)
+            for session in sessions:
+                session.mission_model.finish_ai_decisions()
+                session.mission_controller.move_ai_entities(ask_ai_for_moves=False)
+        else:
+            self._decide_in_pool(sessions)
+            for session in sessions:
+                session.mission_controller.move_ai_entities(ask_ai_for_moves=False)
+
+        # Tell the clients what happened and get ready for the next round.
+        for session in sessions:
+            turn_delta = session.mission_controller.get_turn_delta()
+            session.send_message({
+                'type': 'turn',
+                'turn': turn_delta['turn'],
+                'moves': turn_delta['moves'],
+                'mission complete': turn_delta['mission complete'],
+            })
+
+            if turn_delta['mission complete'] in ['player win', 'player lose']:
+                session.mission_complete = True
+                session.pending_moves = []
+            else:
+                session.mission_controller.reset_for_new_round()
+
+        self.turns_played += len(sessions)
+
+    def _decide_in_pool(self, sessions):
+        # Send every AI decision that can be made from a snapshot to the pool in one batch.
+        deadline = None
+        if self.ai_time_budget_seconds is not None:
+            deadline = timeit.default_timer() + self.ai_time_budget_seconds
+
+        tasks = []
+        task_decisions = []
+        for session in sessions:
+            mission_model = session.mission_model
+            mission_model.timed_out_ai_ids = []
+            all_ai_by_id = mission_model.all_ai_by_id
+            for ai_id in sorted(all_ai_by_id):
+                ai_controller = all_ai_by_id[ai_id]
+                if ai_controller.use_book_moves():
+                    continue
+                ai_controller.start_decision(deadline)
+
+                # A late decision from an earlier turn still holds a worker. Do not queue more work for it.
+                late_decision = session.late_decisions_by_ai_id.get(ai_id)
+                if late_decision is not None:
+                    if not late_decision.ready():
+                        ai_controller.set_next_moves(ai_controller.get_fallback_moves())
+                        mission_model.timed_out_ai_ids.append(ai_id)
+                        continue
+                    del session.late_decisions_by_ai_id[ai_id]
+
+                snapshot = ai_controller.get_decision_snapshot()
+                if snapshot is None:
+                    ai_controller.determine_next_moves()
+                    ai_controller.finish_decision()
+                else:
+                    tasks.append((ai_controller.__class__, snapshot))
+                    task_decisions.append((session, ai_id, ai_controller))
+
+        if tasks and deadline is None:
+            chunk_size = max(1, len(tasks) / (4 * multiprocessing.cpu_count()))
+            all_moves = self.ai_pool.map(ai_controllers.decide_from_snapshot_task, tasks, chunk_size)
+            for (session, ai_id, ai_controller), moves in zip(task_decisions, all_moves):
+                ai_controller.set_next_moves(ai_controller.get_moves_from_decision(moves))
+        elif tasks:
+            # Collect each decision separately so one slow decision cannot hold up the batch.
+            # A late task cannot be stopped. It keeps its worker busy until it returns. See late_decisions_by_ai_id.
+            async_results = [self.ai_pool.apply_async(ai_controllers.decide_from_snapshot_task, (task,)) for task in tasks]
+            for (session, ai_id, ai_controller), async_result in zip(task_decisions, async_results):
+                try:
+                    moves = ai_controller.get_moves_from_decision(async_result.get(max(0.0, deadline - timeit.default_timer())))
+                except multiprocessing.TimeoutError:
+                    moves = ai_controller.get_fallback_moves()
+                    session.mission_model.timed_out_ai_ids.append(ai_id)
+                    session.late_decisions_by_ai_id[ai_id] = async_result
+                ai_controller.set_next_moves(moves)
+
+    def run_once(self, timeout=0.05):
+        """Run one tick of the event loop: accept and read clients, play every ready turn, then write.
+        """
+        listen_fd = self.listen_socket.fileno()
+        for fd, readable, writable in self.poller.poll(timeout):
+            if fd == listen_fd:
+                self._accept_clients()
+                continue
+
+            session = self.sessions_by_fd.get(fd)
+            if session is None:
+                continue
+            if readable and not self._is_backed_up(session):
+                self._read_client(session)
+            if writable and not session.closed:
+                self._write_client(session)
+
+        # Moves left in the input buffer become pending as earlier ones are played.
+        for session in self.sessions_by_fd.values():
+            if session.input_buffer and not session.closed:
+                self._read_moves(session)
+
+        # Play all of the turns that are ready as one batch.
+        ready_sessions = [session for session in self.sessions_by_fd.values() if session.pending_moves]
+        if ready_sessions:
+            self.play_turns(ready_sessions)
+
+        # Send what we can right away, and watch for the rest.
+        for session in self.sessions_by_fd.values():
+            if session.output_chunks:
+                self._write_client(session)
+            if not session.closed:
+                self.poller.register(
+                    session.socket.fileno(),
+                    read=not self._is_backed_up(session),
+                    write=bool(session.output_chunks)
+                )
+
+    def serve_forever(self, timeout=0.05):
+        """Run the event loop until shutdown() is called.
+        """
+        self.running = True
+        while self.running:
+            self.run_once(timeout)
+
+    def shutdown(self):
+        """Stop serve_forever after the current tick.
+        """
+        self.running = False
+
+    def close(self):
+        """Disconnect everyone and stop listening.
+        """
+        for session in self.sessions_by_fd.values():
+            self.close_session(session)
+        self.poller.unregister(self.listen_socket.fileno())
+        self.listen_socket.close()
+        self.poller.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Host Fox and Geese missions for TCP clients.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('--mission', default="mission 1", help="The mission every client plays.")
+    parser.add_argument('--ai-processes', type=int, default=0, help="Make AI decisions in this many worker processes. 0 decides in the server process.")
+    parser.add_argument('--ai-time-budget', type=float, help="Seconds the AI gets to decide each turn.")
+    args = parser.parse_args(argv)
+
+    ai_pool = None
+    if args.ai_processes > 0:
+        ai_pool = multiprocessing.Pool(args.ai_processes)
+
+    game_server = GameServer(
+        host=args.host,
+        port=args.port,
+        mission_id=args.mission,
+        ai_pool=ai_pool,
+        ai_time_budget_seconds=args.ai_time_budget,
+        opening_book=load_campaign_book()
+    )
+    print "Serving %s on %s:%d" % ((args.mission,) + game_server.server_address)
+    try:
+        game_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        game_server.close()
+        if ai_pool:
+            ai_pool.terminate()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,277 @@
+"""A mission's board in shared memory, so AI worker processes can read it without pickling the MissionModel.
+
+The main process owns a SharedBoard and publishes the registry's columns to it each turn. Workers attach to the same
+file with attach(path), read only, and read the columns straight out of the mapped memory.
+
+The board is a file (in /dev/shm when there is one, so it never touches the disk) laid out as:
+    header: generation, map width, map height, slot count, capacity
+    positions_x: capacity int32s
+    positions_y: capacity int32s
+    type_codes: capacity bytes. See entity.ENTITY_TYPE_CODES. Empty slots are entity.NO_TYPE.
+    dead: capacity bytes. 1 if the Entity is dead.
+
+Columns are indexed by EntityRegistry slot. The generation goes up by 2 with every publish. It is odd while a publish
+is being written, so readers retry until they see the same even generation before and after reading.
+
+When the registry outgrows the board, publish doubles its capacity. The file grows and the columns move, so views map
+it again when they see the new capacity in the header.
+
+Boards are closed, and their files removed, at exit if they were not closed before. Workers keep only the last few
+views they attached, and drop the ones whose board is gone.
+"""
+import array
+import atexit
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+HEADER = struct.Struct('<QIIII')
+"""generation, width, height, slot count, capacity"""
+
+SHARED_MEMORY_DIRECTORY = '/dev/shm'
+
+READ_RETRY_SECONDS = 0.0001
+
+MAX_ATTACHED_VIEWS = 4
+"""How many views attach keeps open in each process."""
+
+INT32 = struct.Struct('<i')
+BYTE = struct.Struct('B')
+
+def _get_layout(capacity):
+    # Returns the offsets of the columns and the size of the board.
+    positions_x_offset = HEADER.size
+    positions_y_offset = positions_x_offset + 4 * capacity
+    type_codes_offset = positions_y_offset + 4 * capacity
+    dead_offset = type_codes_offset + capacity
+    size = dead_offset + capacity
+    return positions_x_offset, positions_y_offset, type_codes_offset, dead_offset, size
+
+class SharedBoard(object):
+    """The writable board, owned by the process that runs the MissionModel.
+    capacity: The most registry slots the board can hold.
+    path: The file to keep the board in. Defaults to a new temporary file, removed by close.
+    """
+    def __init__(self, capacity, path=None):
+        self.generation = 0
+        self.memory = None
+        self.owner_pid = os.getpid()
+
+        self.owns_path = path is None
+        if path is None:
+            directory = None
+            if os.path.isdir(SHARED_MEMORY_DIRECTORY):
+                directory = SHARED_MEMORY_DIRECTORY
+            file_descriptor, path = tempfile.mkstemp(prefix='fox_and_geese_board_', dir=directory)
+            os.close(file_descriptor)
+        self.path = path
+
+        self._map(capacity)
+        HEADER.pack_into(self.memory, 0, self.generation, 0, 0, 0, capacity)
+        _open_boards.add(self)
+
+    def _map(self, capacity):
+        # Size the file for capacity slots and map it, in place of any earlier mapping.
+        self.capacity = capacity
+        self.positions_x_offset, self.positions_y_offset, self.type_codes_offset, self.dead_offset, self.size = _get_layout(capacity)
+        file_descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        try:
+            os.ftruncate(file_descriptor, self.size)
+            memory = mmap.mmap(file_descriptor, self.size, access=mmap.ACCESS_WRITE)
+        finally:
+            os.close(file_descriptor)
+        if self.memory is not None:
+            self.memory.close()
+        self.memory = memory
+
+    def publish(self, mission_model):
+        """Write the mission's board. Returns the new generation.
+        Doubles the capacity first if the registry has more slots than the board holds.
+        """
+        registry = mission_model.all_entities_by_id
+        slot_count = len(registry.entities_by_slot)
+
+        positions_x = array.array('i', [x if x is not None else 0 for x in registry.positions_x])
+        positions_y = array.array('i', [y if y is not None else 0 for y in registry.positions_y])
+
+        # Empty slots have no type.
+        type_codes = array.array('B', registry.type_codes)
+        for slot in registry.free_slots:
+            type_codes[slot] = 0
+
+        memory = self.memory
+
+        # An odd generation tells readers a publish is in progress.
+        self.generation += 1
+        HEADER.pack_into(memory, 0, self.generation, mission_model.grid_width, mission_model.grid_height, slot_count, self.capacity)
+
+        # The columns move when the board grows. Views see the new capacity and map the file again.
+        if slot_count > self.capacity:
+            capacity = max(1, self.capacity)
+            while capacity < slot_count:
+                capacity *= 2
+            self._map(capacity)
+            memory = self.memory
+            HEADER.pack_into(memory, 0, self.generation, mission_model.grid_width, mission_model.grid_height, slot_count, self.capacity)
+
+        memory[self.positions_x_offset:self.positions_x_offset + 4 * slot_count] = positions_x.tostring()
+        memory[self.positions_y_offset:self.positions_y_offset + 4 * slot_count] = positions_y.tostring()
+        memory[self.type_codes_offset:self.type_codes_offset + slot_count] = type_codes.tostring()
+        memory[self.dead_offset:self.dead_offset + slot_count] = registry.dead.tostring()
+
+        self.generation += 1
+        HEADER.pack_into(memory, 0, self.generation, mission_model.grid_width, mission_model.grid_height, slot_count, self.capacity)
+        return self.generation
+
+    def close(self):
+        """Unmap the board, and remove its file if the board made it.
+        """
+        if self.memory is None:
+            return
+        self.memory.close()
+        self.memory = None
+        _open_boards.discard(self)
+        if self.owns_path and os.path.exists(self.path):
+            os.remove(self.path)
+
+class BoardView(object):
+    """A read only view of a SharedBoard, for worker processes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.memory = None
+        self._map()
+
+    def _map(self):
+        # Map the whole file, in place of any earlier mapping, and find the columns.
+        file_descriptor = os.open(self.path, os.O_RDONLY)
+        try:
+            size = os.fstat(file_descriptor).st_size
+            memory = mmap.mmap(file_descriptor, size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(file_descriptor)
+        if self.memory is not None:
+            self.memory.close()
+        self.memory = memory
+
+        self.capacity = HEADER.unpack_from(memory, 0)[4]
+        self.positions_x_offset, self.positions_y_offset, self.type_codes_offset, self.dead_offset, size = _get_layout(self.capacity)
+
+    def get_generation(self):
+        """Returns the generation of the board. Odd while it is being published.
+        """
+        return HEADER.unpack_from(self.memory, 0)[0]
+
+    def _read_consistently(self, read_columns, generation, timeout):
+        # Calls read_columns(slot count) until it reads a settled board of the generation. Returns the board dictionary.
+        give_up_time = time.time() + timeout
+        while True:
+            board_generation, width, height, slot_count, capacity = HEADER.unpack_from(self.memory, 0)
+            if board_generation % 2 == 0 and capacity != self.capacity:
+                # The board grew. Its columns moved.
+                self._map()
+                continue
+
+            if board_generation % 2 == 0 and (generation is None or board_generation == generation):
+                columns = read_columns(slot_count)
+
+                # The board did not change while it was read.
+                if HEADER.unpack_from(self.memory, 0)[0] == board_generation:
+                    positions_x, positions_y, type_codes, dead = columns
+                    return {
+                        'generation': board_generation,
+                        'width': width,
+                        'height': height,
+                        'positions x': positions_x,
+                        'positions y': positions_y,
+                        'type codes': type_codes,
+                        'dead': dead,
+                    }
+
+            if generation is not None and board_generation > generation and board_generation % 2 == 0:
+                raise ValueError("Board generation %d was replaced by %d." % (generation, board_generation))
+            if time.time() > give_up_time:
+                raise ValueError("Board %s did not reach generation %s." % (self.path, generation))
+            time.sleep(READ_RETRY_SECONDS)
+
+    def read(self, generation=None, timeout=1.0):
+        """Returns a dictionary with a consistent copy of the board:
+            generation, width, height: From the header.
+            positions x, positions y, type codes, dead: Tuples indexed by slot.
+        If generation is given, waits until the board has that generation.
+        Raises ValueError if the board does not settle before the timeout.
+        """
+        def read_columns(slot_count):
+            memory = self.memory
+            return (
+                struct.unpack_from('<%di' % slot_count, memory, self.positions_x_offset),
+                struct.unpack_from('<%di' % slot_count, memory, self.positions_y_offset),
+                struct.unpack_from('%dB' % slot_count, memory, self.type_codes_offset),
+                struct.unpack_from('%dB' % slot_count, memory, self.dead_offset),
+            )
+
+        return self._read_consistently(read_columns, generation, timeout)
+
+    def read_slots(self, slots, generation=None, timeout=1.0):
+        """Like read, but copies only the given slots. The columns are lists in the order of slots.
+        Raises ValueError if a slot is not on the board.
+        """
+        def read_columns(slot_count):
+            for slot in slots:
+                if not 0 <= slot < slot_count:
+                    raise ValueError("Slot %d is not on board %s." % (slot, self.path))
+            memory = self.memory
+            unpack_int32 = INT32.unpack_from
+            unpack_byte = BYTE.unpack_from
+            positions_x_offset = self.positions_x_offset
+            positions_y_offset = self.positions_y_offset
+            type_codes_offset = self.type_codes_offset
+            dead_offset = self.dead_offset
+            return (
+                [unpack_int32(memory, positions_x_offset + 4 * slot)[0] for slot in slots],
+                [unpack_int32(memory, positions_y_offset + 4 * slot)[0] for slot in slots],
+                [unpack_byte(memory, type_codes_offset + slot)[0] for slot in slots],
+                [unpack_byte(memory, dead_offset + slot)[0] for slot in slots],
+            )
+
+        return self._read_consistently(read_columns, generation, timeout)
+
+    def close(self):
+        if self.memory is None:
+            return
+        self.memory.close()
+        self.memory = None
+
+# Boards that have not been closed yet. Each process closes the ones it made at exit. Forked workers leave them alone.
+_open_boards = set()
+
+def _close_open_boards():
+    for board in list(_open_boards):
+        if board.owner_pid == os.getpid():
+            board.close()
+
+atexit.register(_close_open_boards)
+
+# Each worker process keeps its last few views open between tasks, most recently attached last.
+_views_by_path = {}
+_attached_paths = []
+
+def attach(path):
+    """Returns a BoardView of the board at path, reusing the one this process already has.
+    Views of boards that were removed, and all but the last MAX_ATTACHED_VIEWS views, are closed.
+    """
+    view = _views_by_path.get(path)
+    if view is None:
+        view = BoardView(path)
+        _views_by_path[path] = view
+    else:
+        _attached_paths.remove(path)
+    _attached_paths.append(path)
+
+    for attached_path in list(_attached_paths):
+        if attached_path != path and (len(_attached_paths) > MAX_ATTACHED_VIEWS or not os.path.exists(attached_path)):
+            _attached_paths.remove(attached_path)
+            _views_by_path.pop(attached_path).close()
+    return view
@@ -0,0 +1,151 @@
+"""Plays missions without a user interface.
+
+Only depends on the mission, entity and ai_controllers modules, so it starts quickly and does not need Kivy or a display.
+
+Usage:
+    python simulation.py --games 100 --fox-ai AlwaysWait --goose-ai ChaseTheFox
+
+Exits with SLOW_START_EXIT_STATUS if the games were played but startup took longer than COLD_START_TARGET_SECONDS.
+"""
+import time
+module_start_time = time.time()
+
+import argparse
+import importlib
+import sys
+
+import ai_controllers
+from metrics import MetricsFileWriter, SimulationMetrics
+from mission import MissionModel, MissionController, read_campaign, get_campaign_mission_ids, DEFAULT_CAMPAIGN_FILE
+
+COLD_START_TARGET_SECONDS = 0.5
+"""A batch simulation process should be ready to play within this many seconds of importing this module."""
+
+SLOW_START_EXIT_STATUS = 3
+"""The exit status of main when startup missed COLD_START_TARGET_SECONDS."""
+
+def setup_mission(mission_id, yaml_document, fox_ai_class=ai_controllers.AlwaysWait, goose_ai_class=ai_controllers.ChaseTheFox, opening_book=None):
+    """Load the mission and replace its AI controllers.
+    opening_book: An opening_book.OpeningBook for the AI controllers to use, if any.
+    Returns a MissionModel and a MissionController for it.
+    """
+    mission_model = MissionModel()
+    mission_model.load_mission(mission_id, yaml_document)
+    mission_model.opening_book = opening_book
+
+    # The mission gives the fox to the player. Hand it to an AI instead.
+    mission_model.all_ai_by_id['fox'] = fox_ai_class(mission_model, 'fox')
+
+    goose_ids = [entity_id for entity_id in mission_model.all_entities_by_id.get_entity_ids_in_order() if entity_id != 'fox']
+    mission_model.all_ai_by_id['goose'] = goose_ai_class(mission_model, goose_ids)
+
+    mission_controller = MissionController(mission_model=mission_model)
+    return mission_model, mission_controller
+
+def play_mission(mission_controller, max_turns=100, metrics=None):
+    """Play turns until the mission is complete or max_turns have passed.
+    If metrics (a metrics.SimulationMetrics) is given, the turns and the result are counted.
+    Returns a dictionary:
+        result: See MissionModel.get_mission_status
+        turns: The number of turns played.
+    """
+    if metrics:
+        metrics.watch(mission_controller)
+
+    result = 'not finished'
+    turns = 0
+    while turns < max_turns:
+        mission_controller.move_ai_entities()
+        turns += 1
+
+        result = mission_controller.get_status()['mission complete']
+        if result in ['player win', 'player lose']:
+            break
+
+        mission_controller.reset_for_new_round()
+
+    if metrics:
+        metrics.record_game(result)
+
+    return {
+        'result': result,
+        'turns': turns,
+    }
+
+def run_mission(mission_id, yaml_document, fox_ai_class=ai_controllers.AlwaysWait, goose_ai_class=ai_controllers.ChaseTheFox, max_turns=100, metrics=None):
+    """Load and play one mission.
+    Returns the dictionary from play_mission with the 'mission id' added.
+    """
+    mission_model, mission_controller = setup_mission(mission_id, yaml_document, fox_ai_class, goose_ai_class)
+    results = play_mission(mission_controller, max_turns, metrics)
+    results['mission id'] = mission_id
+    return results
+
+def get_ai_class(class_name):
+    """Returns the AIController subclass in ai_controllers with the given name.
+    Use module.ClassName for AIControllers in other modules.
+    """
+    module = ai_controllers
+    module_class_name = class_name
+    if '.' in class_name:
+        module_name, module_class_name = class_name.rsplit('.', 1)
+        module = importlib.import_module(module_name)
+    ai_class = getattr(module, module_class_name, None)
+    try:
+        is_ai_class = issubclass(ai_class, ai_controllers.AIController)
+    except TypeError:
+        is_ai_class = False
+
+    if not is_ai_class:
+        raise ValueError("%s is not an AIController" % class_name)
+    return ai_class
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play Fox and Geese missions without a user interface.")
+    parser.add_argument('--campaign', default=DEFAULT_CAMPAIGN_FILE, help="The campaign yaml file.")
+    parser.add_argument('--mission', action='append', dest='mission_ids', help="Mission id to play. Defaults to every mission in the campaign.")
+    parser.add_argument('--games', type=int, default=1, help="Games to play per mission.")
+    parser.add_argument('--max-turns', type=int, default=100, help="Stop a game after this many turns.")
+    parser.add_argument('--fox-ai', default='AlwaysWait', help="Name of the AIController controlling the fox.")
+    parser.add_argument('--goose-ai', default='ChaseTheFox', help="Name of the AIController controlling the geese.")
+    parser.add_argument('--metrics-directory', help="Periodically write this process's metrics here. See metrics.py to serve them.")
+    args = parser.parse_args(argv)
+
+    # Everything needed to play has been imported.
+    startup_seconds = time.time() - module_start_time
+
+    yaml_document = read_campaign(args.campaign)
+    mission_ids = args.mission_ids or get_campaign_mission_ids(yaml_document)
+    fox_ai_class = get_ai_class(args.fox_ai)
+    goose_ai_class = get_ai_class(args.goose_ai)
+
+    metrics = None
+    metrics_writer = None
+    if args.metrics_directory:
+        metrics = SimulationMetrics()
+        metrics_writer = MetricsFileWriter(metrics, args.metrics_directory)
+
+    play_start_time = time.time()
+    game_count = 0
+    for mission_id in mission_ids:
+        result_counts = {}
+        for game in xrange(args.games):
+            results = run_mission(mission_id, yaml_document, fox_ai_class, goose_ai_class, args.max_turns, metrics)
+            result_counts[results['result']] = result_counts.get(results['result'], 0) + 1
+            game_count += 1
+            if metrics_writer:
+                metrics_writer.maybe_write()
+        print "%s: %s" % (mission_id, ", ".join(["%s %d" % (result, result_counts[result]) for result in sorted(result_counts)]))
+    play_seconds = time.time() - play_start_time
+
+    if metrics_writer:
+        metrics_writer.write()
+
+    print "startup %.3fs (target %.3fs), played %d games in %.3fs" % (startup_seconds, COLD_START_TARGET_SECONDS, game_count, play_seconds)
+    if startup_seconds > COLD_START_TARGET_SECONDS:
+        sys.stderr.write("Startup took longer than the %.3fs target.\n" % COLD_START_TARGET_SECONDS)
+        return SLOW_START_EXIT_STATUS
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,221 @@
+"""Board symmetries, so searches can store one state for all of its mirror images.
+
+A rectangular map maps onto itself when mirrored in x, in y, or both. A square map can also be transposed or rotated a
+quarter turn, for eight symmetries in all. Terrain can break some of them, so only the transforms that leave the
+terrain alone are used.
+
+canonicalize picks the same state out of every mirror image of a mission, and the transform that leads to it:
+
+    symmetry = mission_model.get_symmetry()
+    state_key, transform = symmetry.canonicalize(mission_model)
+    canonical_directions = table.get(state_key)
+    if canonical_directions is not None:
+        directions = symmetry.restore_directions(canonical_directions, transform)
+
+Transposition tables, opening books and replays can then store states once, keyed by state_key.
+
+Each transform's cell map holds an int per cell of the map, and checking the terrain looks at every cell. So symmetries
+are for campaign sized maps, not very large ones. See chunked_grid.
+"""
+import array
+from operator import add
+
+from terrain import STEP_BY_DIRECTION
+
+DIRECTION_BY_STEP = dict([(step, direction) for direction, step in STEP_BY_DIRECTION.items()])
+DIRECTION_BY_STEP[(0, 0)] = 'W'
+
+TRANSFORM_NAMES = {
+    (False, False, False): 'identity',
+    (False, True, False): 'mirror x',
+    (False, False, True): 'mirror y',
+    (False, True, True): 'rotate 180',
+    (True, False, False): 'transpose',
+    (True, True, False): 'rotate 90',
+    (True, False, True): 'rotate 270',
+    (True, True, True): 'anti-transpose',
+}
+"""Names of the transforms, keyed by (swap_xy, mirror_x, mirror_y). Rotations are counterclockwise."""
+
+class BoardTransform(object):
+    """Maps cells and direction codes of a width x height map onto their mirror image.
+    Swaps x and y first if swap_xy, then mirrors.
+    """
+    def __init__(self, width, height, swap_xy=False, mirror_x=False, mirror_y=False):
+        self.width = width
+        self.height = height
+        self.swap_xy = swap_xy
+        self.mirror_x = mirror_x
+        self.mirror_y = mirror_y
+        self.name = TRANSFORM_NAMES[(swap_xy, mirror_x, mirror_y)]
+
+        # The size of the map after the transform.
+        if swap_xy:
+            self.output_width, self.output_height = height, width
+        else:
+            self.output_width, self.output_height = width, height
+
+        self._cell_map = None
+
+        self.direction_by_direction = {}
+        for (step_x, step_y), direction in DIRECTION_BY_STEP.items():
+            self.direction_by_direction[direction] = DIRECTION_BY_STEP[self.apply_step(step_x, step_y)]
+
+    def __repr__(self):
+        return "BoardTransform(%r)" % self.name
+
+    def is_identity(self):
+        return not (self.swap_xy or self.mirror_x or self.mirror_y)
+
+    def apply(self, x, y):
+        """Returns the cell (x, y) moves to.
+        """
+        if self.swap_xy:
+            x, y = y, x
+        if self.mirror_x:
+            x = self.output_width - 1 - x
+        if self.mirror_y:
+            y = self.output_height - 1 - y
+        return (x, y)
+
+    def apply_step(self, step_x, step_y):
+        """Returns the step (step_x, step_y) turns into.
+        """
+        if self.swap_xy:
+            step_x, step_y = step_y, step_x
+        if self.mirror_x:
+            step_x = -step_x
+        if self.mirror_y:
+            step_y = -step_y
+        return (step_x, step_y)
+
+    def apply_direction(self, direction):
+        """Returns the direction code direction turns into. 'W' stays 'W'.
+        """
+        return self.direction_by_direction[direction]
+
+    def get_cell_map(self):
+        """Returns an array with the cell each cell moves to. Cells are numbered y * width + x, as in terrain.TerrainGrid.
+        """
+        if self._cell_map is None:
+            output_width = self.output_width
+            cell_map = array.array('l')
+            for y in xrange(self.height):
+                for x in xrange(self.width):
+                    new_x, new_y = self.apply(x, y)
+                    cell_map.append(new_y * output_width + new_x)
+            self._cell_map = cell_map
+        return self._cell_map
+
+    def inverse(self):
+        """Returns the transform that undoes this one.
+        """
+        # Mirroring after a swap is the same as swapping after mirroring the other axis.
+        if self.swap_xy:
+            return BoardTransform(self.output_width, self.output_height, True, self.mirror_y, self.mirror_x)
+        return BoardTransform(self.width, self.height, False, self.mirror_x, self.mirror_y)
+
+def get_board_transforms(width, height):
+    """Returns the transforms that map a width x height map onto itself. The identity comes first.
+    """
+    swaps = [False]
+    if width == height:
+        swaps.append(True)
+    return [
+        BoardTransform(width, height, swap_xy, mirror_x, mirror_y)
+        for swap_xy in swaps
+        for mirror_x in (False, True)
+        for mirror_y in (False, True)
+    ]
+
+def _keeps_terrain(transform, terrain_grid):
+    terrain = terrain_grid.terrain
+    cell_map = transform.get_cell_map()
+    for cell in xrange(len(terrain)):
+        if terrain[cell] != terrain[cell_map[cell]]:
+            return False
+    return True
+
+class BoardSymmetry(object):
+    """The symmetries of one map and its terrain. See MissionModel.get_symmetry.
+
+    A state key is a sorted tuple with an int per living Entity: type code * cells on the map + y * width + x.
+    Entities of the same type are interchangeable, so they are not told apart. Types without a code of their own all
+    share entity.OTHER_TYPE.
+    """
+    def __init__(self, width, height, terrain_grid=None):
+        self.width = width
+        self.height = height
+        self.cell_count = width * height
+        self.transforms = get_board_transforms(width, height)
+        if terrain_grid is not None:
+            self.transforms = [transform for transform in self.transforms if _keeps_terrain(transform, terrain_grid)]
+
+    def _get_key(self, type_offsets, cells, transform):
+        if transform.is_identity():
+            return tuple(sorted(map(add, type_offsets, cells)))
+        return tuple(sorted(map(add, type_offsets, map(transform.get_cell_map().__getitem__, cells))))
+
+    def _canonicalize(self, type_offsets, cells):
+        best_key = None
+        best_transform = None
+        for transform in self.transforms:
+            state_key = self._get_key(type_offsets, cells, transform)
+            if best_key is None or state_key < best_key:
+                best_key = state_key
+                best_transform = transform
+        return best_key, best_transform
+
+    def _split_positions(self, positions):
+        cell_count = self.cell_count
+        width = self.width
+        type_offsets = [type_code * cell_count for type_code, x, y in positions]
+        cells = [y * width + x for type_code, x, y in positions]
+        return type_offsets, cells
+
+    def get_state_key(self, positions, transform):
+        """Returns the key of the state after the transform.
+        positions is a list of (type code, x, y) for the living Entities.
+        """
+        type_offsets, cells = self._split_positions(positions)
+        return self._get_key(type_offsets, cells, transform)
+
+    def canonicalize_positions(self, positions):
+        """Returns (state key, transform) for the smallest key among the mirror images of positions.
+        Every mirror image of a state gets the same key. The transform maps this state onto it.
+        """
+        type_offsets, cells = self._split_positions(positions)
+        return self._canonicalize(type_offsets, cells)
+
+    def canonicalize(self, mission_model):
+        """Returns (state key, transform) for the state of the mission's living Entities. See canonicalize_positions.
+        """
+        registry = mission_model.all_entities_by_id
+        positions_x = registry.positions_x
+        positions_y = registry.positions_y
+        type_codes = registry.type_codes
+        dead = registry.dead
+        cell_count = self.cell_count
+        width = self.width
+
+        slots = [slot for slot in registry.get_occupied_slots() if not dead[slot]]
+        type_offsets = [type_codes[slot] * cell_count for slot in slots]
+        cells = [positions_y[slot] * width + positions_x[slot] for slot in slots]
+        return self._canonicalize(type_offsets, cells)
+
+    def transform_directions(self, directions, transform):
+        """Returns the direction codes as seen after the transform.
+        """
+        apply_direction = transform.apply_direction
+        return [apply_direction(direction) for direction in directions]
+
+    def restore_directions(self, canonical_directions, transform):
+        """Returns the direction codes chosen in the canonical state, as moves in the state canonicalize was given.
+        """
+        return self.transform_directions(canonical_directions, transform.inverse())
+
+    def restore_moves(self, canonical_moves_by_entity_id, transform):
+        """Like restore_directions, for a dictionary of direction codes by entity id.
+        """
+        apply_direction = transform.inverse().apply_direction
+        return dict([(entity_id, apply_direction(direction)) for entity_id, direction in canonical_moves_by_entity_id.items()])
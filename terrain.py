@@ -0,0 +1,182 @@
+"""Terrain for missions, and pathfinding around it.
+
+A mission may add a terrain layer to its yaml. Rows are listed top (the highest y) first, one character per cell:
+
+    terrain:
+      rows:
+        - "....."
+        - ".#~#."
+        - "....."
+
+See TERRAIN_BY_CHARACTER for the characters. Walls and water cannot be entered.
+Without a terrain layer every cell is open.
+
+Terrain takes memory and time in proportion to the map area, unlike the Entities (see chunked_grid). TerrainGrid keeps
+two bytes per cell, get_neighbors a list per cell, and every distance field an int per cell, found by a search over
+the whole map. Very large maps should have no terrain.
+"""
+import array
+import collections
+
+OPEN = 0
+WALL = 1
+WATER = 2
+
+TERRAIN_BY_CHARACTER = {
+    '.': OPEN,
+    '#': WALL,
+    '~': WATER,
+}
+
+IMPASSABLE_TERRAIN = set([WALL, WATER])
+
+# The step each direction code takes. The same directions MissionModel.try_to_move_entity accepts.
+STEPS_BY_DIRECTION = [
+    ('UL', -1, 1),
+    ('U', 0, 1),
+    ('UR', 1, 1),
+    ('L', -1, 0),
+    ('R', 1, 0),
+    ('DL', -1, -1),
+    ('D', 0, -1),
+    ('DR', 1, -1),
+]
+
+STEP_BY_DIRECTION = dict([(direction, (step_x, step_y)) for direction, step_x, step_y in STEPS_BY_DIRECTION])
+
+UNREACHABLE = -1
+
+class TerrainGrid(object):
+    """The terrain of every cell of a map, and whether it can be entered.
+    Cells are numbered y * width + x.
+    """
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.terrain = bytearray(width * height)
+        self.passable = bytearray('\x01' * (width * height))
+        self._neighbors = None
+
+    @classmethod
+    def from_rows(cls, rows, width, height):
+        """Returns a TerrainGrid for yaml rows listed top first. Missing rows and columns are open.
+        """
+        terrain_grid = cls(width, height)
+        for row_index, row in enumerate(rows):
+            y = height - 1 - row_index
+            if y < 0:
+                raise ValueError("The terrain has more rows than the map height %d." % height)
+            for x, character in enumerate(row):
+                if x >= width:
+                    raise ValueError("Terrain row %d is wider than the map width %d." % (row_index, width))
+                if not character in TERRAIN_BY_CHARACTER:
+                    raise ValueError("Unknown terrain %r at (%d, %d). Expected one of %s." % (character, x, y, "".join(sorted(TERRAIN_BY_CHARACTER))))
+                terrain_grid.set_terrain(x, y, TERRAIN_BY_CHARACTER[character])
+        return terrain_grid
+
+    def set_terrain(self, x, y, terrain):
+        cell = y * self.width + x
+        self.terrain[cell] = terrain
+        self.passable[cell] = 0 if terrain in IMPASSABLE_TERRAIN else 1
+        self._neighbors = None
+
+    def is_passable(self, x, y):
+        """Returns True if the cell is on the map and can be entered.
+        """
+        if x < 0 or y < 0 or x >= self.width or y >= self.height:
+            return False
+        return self.passable[y * self.width + x] == 1
+
+    def get_neighbors(self):
+        """Returns a list with the passable neighbor cells of each cell. Built once per terrain.
+        """
+        if self._neighbors is None:
+            width = self.width
+            height = self.height
+            passable = self.passable
+            neighbors = []
+            for y in xrange(height):
+                # Only the steps that stay on the map.
+                row_steps = [(step_x, step_y * width + step_x) for direction, step_x, step_y in STEPS_BY_DIRECTION if 0 <= y + step_y < height]
+                for x in xrange(width):
+                    cell = y * width + x
+                    neighbors.append([
+                        cell + cell_step
+                        for step_x, cell_step in row_steps
+                        if 0 <= x + step_x < width and passable[cell + cell_step]
+                    ])
+            self._neighbors = neighbors
+        return self._neighbors
+
+class PathfindingService(object):
+    """Shared by the AI controllers of a mission. Finds the distance of every cell to a target cell, around the terrain.
+    Keeps the distance fields of the most recently used cache_size targets.
+    """
+    def __init__(self, terrain_grid, cache_size=64):
+        self.terrain_grid = terrain_grid
+        self.cache_size = cache_size
+        self.distance_fields_by_target = collections.OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def get_distance_field(self, target_x, target_y):
+        """Returns an array with the number of moves from every cell to the target. UNREACHABLE for cells that cannot get there.
+        """
+        target_cell = target_y * self.terrain_grid.width + target_x
+        distance_field = self.distance_fields_by_target.pop(target_cell, None)
+        if distance_field is None:
+            self.cache_misses += 1
+            distance_field = self._find_distances(target_cell)
+            if len(self.distance_fields_by_target) >= self.cache_size:
+                self.distance_fields_by_target.popitem(last=False)
+        else:
+            self.cache_hits += 1
+
+        # The most recently used target goes last.
+        self.distance_fields_by_target[target_cell] = distance_field
+        return distance_field
+
+    def _find_distances(self, target_cell):
+        # Breadth first search out from the target. Moves are symmetric, so this is the distance to the target.
+        neighbors = self.terrain_grid.get_neighbors()
+        distances = array.array('i', [UNREACHABLE]) * len(neighbors)
+        distances[target_cell] = 0
+        frontier = collections.deque([target_cell])
+        while frontier:
+            cell = frontier.popleft()
+            next_distance = distances[cell] + 1
+            for neighbor in neighbors[cell]:
+                if distances[neighbor] == UNREACHABLE:
+                    distances[neighbor] = next_distance
+                    frontier.append(neighbor)
+        return distances
+
+    def get_directions(self, target_x, target_y, positions_x, positions_y, preferred_directions):
+        """Returns a list with the direction code that brings each position one move closer to the target.
+        preferred_directions has a direction for each position, taken whenever it is one of the closer moves.
+        Positions that are on the target or cannot reach it keep their preferred direction.
+        """
+        distance_field = self.get_distance_field(target_x, target_y)
+        width = self.terrain_grid.width
+        neighbors = self.terrain_grid.get_neighbors()
+
+        directions = []
+        for x, y, preferred_direction in zip(positions_x, positions_y, preferred_directions):
+            cell = y * width + x
+            distance = distance_field[cell]
+            if distance <= 0:
+                directions.append(preferred_direction)
+                continue
+
+            # One of the passable neighbors is always a move closer.
+            closer_cells = set([neighbor for neighbor in neighbors[cell] if distance_field[neighbor] == distance - 1])
+            step_x, step_y = STEP_BY_DIRECTION.get(preferred_direction, (0, 0))
+            if cell + step_y * width + step_x in closer_cells and 0 <= x + step_x < width:
+                directions.append(preferred_direction)
+                continue
+
+            for direction, step_x, step_y in STEPS_BY_DIRECTION:
+                if cell + step_y * width + step_x in closer_cells and 0 <= x + step_x < width:
+                    directions.append(direction)
+                    break
+        return directions
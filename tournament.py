@@ -0,0 +1,303 @@
+"""Plays fox AIs against goose AIs on every mission of a campaign, in parallel.
+
+Every fox AI plays every goose AI on every mission. Each finished game is appended to a results file as one line of JSON,
+so an interrupted tournament picks up where it left off when run again with the same results file.
+
+Usage:
+    python tournament.py --fox-ai AlwaysWait --goose-ai ChaseTheFox --goose-ai AlwaysWait --games 20 --results results.jsonl
+    python tournament.py --fox-ai my_ai.LookAhead --goose-ai ChaseTheFox --results results.jsonl --processes 8
+
+AI names are looked up like simulation.get_ai_class, so your own AIControllers can be given as module.ClassName.
+The campaign's opening book is used if there is one. See opening_book.py.
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import sys
+import timeit
+
+from mission import read_campaign, get_campaign_mission_ids, DEFAULT_CAMPAIGN_FILE
+from opening_book import OpeningBook, load_campaign_book
+from simulation import get_ai_class, setup_mission
+
+CONFIDENCE_Z = 1.96
+"""z score of the 95% confidence intervals reported for win rates."""
+
+def make_matches(fox_ai_names, goose_ai_names, mission_ids, games=1):
+    """Returns a list of every game to play, as dictionaries:
+        match: A key unique to the game, used to resume.
+        fox ai, goose ai: AI names. See simulation.get_ai_class
+        mission id: The mission to play.
+        game: The game number, starting at 0.
+    """
+    matches = []
+    for mission_id in mission_ids:
+        for fox_ai_name in fox_ai_names:
+            for goose_ai_name in goose_ai_names:
+                for game in xrange(games):
+                    matches.append({
+                        'match': "%s|%s|%s|%d" % (mission_id, fox_ai_name, goose_ai_name, game),
+                        'fox ai': fox_ai_name,
+                        'goose ai': goose_ai_name,
+                        'mission id': mission_id,
+                        'game': game,
+                    })
+    return matches
+
+# Each worker process reads the campaign and opens the opening book once.
+_worker_yaml_document = None
+_worker_opening_book = None
+
+def _init_worker(yaml_document, opening_book_path=None):
+    global _worker_yaml_document, _worker_opening_book
+    _worker_yaml_document = yaml_document
+    _worker_opening_book = None
+    if opening_book_path:
+        _worker_opening_book = OpeningBook(opening_book_path)
+
+def play_match(match, yaml_document=None, max_turns=100, opening_book=None):
+    """Play one game from make_matches. Uses the worker's campaign if yaml_document is not given.
+    opening_book: An opening_book.OpeningBook the AIs look their first moves up in, if any.
+    Returns the match dictionary with these added:
+        result: See MissionModel.get_mission_status
+        turns: The number of turns played.
+        fox ai seconds, goose ai seconds: Time each side spent deciding its moves.
+    """
+    if yaml_document is None:
+        yaml_document = _worker_yaml_document
+
+    mission_model, mission_controller = setup_mission(
+        match['mission id'],
+        yaml_document,
+        get_ai_class(match['fox ai']),
+        get_ai_class(match['goose ai']),
+        opening_book
+    )
+    ai_controllers_by_side = [
+        ('fox ai seconds', mission_model.all_ai_by_id['fox']),
+        ('goose ai seconds', mission_model.all_ai_by_id['goose']),
+    ]
+    ai_seconds = {'fox ai seconds': 0.0, 'goose ai seconds': 0.0}
+
+    result = 'not finished'
+    turns = 0
+    while turns < max_turns:
+        # Time each side's decision separately.
+        for side, ai_controller in ai_controllers_by_side:
+            start_time = timeit.default_timer()
+            if not ai_controller.use_book_moves():
+                ai_controller.determine_next_moves()
+            ai_seconds[side] += timeit.default_timer() - start_time
+
+        mission_controller.move_ai_entities(ask_ai_for_moves=False)
+        turns += 1
+
+        result = mission_controller.get_status()['mission complete']
+        if result in ['player win', 'player lose']:
+            break
+
+        mission_controller.reset_for_new_round()
+
+    match_result = dict(match)
+    match_result.update(ai_seconds)
+    match_result['result'] = result
+    match_result['turns'] = turns
+    return match_result
+
+def _play_match_task(task):
+    # Process pool friendly wrapper. task is a tuple of (match, max_turns).
+    match, max_turns = task
+    return play_match(match, max_turns=max_turns, opening_book=_worker_opening_book)
+
+def read_results(results_file):
+    """Returns the match results already written to the results file. A half written last line is ignored.
+    """
+    results = []
+    if not os.path.exists(results_file):
+        return results
+
+    with open(results_file) as results_lines:
+        for line in results_lines:
+            try:
+                results.append(json.loads(line))
+            except ValueError:
+                # The tournament was interrupted while writing this line.
+                break
+    return results
+
+def _truncate_partial_line(results_file):
+    # Drop anything after the last complete line, so new results start on a line of their own.
+    if not os.path.exists(results_file):
+        return
+    with open(results_file, 'rb+') as results_lines:
+        content = results_lines.read()
+        complete_size = content.rfind("\n") + 1
+        if complete_size < len(content):
+            results_lines.truncate(complete_size)
+
+def run_tournament(matches, yaml_document, results_file, processes=None, max_turns=100, chunk_size=None, progress=None, opening_book_path=None):
+    """Play every match that is not in the results file yet, appending each result to the file as it finishes.
+    processes: Worker processes to use. Defaults to one per CPU. 0 plays in this process.
+    opening_book_path: An opening book file for the AIs to look their first moves up in. See opening_book.
+    chunk_size: Matches handed to a worker at a time. Defaults to a size that keeps every worker busy until the end.
+    progress: Called with each new result.
+    Returns every result for the matches, including the ones from earlier runs.
+    """
+    _truncate_partial_line(results_file)
+    match_keys = set([match['match'] for match in matches])
+    results = [result for result in read_results(results_file) if result['match'] in match_keys]
+    finished_keys = set([result['match'] for result in results])
+    tasks = [(match, max_turns) for match in matches if not match['match'] in finished_keys]
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    pool = None
+    if processes > 0 and tasks:
+        pool = multiprocessing.Pool(processes, _init_worker, (yaml_document, opening_book_path))
+        if chunk_size is None:
+            # Small enough chunks that no worker is left with a long queue at the end.
+            chunk_size = max(1, len(tasks) / (processes * 4))
+        new_results = pool.imap_unordered(_play_match_task, tasks, chunk_size)
+    else:
+        _init_worker(yaml_document, opening_book_path)
+        new_results = (_play_match_task(task) for task in tasks)
+
+    try:
+        with open(results_file, 'a') as results_lines:
+            for result in new_results:
+                results_lines.write(json.dumps(result, sort_keys=True) + "\n")
+                results_lines.flush()
+                results.append(result)
+                if progress:
+                    progress(result)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    return results
+
+def wilson_interval(successes, trials, z=CONFIDENCE_Z):
+    """Returns the (low, high) Wilson score interval for a success rate. (0.0, 1.0) if there were no trials.
+    """
+    if trials == 0:
+        return (0.0, 1.0)
+    rate = successes / float(trials)
+    denominator = 1 + z * z / trials
+    center = (rate + z * z / (2 * trials)) / denominator
+    spread = z * math.sqrt(rate * (1 - rate) / trials + z * z / (4 * trials * trials)) / denominator
+    return (max(0.0, center - spread), min(1.0, center + spread))
+
+def summarize_results(results):
+    """Returns a list of summaries, one per fox AI and goose AI pairing, sorted by fox win rate:
+        fox ai, goose ai: AI names.
+        games: Games played.
+        fox wins, goose wins, unfinished: Counts of each result. The fox is the player.
+        fox win rate: Fox wins over games.
+        fox win interval: 95% confidence interval of the fox win rate.
+        average turns: Average game length.
+        fox ai seconds per turn, goose ai seconds per turn: Average time each side took to decide a move.
+    """
+    summaries_by_pairing = {}
+    for result in results:
+        pairing = (result['fox ai'], result['goose ai'])
+        if not pairing in summaries_by_pairing:
+            summaries_by_pairing[pairing] = {
+                'fox ai': result['fox ai'],
+                'goose ai': result['goose ai'],
+                'games': 0,
+                'fox wins': 0,
+                'goose wins': 0,
+                'unfinished': 0,
+                'turns': 0,
+                'fox ai seconds': 0.0,
+                'goose ai seconds': 0.0,
+            }
+        summary = summaries_by_pairing[pairing]
+        summary['games'] += 1
+        summary['turns'] += result['turns']
+        summary['fox ai seconds'] += result['fox ai seconds']
+        summary['goose ai seconds'] += result['goose ai seconds']
+        if result['result'] == 'player win':
+            summary['fox wins'] += 1
+        elif result['result'] == 'player lose':
+            summary['goose wins'] += 1
+        else:
+            summary['unfinished'] += 1
+
+    summaries = []
+    for summary in summaries_by_pairing.values():
+        turns = summary.pop('turns')
+        fox_ai_seconds = summary.pop('fox ai seconds')
+        goose_ai_seconds = summary.pop('goose ai seconds')
+        summary['fox win rate'] = summary['fox wins'] / float(summary['games'])
+        summary['fox win interval'] = wilson_interval(summary['fox wins'], summary['games'])
+        summary['average turns'] = turns / float(summary['games'])
+        summary['fox ai seconds per turn'] = fox_ai_seconds / turns if turns else 0.0
+        summary['goose ai seconds per turn'] = goose_ai_seconds / turns if turns else 0.0
+        summaries.append(summary)
+
+    summaries.sort(key=lambda summary: (-summary['fox win rate'], summary['fox ai'], summary['goose ai']))
+    return summaries
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play fox AIs against goose AIs on every mission of a campaign.")
+    parser.add_argument('--campaign', default=DEFAULT_CAMPAIGN_FILE, help="The campaign yaml file.")
+    parser.add_argument('--mission', action='append', dest='mission_ids', help="Mission id to play. Defaults to every mission in the campaign.")
+    parser.add_argument('--fox-ai', action='append', dest='fox_ai_names', help="AIController for the fox. May be repeated.")
+    parser.add_argument('--goose-ai', action='append', dest='goose_ai_names', help="AIController for the geese. May be repeated.")
+    parser.add_argument('--games', type=int, default=1, help="Games per pairing per mission.")
+    parser.add_argument('--max-turns', type=int, default=100, help="Stop a game after this many turns.")
+    parser.add_argument('--results', required=True, help="Append results to this JSON lines file. Matches already in it are skipped.")
+    parser.add_argument('--processes', type=int, help="Worker processes. Defaults to one per CPU.")
+    parser.add_argument('--chunk-size', type=int, help="Matches handed to a worker at a time.")
+    parser.add_argument('--no-opening-book', action='store_true', help="Ignore the campaign's opening book. See opening_book.py.")
+    args = parser.parse_args(argv)
+
+    fox_ai_names = args.fox_ai_names or ['AlwaysWait']
+    goose_ai_names = args.goose_ai_names or ['ChaseTheFox']
+
+    # Fail before starting any workers if an AI name is wrong.
+    for ai_name in fox_ai_names + goose_ai_names:
+        get_ai_class(ai_name)
+
+    yaml_document = read_campaign(args.campaign)
+    mission_ids = args.mission_ids or get_campaign_mission_ids(yaml_document)
+    matches = make_matches(fox_ai_names, goose_ai_names, mission_ids, args.games)
+
+    # Use the campaign's opening book if it is up to date.
+    opening_book_path = None
+    if not args.no_opening_book:
+        opening_book = load_campaign_book(args.campaign, yaml_document)
+        if opening_book is not None:
+            opening_book_path = opening_book.path
+            opening_book.close()
+
+    results = run_tournament(
+        matches,
+        yaml_document,
+        args.results,
+        processes=args.processes,
+        max_turns=args.max_turns,
+        chunk_size=args.chunk_size,
+        opening_book_path=opening_book_path
+    )
+
+    print "%-24s %-24s %6s %6s %6s %6s %15s %8s %12s %12s" % (
+        "fox ai", "goose ai", "games", "fox", "geese", "none", "fox win (95%)", "turns", "fox ai/turn", "goose ai/turn"
+    )
+    for summary in summarize_results(results):
+        print "%-24s %-24s %6d %6d %6d %6d %4.2f %4.2f-%4.2f %8.1f %10.1fus %10.1fus" % (
+            summary['fox ai'], summary['goose ai'], summary['games'],
+            summary['fox wins'], summary['goose wins'], summary['unfinished'],
+            summary['fox win rate'], summary['fox win interval'][0], summary['fox win interval'][1],
+            summary['average turns'],
+            summary['fox ai seconds per turn'] * 1e6, summary['goose ai seconds per turn'] * 1e6
+        )
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,38 @@
 from mock import patch, Mock
+import cPickle
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
 
 import yaml
 
-from mission import MissionModel, MissionController, MissionView
-from entity import Entity, FoxCollisionResolver, GooseCollisionResolver
+from mission import MissionModel, MissionController, MissionView, read_campaign
+from entity import Entity, EntityRegistry, FoxCollisionResolver, GooseCollisionResolver
 import ai_controllers
+import benchmarks
+import chunked_grid
+import entity as entity_module
+import metrics
+import mission_state
+import opening_book
+import profiling
+import server
+import shared_board
+import simulation
+import symmetry
+import terrain
+import tournament
+import wire_protocol
 
 class EntityMovementTest(unittest.TestCase):
     def setUp(self):
@@ -507,8 +534,11 @@ class FoxGooseCollisionBehavior(unittest.TestCase):
         # Check for collisions
         self.mission_model.find_collisions()
 
-        # Ask Mission Controller for entities to act on the collisions
-        self.mission_model.resolve_collisions()
+        # Ask Mission Controller for entities to act on the collisions. The retreat is one move, not one per axis.
+        registry = self.mission_model.all_entities_by_id
+        with patch.object(registry, 'set_position', wraps=registry.set_position) as set_position:
+            self.mission_model.resolve_collisions()
+        set_position.assert_called_once_with(self.goose_2.slot, 1, 1)
 
         # Goose 0 should not have moved
         self.assertEqual(self.goose_0.position_x, 0)
@@ -640,6 +670,886 @@ class GroupAITests(unittest.TestCase):
             'fox':'DR'
         })
 
+    def test_chase_follows_moves(self):
+        """The geese keep chasing after the fox and the geese move.
+        """
+        self.mission_model.try_to_move_entity(id='fox', direction='UR')
+        self.mission_model.try_to_move_entity(id='goose_000', direction='R')
+        self.mission_model.move_all_entities()
+
+        self.mission_model.ask_all_ai_for_next_move()
+        goose_ai = self.mission_model.all_ai_by_id['goose']
+        self.assertEqual(goose_ai.get_next_moves(), {
+            'goose_000':'UR',
+            'goose_001':'L',
+            'goose_002':'U'
+        })
+        self.assertEqual(goose_ai.get_next_moves(), goose_ai.decide_from_snapshot(goose_ai.get_decision_snapshot()))
+
+    def test_chase_before_geese_added(self):
+        """The chasing AI can be made before its geese are in the mission.
+        """
+        mission_model = MissionModel(width=5, height=5)
+        goose_ai = ai_controllers.ChaseTheFox(mission_model, ['goose_000'])
+        mission_model.all_entities_by_id['fox'] = Entity(position={'x':4, 'y':4}, entity_type='fox')
+        mission_model.all_entities_by_id['goose_000'] = Entity(position={'x':0, 'y':0}, entity_type='goose')
+
+        goose_ai.determine_next_moves()
+        self.assertEqual(goose_ai.get_next_moves(), {'goose_000': 'UR'})
+
+    def test_chase_follows_direct_writes(self):
+        """Geese moved by setting their positions are chased from where they are now.
+        """
+        goose_ai = self.mission_model.all_ai_by_id['goose']
+        goose_ai.determine_next_moves()
+        goose = self.mission_model.all_entities_by_id['goose_000']
+        fox = self.mission_model.all_entities_by_id['fox']
+        goose.position_x = fox.position_x
+        goose.position_y = fox.position_y + 1
+
+        goose_ai.determine_next_moves()
+        self.assertEqual(goose_ai.get_next_moves()['goose_000'], 'D')
+
+    def test_chase_after_delete(self):
+        """Deleting a goose moves the last goose into its place. Every remaining goose keeps its own position.
+        """
+        goose_ai = self.mission_model.all_ai_by_id['goose']
+        goose_ai.delete_entities(['goose_000', 'fox'])
+        self.assertEqual(sorted(goose_ai.entity_ids), ['goose_001', 'goose_002'])
+
+        self.mission_model.ask_all_ai_for_next_move()
+        self.assertEqual(goose_ai.get_next_moves(), {
+            'goose_001':'DL',
+            'goose_002':'L'
+        })
+
+        goose_ai.delete_entities(['goose_001', 'goose_002'])
+        self.mission_model.ask_all_ai_for_next_move()
+        self.assertEqual(goose_ai.get_next_moves(), {})
+        self.assertEqual(goose_ai.decide_from_snapshot(goose_ai.get_decision_snapshot()), {})
+
+    def test_next_moves_by_slot(self):
+        """The moves by slot match the moves by id, before and after the geese are looked up and one is deleted.
+        """
+        registry = self.mission_model.all_entities_by_id
+        goose_ai = self.mission_model.all_ai_by_id['goose']
+        goose_ai.set_next_moves({'goose_000': 'R', 'goose_002': 'L'})
+        self.assertEqual(goose_ai.get_next_moves_by_slot(), {self.goose_0.slot: 'R', self.goose_2.slot: 'L'})
+
+        goose_ai.delete_entities(['goose_000'])
+        self.mission_model.ask_all_ai_for_next_move()
+        moves_by_slot = dict([(registry.get_slot(entity_id), direction) for entity_id, direction in goose_ai.get_next_moves().items()])
+        self.assertEqual(goose_ai.get_next_moves_by_slot(), moves_by_slot)
+        self.assertEqual(self.mission_model.all_ai_by_id['fox'].get_next_moves_by_slot(), {self.fox_entity.slot: 'W'})
+
+class SlowChaseTheFox(ai_controllers.ChaseTheFox):
+    """Proposes the usual moves right away, then keeps thinking until told to stop.
+    """
+    def determine_next_moves(self):
+        self.propose_moves(self.decide_from_snapshot(self.get_decision_snapshot()))
+        while not self.should_stop():
+            time.sleep(0.001)
+        self.stopped = True
+
+class ProposingAI(ai_controllers.AlwaysWait):
+    """Only proposes moves, taking the next of its planned moves each turn.
+    """
+    def determine_next_moves(self):
+        self.propose_moves(self.planned_moves.pop(0))
+
+class StubbornAI(ai_controllers.AlwaysWait):
+    """Ignores cancellation and never proposes anything.
+    """
+    decides_at_once = False
+
+    def determine_next_moves(self):
+        self.release.wait(1.0)
+
+class LateMovesAI(ai_controllers.AlwaysWait):
+    """Ignores cancellation, then sets and proposes moves once released.
+    """
+    decides_at_once = False
+
+    def determine_next_moves(self):
+        self.release.wait(1.0)
+        self.propose_moves({'goose_000': 'R'})
+        self.set_next_moves({'goose_000': 'R', 'goose_001': 'R'})
+
+class AITimeBudgetTests(unittest.TestCase):
+    """Tests the mission model enforces the AI time budget.
+    """
+    def setUp(self):
+        self.mission_model = MissionModel(width=5, height=2)
+        self.mission_model.all_entities_by_id['fox'] = Entity(position={'x':2, 'y':0}, entity_type='fox')
+        self.mission_model.all_entities_by_id['goose_000'] = Entity(position={'x':0, 'y':0}, entity_type='goose')
+        self.mission_model.all_entities_by_id['goose_001'] = Entity(position={'x':4, 'y':1}, entity_type='goose')
+        self.mission_model.all_ai_by_id['fox'] = ai_controllers.AlwaysWait(self.mission_model, 'fox')
+        self.mission_model.ai_time_budget_seconds = 0.05
+
+    def test_late_ai_uses_best_moves(self):
+        """An AI still thinking at the deadline is cancelled and its best moves so far are used.
+        """
+        slow_ai = SlowChaseTheFox(self.mission_model, ['goose_000', 'goose_001'])
+        self.mission_model.all_ai_by_id['goose'] = slow_ai
+
+        start_time = time.time()
+        self.mission_model.ask_all_ai_for_next_move()
+        self.assertTrue(time.time() - start_time < 0.5)
+
+        self.assertEqual(slow_ai.get_next_moves(), {'goose_000': 'R', 'goose_001': 'DL'})
+        self.assertEqual(self.mission_model.timed_out_ai_ids, ['goose'])
+        self.assertEqual(self.mission_model.all_ai_by_id['fox'].get_next_moves(), {'fox': 'W'})
+
+    def test_proposed_moves_every_turn(self):
+        """An AI that only proposes moves plays the ones it proposed this turn, not last turn's.
+        """
+        proposing_ai = ProposingAI(self.mission_model, ['goose_000'])
+        proposing_ai.planned_moves = [{'goose_000': 'R'}, {'goose_000': 'L'}]
+        self.mission_model.all_ai_by_id['goose'] = proposing_ai
+        self.mission_model.ai_time_budget_seconds = None
+
+        self.mission_model.ask_all_ai_for_next_move()
+        self.assertEqual(proposing_ai.get_next_moves(), {'goose_000': 'R'})
+        self.mission_model.ask_all_ai_for_next_move()
+        self.assertEqual(proposing_ai.get_next_moves(), {'goose_000': 'L'})
+
+    def test_stubborn_ai_waits(self):
+        """An AI that proposed nothing and ignores cancellation waits, and is not asked again while it is busy.
+        """
+        stubborn_ai = StubbornAI(self.mission_model, ['goose_000', 'goose_001'])
+        stubborn_ai.release = threading.Event()
+        self.mission_model.all_ai_by_id['goose'] = stubborn_ai
+
+        self.mission_model.ask_all_ai_for_next_move()
+        self.assertEqual(stubborn_ai.get_next_moves(), {'goose_000': 'W', 'goose_001': 'W'})
+        decision_worker = self.mission_model._decision_workers_by_ai_id['goose']
+        self.assertTrue(decision_worker.is_busy())
+
+        with patch.object(decision_worker, 'decide') as decide:
+            self.mission_model.ask_all_ai_for_next_move()
+        self.assertFalse(decide.called)
+        self.assertEqual(self.mission_model.timed_out_ai_ids, ['goose'])
+
+        stubborn_ai.release.set()
+        decision_worker.join()
+        self.mission_model.stop_decision_workers()
+        decision_worker.thread.join()
+
+    def test_stale_decision_dropped(self):
+        """Moves from a decision that outlived its turn are dropped, even if it finishes while the next turn waits.
+        """
+        late_ai = LateMovesAI(self.mission_model, ['goose_000', 'goose_001'])
+        late_ai.release = threading.Event()
+        self.mission_model.all_ai_by_id['goose'] = late_ai
+
+        self.mission_model.ask_all_ai_for_next_move()
+        decision_worker = self.mission_model._decision_workers_by_ai_id['goose']
+
+        # The old decision finishes halfway through the next turn's budget.
+        release_timer = threading.Timer(0.02, late_ai.release.set)
+        release_timer.start()
+        self.mission_model.ask_all_ai_for_next_move()
+        decision_worker.join()
+        release_timer.join()
+
+        self.assertEqual(self.mission_model.timed_out_ai_ids, ['goose'])
+        self.assertEqual(late_ai.get_next_moves(), {'goose_000': 'W', 'goose_001': 'W'})
+        self.assertEqual(late_ai.best_moves_by_entity_id, {})
+
+    def test_worker_thread_reused(self):
+        """Each controller decides on the same thread every turn, and a new controller gets a new one.
+        """
+        goose_ai = ai_controllers.ChaseTheFox(self.mission_model, ['goose_000', 'goose_001'])
+        self.mission_model.all_ai_by_id['goose'] = goose_ai
+        self.mission_model.ask_all_ai_for_next_move()
+        decision_worker = self.mission_model._decision_workers_by_ai_id['goose']
+        self.mission_model.ask_all_ai_for_next_move()
+        self.assertIs(self.mission_model._decision_workers_by_ai_id['goose'], decision_worker)
+        self.assertEqual(goose_ai.get_next_moves(), {'goose_000': 'R', 'goose_001': 'DL'})
+
+        self.mission_model.all_ai_by_id['goose'] = ai_controllers.ChaseTheFox(self.mission_model, ['goose_000', 'goose_001'])
+        self.mission_model.ask_all_ai_for_next_move()
+        self.assertIsNot(self.mission_model._decision_workers_by_ai_id['goose'], decision_worker)
+        decision_worker.thread.join(1.0)
+        self.assertFalse(decision_worker.thread.is_alive())
+
+        # Controllers that decide at once do not need a thread.
+        self.assertNotIn('fox', self.mission_model._decision_workers_by_ai_id)
+        self.mission_model.stop_decision_workers()
+
+    def test_instructions_decide_at_once(self):
+        """An instruction is consumed on the calling thread, so a late decision thread can never use it up.
+        """
+        fox_ai = ai_controllers.ManualInstructions(self.mission_model, 'fox')
+        self.mission_model.all_ai_by_id['fox'] = fox_ai
+        self.mission_model.all_ai_by_id['goose'] = SlowChaseTheFox(self.mission_model, ['goose_000', 'goose_001'])
+
+        fox_ai.add_instruction('L')
+        self.mission_model.ask_all_ai_for_next_move()
+        self.assertEqual(fox_ai.get_next_moves(), {'fox': 'L'})
+        self.assertIsNone(fox_ai.next_instruction)
+        self.assertEqual(self.mission_model.timed_out_ai_ids, ['goose'])
+        self.mission_model.stop_decision_workers()
+
+    def test_controllers_do_not_share_a_lock(self):
+        """A decision holding its controller's lock does not hold up another controller, and the lock is not pickled.
+        """
+        goose_ai = ai_controllers.ChaseTheFox(self.mission_model, ['goose_000'])
+        fox_ai = self.mission_model.all_ai_by_id['fox']
+        with goose_ai._decision_lock:
+            fox_ai.set_next_moves({'fox': 'L'})
+        self.assertEqual(fox_ai.get_next_moves(), {'fox': 'L'})
+
+        copied_ai = cPickle.loads(cPickle.dumps(fox_ai, cPickle.HIGHEST_PROTOCOL))
+        copied_ai.set_next_moves({'fox': 'R'})
+        self.assertEqual(copied_ai.get_next_moves(), {'fox': 'R'})
+        self.assertIsNot(copied_ai._decision_lock, fox_ai._decision_lock)
+
+    def test_fast_ai_is_not_cut_short(self):
+        """AIs that finish in time keep their own moves.
+        """
+        self.mission_model.all_ai_by_id['goose'] = ai_controllers.ChaseTheFox(self.mission_model, ['goose_000', 'goose_001'])
+        self.mission_model.ask_all_ai_for_next_move()
+        self.assertEqual(self.mission_model.timed_out_ai_ids, [])
+        self.assertEqual(self.mission_model.all_ai_by_id['goose'].get_next_moves(), {'goose_000': 'R', 'goose_001': 'DL'})
+
+class ParallelAITests(unittest.TestCase):
+    """Tests AI controllers deciding in an executor.
+    """
+    def get_next_moves(self, ai_executor):
+        mission_model, mission_controller = simulation.setup_mission("mission 1", read_campaign())
+        mission_model.ai_executor = ai_executor
+        mission_model.ask_all_ai_for_next_move()
+        return dict([(ai_id, mission_model.all_ai_by_id[ai_id].get_next_moves()) for ai_id in mission_model.all_ai_by_id])
+
+    def test_thread_pool_matches_sequential(self):
+        """Deciding in a thread pool makes the same moves as deciding one controller at a time.
+        """
+        ai_executor = ThreadPool(2)
+        try:
+            self.assertEqual(self.get_next_moves(ai_executor), self.get_next_moves(None))
+        finally:
+            ai_executor.terminate()
+
+    def test_process_pool_matches_sequential(self):
+        """Deciding in worker processes makes the same moves as deciding one controller at a time.
+        """
+        ai_executor = multiprocessing.Pool(2)
+        try:
+            self.assertEqual(self.get_next_moves(ai_executor), self.get_next_moves(None))
+        finally:
+            ai_executor.terminate()
+
+    def test_process_pool_reads_shared_board(self):
+        """Worker processes reading the board from shared memory make the same moves.
+        """
+        mission_model, mission_controller = simulation.setup_mission("mission 1", read_campaign())
+        expected_moves = self.get_next_moves(None)
+        ai_executor = multiprocessing.Pool(2)
+        board = mission_model.share_board()
+        try:
+            mission_model.ai_executor = ai_executor
+            mission_model.ask_all_ai_for_next_move()
+            self.assertEqual(mission_model.all_ai_by_id['goose'].get_next_moves(), expected_moves['goose'])
+            self.assertEqual(board.generation, 2)
+        finally:
+            ai_executor.terminate()
+            board.close()
+        self.assertFalse(os.path.exists(board.path))
+
+    def test_executor_respects_time_budget(self):
+        """A decision that is not back by the deadline falls back to waiting.
+        """
+        mission_model, mission_controller = simulation.setup_mission("mission 1", read_campaign())
+        mission_model.ai_time_budget_seconds = 0.05
+        def never_ready(timeout):
+            time.sleep(timeout)
+            raise multiprocessing.TimeoutError()
+
+        mission_model.ai_executor = Mock()
+        mission_model.ai_executor.apply_async.return_value.get.side_effect = never_ready
+
+        mission_model.ask_all_ai_for_next_move()
+        self.assertEqual(mission_model.timed_out_ai_ids, ['goose'])
+        self.assertEqual(set(mission_model.all_ai_by_id['goose'].get_next_moves().values()), set(['W']))
+
+class SharedBoardTest(unittest.TestCase):
+    """Tests the board published to shared memory.
+    """
+    def test_publish_and_read(self):
+        """A read only view sees each published generation of the board.
+        """
+        mission_model, mission_controller = simulation.setup_mission("mission 1", read_campaign())
+        board = mission_model.share_board()
+        try:
+            view = shared_board.BoardView(board.path)
+            self.assertEqual(view.get_generation(), 0)
+            board.publish(mission_model)
+
+            registry = mission_model.all_entities_by_id
+            fox = registry['fox']
+            state = view.read(2)
+            self.assertEqual((state['width'], state['height']), (mission_model.grid_width, mission_model.grid_height))
+            self.assertEqual((state['positions x'][fox.slot], state['positions y'][fox.slot]), (fox.position_x, fox.position_y))
+            self.assertEqual(state['type codes'][fox.slot], entity_module.FOX)
+
+            # Removed Entities leave an empty slot.
+            goose_slot = registry['goose_0'].slot
+            registry['goose_0'].is_dead = True
+            del registry['goose_0']
+            board.publish(mission_model)
+            state = view.read(4)
+            self.assertEqual(state['type codes'][goose_slot], entity_module.NO_TYPE)
+
+            # An old generation is gone for good.
+            with self.assertRaises(ValueError):
+                view.read(2)
+            view.close()
+        finally:
+            board.close()
+
+    def test_board_grows(self):
+        """A board that is too small grows when published, and views follow it.
+        """
+        mission_model, mission_controller = simulation.setup_mission("mission 1", read_campaign())
+        board = mission_model.share_board(capacity=1)
+        try:
+            view = shared_board.BoardView(board.path)
+            board.publish(mission_model)
+            registry = mission_model.all_entities_by_id
+            self.assertTrue(board.capacity >= len(registry.entities_by_slot))
+
+            state = view.read(2)
+            self.assertEqual(list(state['positions x']), registry.positions_x)
+            self.assertEqual(view.capacity, board.capacity)
+            view.close()
+        finally:
+            board.close()
+
+    def test_read_slots(self):
+        """Reading some slots gives their columns in the order asked for.
+        """
+        mission_model, mission_controller = simulation.setup_mission("mission 1", read_campaign())
+        board = mission_model.share_board()
+        try:
+            board.publish(mission_model)
+            registry = mission_model.all_entities_by_id
+            slots = [registry['goose_1'].slot, registry['fox'].slot]
+            view = shared_board.BoardView(board.path)
+            state = view.read_slots(slots, 2)
+            self.assertEqual(state['positions x'], [registry.positions_x[slot] for slot in slots])
+            self.assertEqual(state['positions y'], [registry.positions_y[slot] for slot in slots])
+            self.assertEqual(state['type codes'], [entity_module.GOOSE, entity_module.FOX])
+            with self.assertRaises(ValueError):
+                view.read_slots([len(registry.entities_by_slot)], 2)
+            view.close()
+        finally:
+            board.close()
+
+    def test_load_mission_closes_board(self):
+        """Loading another mission closes the shared board and removes its file.
+        """
+        mission_model, mission_controller = simulation.setup_mission("mission 1", read_campaign())
+        board = mission_model.share_board()
+        mission_model.load_mission("mission 1", read_campaign())
+        self.assertIsNone(mission_model.shared_board)
+        self.assertFalse(os.path.exists(board.path))
+        self.assertNotIn(board, shared_board._open_boards)
+
+    def test_attach_drops_old_views(self):
+        """Workers close the views of removed boards, and keep only the last few.
+        """
+        boards = [shared_board.SharedBoard(4) for index in xrange(shared_board.MAX_ATTACHED_VIEWS + 2)]
+        try:
+            views = [shared_board.attach(board.path) for board in boards]
+            self.assertIs(shared_board.attach(boards[-1].path), views[-1])
+            self.assertIsNone(views[0].memory)
+            self.assertIsNotNone(views[-1].memory)
+
+            boards[-2].close()
+            shared_board.attach(boards[-1].path)
+            self.assertIsNone(views[-2].memory)
+            self.assertNotIn(boards[-2].path, shared_board._views_by_path)
+        finally:
+            for board in boards:
+                board.close()
+            for view in views:
+                view.close()
+            shared_board._views_by_path.clear()
+            del shared_board._attached_paths[:]
+
+class EntityRegistryTest(unittest.TestCase):
+    """Tests the registry counts living and dead Entities as they change.
+    """
+    def setUp(self):
+        self.registry = EntityRegistry()
+        self.fox = Entity(position={'x':0, 'y':0}, entity_type='fox')
+        self.goose_0 = Entity(position={'x':1, 'y':0}, entity_type='goose')
+        self.goose_1 = Entity(position={'x':2, 'y':0}, entity_type='goose')
+        self.registry['fox'] = self.fox
+        self.registry['goose_000'] = self.goose_0
+        self.registry['goose_001'] = self.goose_1
+
+    def test_counts_follow_deaths(self):
+        """Killing an Entity moves it from the living to the dead count.
+        """
+        self.assertEqual(self.registry.count('goose'), 2)
+        self.assertEqual(self.registry.count('goose', dead=False), 2)
+
+        self.goose_1.is_dead = True
+        self.goose_1.is_dead = True
+        self.assertEqual(self.registry.count('goose', dead=False), 1)
+        self.assertEqual(self.registry.count('goose', dead=True), 1)
+        self.assertEqual(self.registry.dead_entity_ids, set(['goose_001']))
+
+        self.goose_1.is_dead = False
+        self.assertEqual(self.registry.count('goose', dead=True), 0)
+        self.assertEqual(self.registry.dead_entity_ids, set())
+
+    def test_counts_follow_removal(self):
+        """Removing or replacing an Entity updates the counts. Removed Entities no longer report to the registry.
+        """
+        self.goose_0.is_dead = True
+        del self.registry['goose_000']
+        self.assertEqual(self.registry.count('goose'), 1)
+        self.assertEqual(self.registry.dead_entity_ids, set())
+
+        self.goose_0.is_dead = False
+        self.assertEqual(self.registry.count('goose'), 1)
+
+        self.registry['goose_001'] = Entity(position={'x':2, 'y':1}, entity_type='goose')
+        self.assertEqual(self.registry.count('goose'), 1)
+        self.registry.pop('fox')
+        self.assertEqual(self.registry.count('fox'), 0)
+
+    def test_delete_only_dead(self):
+        """The mission model deletes the dead Entities without looking at the living ones.
+        """
+        mission_model = MissionModel(width=3, height=1)
+        mission_model.all_entities_by_id.update(self.registry)
+        self.goose_0.is_dead = True
+
+        self.assertEqual(mission_model.delete_dead_entities(), ['goose_000'])
+        self.assertEqual(sorted(mission_model.all_entities_by_id), ['fox', 'goose_001'])
+        self.assertEqual(mission_model.get_mission_status(), "not finished")
+
+        self.goose_1.is_dead = True
+        self.assertEqual(mission_model.get_mission_status(), "player win")
+
+class EntityHandleTest(unittest.TestCase):
+    """Tests the integer handles and type codes given out by the registry.
+    """
+    def test_handles_go_stale(self):
+        """A removed Entity's handle no longer finds anything, even after its slot is reused.
+        """
+        registry = EntityRegistry()
+        goose = Entity(position={'x':0, 'y':0}, entity_type='goose')
+        registry['goose_000'] = goose
+        handle = goose.handle
+        self.assertIs(registry.get_entity(handle), goose)
+        self.assertEqual(registry.get_entity_id(handle), 'goose_000')
+
+        del registry['goose_000']
+        self.assertIsNone(goose.handle)
+        self.assertIsNone(registry.get_entity(handle))
+
+        new_goose = Entity(position={'x':1, 'y':0}, entity_type='goose')
+        registry['goose_001'] = new_goose
+        self.assertNotEqual(new_goose.handle, handle)
+        self.assertIsNone(registry.get_entity(handle))
+        self.assertIs(registry.get_entity(new_goose.handle), new_goose)
+
+    def test_type_codes(self):
+        """Entity types have small integer codes. Changing the type keeps the counts right.
+        """
+        goose = Entity(entity_type='goose')
+        self.assertEqual(goose.type_code, entity_module.GOOSE)
+
+        registry = EntityRegistry(goose_000=goose)
+        goose.entity_type = 'fox'
+        self.assertEqual(goose.type_code, entity_module.FOX)
+        self.assertEqual(registry.count('goose'), 0)
+        self.assertEqual(registry.count(entity_module.FOX), 1)
+
+    def test_other_type_codes(self):
+        """Types without a code of their own all get OTHER_TYPE. Counting them does not hand out codes.
+        """
+        type_codes = dict(entity_module.ENTITY_TYPE_CODES)
+        registry = EntityRegistry()
+        self.assertEqual(registry.count('wolf'), 0)
+        self.assertEqual(entity_module.ENTITY_TYPE_CODES, type_codes)
+
+        registry['wolf'] = Entity(entity_type='wolf')
+        registry['bear'] = Entity(entity_type='bear')
+        self.assertEqual(registry['wolf'].type_code, entity_module.OTHER_TYPE)
+        self.assertEqual(registry['bear'].type_code, entity_module.OTHER_TYPE)
+        self.assertEqual(registry.count(entity_module.OTHER_TYPE), 2)
+        self.assertEqual(entity_module.ENTITY_TYPE_CODES, type_codes)
+
+    def test_thousands_of_geese_stay_in_order(self):
+        """Geese past goose_999 come after it, not between goose_100 and goose_101.
+        """
+        yaml_document = benchmarks.make_mission_yaml(40, 30, 1100)
+        mission_model, mission_controller = simulation.setup_mission("benchmark", yaml_document)
+        goose_ids = mission_model.all_ai_by_id['goose'].entity_ids
+        self.assertEqual(goose_ids[999:1001], ['goose_999', 'goose_1000'])
+
+class ChunkedGridTest(unittest.TestCase):
+    """Tests the sparse index of Entities by position.
+    """
+    def test_chunks_allocated_on_demand(self):
+        """Only chunks with something on them are allocated. Crowded cells are found without looking at every slot.
+        """
+        grid = chunked_grid.ChunkedGrid(chunk_size=16)
+        grid.add(0, 5, 5)
+        grid.add(1, 5, 5)
+        grid.add(2, 9000, 9000)
+        self.assertEqual(sorted(grid.chunks), [(0, 0), (562, 562)])
+        self.assertEqual(grid.get_crowded_cells(), [((5, 5), [0, 1])])
+
+        grid.move(2, 9000, 9000, 5, 5)
+        self.assertEqual(grid.chunks.keys(), [(0, 0)])
+        self.assertEqual(grid.get_crowded_cells(), [((5, 5), [0, 1, 2])])
+        self.assertEqual(sorted(grid.get_slots_in_area(0, 0, 20, 20)), [0, 1, 2])
+
+        grid.remove(0, 5, 5)
+        grid.remove(1, 5, 5)
+        self.assertEqual(grid.get_crowded_cells(), [])
+        self.assertEqual(grid.get_slots_at(5, 5), [2])
+
+    def test_pending_slots_by_chunk(self):
+        """Pending moves are collected from the active chunks only, once.
+        """
+        grid = chunked_grid.ChunkedGrid(chunk_size=16)
+        grid.add(0, 1, 1)
+        grid.add(1, 100, 100)
+        grid.mark_pending(1, 100, 100)
+        self.assertEqual(grid.active_chunk_keys, set([(6, 6)]))
+        self.assertEqual(grid.pop_pending_slots(), [1])
+        self.assertEqual(grid.pop_pending_slots(), [])
+
+    def test_registry_keeps_grid_up_to_date(self):
+        """Moving, adding and removing Entities updates the registry's grid.
+        """
+        registry = EntityRegistry()
+        goose = Entity(position={'x':1, 'y':2}, entity_type='goose')
+        registry['goose_000'] = goose
+        goose.position_x = 3
+        self.assertEqual(registry.grid.get_slots_at(3, 2), [goose.slot])
+        self.assertEqual(registry.moved_slots, set([goose.slot]))
+
+        del registry['goose_000']
+        self.assertEqual(registry.grid.chunks, {})
+
+    def test_huge_map(self):
+        """A 10,000 by 10,000 map only allocates the chunks its Entities are on.
+        """
+        mission_model = MissionModel(width=10000, height=10000)
+        fox = Entity(position={'x':9998, 'y':9998}, entity_type='fox')
+        fox.collision_behavior = FoxCollisionResolver(fox)
+        mission_model.all_entities_by_id['fox'] = fox
+        for index, position in enumerate([(0, 0), (9999, 9999), (9997, 9999)]):
+            goose = Entity(position={'x':position[0], 'y':position[1]}, entity_type='goose')
+            goose.collision_behavior = GooseCollisionResolver(goose)
+            mission_model.all_entities_by_id["goose_%03d" % index] = goose
+
+        mission_model.try_to_move_entities(['goose_001', 'goose_002'], ['DL', 'DR'])
+        mission_model.move_all_entities()
+        mission_model.find_collisions()
+
+        self.assertEqual(len(mission_model.all_entities_by_id.grid.chunks), 2)
+        self.assertEqual(len(mission_model.collisions), 1)
+        self.assertEqual((mission_model.collisions[0]['x'], mission_model.collisions[0]['y']), (9998, 9998))
+
+class DirtySetTest(unittest.TestCase):
+    """Tests turns only touch the Entities that moved, and stationary Entities still have a full position history.
+    """
+    def setUp(self):
+        self.mission_model = MissionModel(width=5, height=5)
+        self.fox = Entity(position={'x':4, 'y':4}, entity_type='fox')
+        self.goose = Entity(position={'x':0, 'y':0}, entity_type='goose')
+        self.mission_model.all_entities_by_id['fox'] = self.fox
+        self.mission_model.all_entities_by_id['goose_000'] = self.goose
+
+    def test_position_history_of_stationary_entity(self):
+        """Turns the Entity stood still are in its history once it moves or the history is read.
+        """
+        self.mission_model.move_all_entities()
+        self.mission_model.try_to_move_entity('goose_000', 'U')
+        self.mission_model.move_all_entities()
+        self.mission_model.move_all_entities()
+
+        registry = self.mission_model.all_entities_by_id
+        self.assertEqual(registry.moved_slots, set())
+        self.assertEqual(len(registry.position_histories[self.fox.slot]), 0)
+        self.assertEqual(self.fox.position_history, [{'x':4, 'y':4}] * 3)
+        self.assertEqual(self.goose.position_history, [{'x':0, 'y':0}, {'x':0, 'y':0}, {'x':0, 'y':1}])
+        self.assertEqual(registry.get_previous_position(self.goose.slot), (0, 1))
+
+    def test_turn_records_only_moved_entities(self):
+        """The turn delta only lists Entities that changed cell or died.
+        """
+        self.mission_model.all_ai_by_id['fox'] = ai_controllers.AlwaysWait(self.mission_model, 'fox')
+        self.mission_model.all_ai_by_id['goose'] = ai_controllers.ChaseTheFox(self.mission_model, ['goose_000'])
+        mission_controller = MissionController(mission_model=self.mission_model)
+
+        mission_controller.move_ai_entities()
+        self.assertEqual(mission_controller.get_turn_delta()['moves'], {'goose_000': {'x':1, 'y':1, 'is dead':False}})
+        self.assertEqual(self.mission_model.all_entities_by_id.moved_slots, set([self.goose.slot]))
+
+class EntityComponentTest(unittest.TestCase):
+    """Tests Entities keep their components in the registry's columns while registered.
+    """
+    def test_components_move_into_columns_and_back(self):
+        """A registered Entity reads and writes its slot of each column. A removed Entity keeps its last values.
+        """
+        registry = EntityRegistry()
+        goose = Entity(position={'x':1, 'y':2}, entity_type='goose')
+        goose.resource_id = 'goose'
+        registry['goose_000'] = goose
+
+        self.assertEqual((registry.positions_x[goose.slot], registry.positions_y[goose.slot]), (1, 2))
+        registry.set_position(goose.slot, 3, 2)
+        self.assertEqual(goose.position_x, 3)
+        goose.is_dead = True
+        self.assertEqual(registry.dead[goose.slot], 1)
+
+        del registry['goose_000']
+        self.assertEqual((goose.position_x, goose.position_y, goose.resource_id, goose.is_dead), (3, 2, 'goose', True))
+        self.assertIs(goose.collision_behavior.entity, goose)
+
+    def test_entity_in_one_registry(self):
+        """Adding an Entity to a second registry takes it out of the first.
+        """
+        first_registry = EntityRegistry()
+        second_registry = EntityRegistry()
+        fox = Entity(position={'x':4, 'y':0}, entity_type='fox')
+        first_registry['fox'] = fox
+        second_registry['the fox'] = fox
+
+        self.assertEqual(len(first_registry), 0)
+        self.assertEqual(first_registry.count('fox'), 0)
+        self.assertEqual(second_registry.get_entity_id(fox.handle), 'the fox')
+        self.assertEqual(fox.position_x, 4)
+
+    def test_try_to_move_entities(self):
+        """Moving many Entities at once sets the same pending positions as moving them one by one.
+        """
+        directions = ['UL', 'D', 'w', 'jump']
+        mission_models = []
+        for i in xrange(2):
+            mission_model = MissionModel(width=5, height=5)
+            for index in xrange(len(directions)):
+                mission_model.all_entities_by_id['goose_%d' % index] = Entity(position={'x':2, 'y':2}, entity_type='goose')
+            mission_models.append(mission_model)
+
+        entity_ids = ['goose_%d' % index for index in xrange(len(directions))]
+        mission_models[0].try_to_move_entities(entity_ids, directions)
+        for entity_id, direction in zip(entity_ids, directions):
+            mission_models[1].try_to_move_entity(entity_id, direction)
+
+        for mission_model in mission_models:
+            registry = mission_model.all_entities_by_id
+            self.assertEqual(registry.pending_positions_x, [1, 2, None, None])
+            self.assertEqual(registry.pending_positions_y, [3, 1, None, None])
+
+    def test_waiting_visits_no_slots(self):
+        """A turn where every Entity waits, or tries to walk off the map, has no pending moves to visit.
+        """
+        mission_model = MissionModel(width=5, height=5)
+        entity_ids = ['goose_%d' % index for index in xrange(4)]
+        for entity_id in entity_ids:
+            mission_model.all_entities_by_id[entity_id] = Entity(position={'x':0, 'y':0}, entity_type='goose')
+
+        mission_model.try_to_move_entities(entity_ids[:2], ['W', 'W'])
+        mission_model.try_to_move_entity(entity_ids[2], 'W')
+        mission_model.try_to_move_entity(entity_ids[3], 'DL')
+
+        registry = mission_model.all_entities_by_id
+        self.assertEqual(registry.grid.pop_pending_slots(), [])
+        self.assertEqual(registry.pending_positions_x, [None] * 4)
+
+    def test_waiting_cancels_pending_move(self):
+        """Waiting after a move cancels it.
+        """
+        mission_model = MissionModel(width=5, height=5)
+        mission_model.all_entities_by_id['goose'] = Entity(position={'x':2, 'y':2}, entity_type='goose')
+        mission_model.try_to_move_entity('goose', 'U')
+        mission_model.try_to_move_entity('goose', 'W')
+        self.assertEqual(mission_model.all_entities_by_id.grid.pop_pending_slots(), [])
+
+class TerrainTest(unittest.TestCase):
+    """Tests walls and water block moves, and the geese find their way around them.
+    """
+    def setUp(self):
+        # A wall between the goose and the fox, with a gap at the top.
+        #   y=2  . . .
+        #   y=1  . # .
+        #   y=0  . # .
+        self.mission_model = MissionModel(width=3, height=3)
+        self.mission_model.set_terrain(terrain.TerrainGrid.from_rows([
+            "...",
+            ".#.",
+            ".#.",
+        ], 3, 3))
+
+        self.fox_entity = Entity(position={'x':2, 'y':0}, entity_type='fox')
+        self.goose_entity = Entity(position={'x':0, 'y':0}, entity_type='goose')
+        self.mission_model.all_entities_by_id['fox'] = self.fox_entity
+        self.mission_model.all_entities_by_id['goose_000'] = self.goose_entity
+        self.mission_model.all_ai_by_id['fox'] = ai_controllers.AlwaysWait(self.mission_model, 'fox')
+        self.mission_model.all_ai_by_id['goose'] = ai_controllers.ChaseTheFox(self.mission_model, ['goose_000'])
+
+    def test_terrain_from_rows(self):
+        """Rows are listed top first. Walls and water cannot be entered.
+        """
+        terrain_grid = terrain.TerrainGrid.from_rows(["~.", "#."], 2, 2)
+        self.assertFalse(terrain_grid.is_passable(0, 0))
+        self.assertFalse(terrain_grid.is_passable(0, 1))
+        self.assertTrue(terrain_grid.is_passable(1, 0))
+        self.assertFalse(terrain_grid.is_passable(2, 0))
+        self.assertEqual(terrain_grid.terrain[0], terrain.WALL)
+        self.assertEqual(terrain_grid.terrain[2], terrain.WATER)
+
+        with self.assertRaises(ValueError):
+            terrain.TerrainGrid.from_rows(["?."], 2, 2)
+
+    def test_blocked_move_stays(self):
+        """An entity told to move into a wall stays where it is.
+        """
+        self.mission_model.try_to_move_entity('goose_000', 'R')
+        self.mission_model.move_all_entities()
+        self.assertEqual((self.goose_entity.position_x, self.goose_entity.position_y), (0, 0))
+
+    def test_goose_goes_around_wall(self):
+        """The goose heads for the gap in the wall instead of walking into it.
+        """
+        mission_controller = MissionController(mission_model=self.mission_model)
+        path = []
+        for turn in xrange(3):
+            mission_controller.move_ai_entities()
+            path.append((self.goose_entity.position_x, self.goose_entity.position_y))
+            mission_controller.reset_for_new_round()
+        self.assertEqual(path, [(0, 1), (1, 2), (2, 1)])
+
+    def test_terrain_loads_with_yaml(self):
+        """A mission may add terrain rows.
+        """
+        mission_yaml_file = """
+campaign:
+  mission ids:
+    - mission 1
+missions:
+  mission 1:
+    map height: 2
+    map width: 3
+    terrain:
+      rows:
+        - "..."
+        - ".~."
+    fox:
+      position: {x: 2, y: 0}
+    geese:
+      - position: {x: 0, y: 0}
+"""
+        mission_model = MissionModel()
+        mission_model.load_mission("mission 1", mission_yaml_file)
+        self.assertFalse(mission_model.terrain.is_passable(1, 0))
+        self.assertTrue(mission_model.terrain.is_passable(1, 1))
+        self.assertIsNotNone(mission_model.pathfinding)
+
+    def test_distance_field_cache(self):
+        """Distance fields are reused for the same target, and the least recently used one is dropped.
+        """
+        pathfinding = terrain.PathfindingService(self.mission_model.terrain, cache_size=2)
+        distance_field = pathfinding.get_distance_field(2, 0)
+        self.assertEqual(distance_field[0], 4)
+        self.assertEqual(distance_field[1], terrain.UNREACHABLE)
+
+        self.assertIs(pathfinding.get_distance_field(2, 0), distance_field)
+        pathfinding.get_distance_field(0, 0)
+        pathfinding.get_distance_field(2, 0)
+        pathfinding.get_distance_field(0, 2)
+        self.assertEqual((pathfinding.cache_hits, pathfinding.cache_misses), (2, 3))
+
+        # (0, 0) was used least recently.
+        self.assertEqual(pathfinding.distance_fields_by_target.keys(), [2, 6])
+
+class SymmetryTest(unittest.TestCase):
+    """Tests mirror images of a board share one canonical state, and moves map back.
+    """
+    def make_mission(self, width, height, fox_position, goose_positions):
+        mission_model = MissionModel(width=width, height=height)
+        mission_model.all_entities_by_id['fox'] = Entity(position={'x':fox_position[0], 'y':fox_position[1]}, entity_type='fox')
+        for index, (x, y) in enumerate(goose_positions):
+            mission_model.all_entities_by_id['goose_%d' % index] = Entity(position={'x':x, 'y':y}, entity_type='goose')
+        return mission_model
+
+    def test_transforms(self):
+        """Rectangular maps have four symmetries and square maps eight.
+        Each transform moves neighboring cells by the step of the transformed direction, and its inverse undoes it.
+        """
+        self.assertEqual(len(symmetry.get_board_transforms(6, 3)), 4)
+        self.assertEqual(len(symmetry.get_board_transforms(4, 4)), 8)
+
+        for transform in symmetry.get_board_transforms(4, 4) + symmetry.get_board_transforms(6, 3):
+            inverse = transform.inverse()
+            for x in xrange(transform.width - 1):
+                for y in xrange(transform.height - 1):
+                    self.assertEqual(inverse.apply(*transform.apply(x, y)), (x, y))
+                    new_x, new_y = transform.apply(x, y)
+                    step_x, step_y = terrain.STEP_BY_DIRECTION[transform.apply_direction('UR')]
+                    self.assertEqual(transform.apply(x + 1, y + 1), (new_x + step_x, new_y + step_y))
+            self.assertEqual(transform.apply_direction('W'), 'W')
+
+        rotate_90 = symmetry.BoardTransform(4, 4, swap_xy=True, mirror_x=True)
+        self.assertEqual(rotate_90.name, 'rotate 90')
+        self.assertEqual(rotate_90.apply_direction('R'), 'U')
+        self.assertEqual(rotate_90.inverse().apply_direction('U'), 'R')
+
+    def test_mirror_images_share_a_key(self):
+        """Every mirror image of a mission canonicalizes to the same state key.
+        """
+        mission_model = self.make_mission(5, 5, (1, 3), [(0, 0), (4, 1), (2, 2)])
+        state_key, transform = mission_model.get_symmetry().canonicalize(mission_model)
+
+        for mirror in symmetry.get_board_transforms(5, 5):
+            fox_position = mirror.apply(1, 3)
+            goose_positions = [mirror.apply(x, y) for x, y in [(0, 0), (4, 1), (2, 2)]]
+            mirrored_model = self.make_mission(5, 5, fox_position, goose_positions)
+            self.assertEqual(mirrored_model.get_symmetry().canonicalize(mirrored_model)[0], state_key)
+
+        # Dead Entities are not part of the state.
+        mission_model.all_entities_by_id['goose_2'].is_dead = True
+        self.assertNotEqual(mission_model.get_symmetry().canonicalize(mission_model)[0], state_key)
+
+    def test_restore_moves(self):
+        """A move chosen in the canonical state becomes the matching move in the original.
+        """
+        mission_model = self.make_mission(5, 3, (4, 2), [(3, 0)])
+        mission_model.all_ai_by_id['goose'] = ai_controllers.ChaseTheFox(mission_model, ['goose_0'])
+        mission_symmetry = mission_model.get_symmetry()
+        state_key, transform = mission_symmetry.canonicalize(mission_model)
+        self.assertFalse(transform.is_identity())
+
+        # The goose chases the fox in the canonical state.
+        canonical_fox = transform.apply(4, 2)
+        canonical_goose = transform.apply(3, 0)
+        canonical_moves = {'goose_0': ai_controllers.get_chase_directions(canonical_fox[0], canonical_fox[1], [canonical_goose[0]], [canonical_goose[1]])[0]}
+        self.assertEqual(mission_symmetry.restore_moves(canonical_moves, transform), {'goose_0': 'UR'})
+
+    def test_terrain_breaks_symmetry(self):
+        """Only transforms that keep the terrain in place are used.
+        """
+        mission_model = MissionModel(width=3, height=3)
+        self.assertEqual(len(mission_model.get_symmetry().transforms), 8)
+        mission_model.set_terrain(terrain.TerrainGrid.from_rows([
+            "#.#",
+            "...",
+            "...",
+        ], 3, 3))
+        self.assertEqual([transform.name for transform in mission_model.get_symmetry().transforms], ['identity', 'mirror x'])
+
 class MissionStatusTest(unittest.TestCase):
     """These tests will decide if the player wins or loses.
     """
@@ -803,6 +1713,80 @@ class MissionControllerStateTest(unittest.TestCase):
             }
         )
 
+    def test_other_entity_moves_skips_waiting_entities(self):
+        """Only Entities that moved or died this turn should be in the results.
+        """
+        # Add a goose that is already next to the fox, and a fox that waits.
+        self.goose_1 = Entity(position={'x':4, 'y':1}, entity_type='goose')
+        self.goose_1.collision_behavior = GooseCollisionResolver(self.goose_1)
+        self.mission_model.all_entities_by_id['goose_001'] = self.goose_1
+        self.mission_model.all_ai_by_id['goose'] = ai_controllers.ChaseTheFox(self.mission_model, ['goose_000', 'goose_001'])
+
+        self.mission_controller.player_input('w')
+        self.mission_controller.move_ai_entities()
+
+        state = self.mission_controller.get_status()
+        self.assertEqual(
+            state["other entities moves"],
+            {
+                'goose_000': {
+                    'x':1,
+                    'y':0,
+                    'is dead': False
+                },
+                'goose_001': {
+                    'x':3,
+                    'y':0,
+                    'is dead': False
+                }
+            }
+        )
+
+    def test_turn_listeners_receive_delta(self):
+        """Turn listeners should be told what changed after every turn.
+        """
+        deltas = []
+        self.mission_controller.add_turn_listener(deltas.append)
+
+        self.mission_controller.player_input('L')
+        self.mission_controller.move_ai_entities()
+
+        self.assertEqual(len(deltas), 1)
+        self.assertEqual(deltas[0], self.mission_controller.get_turn_delta())
+        self.assertEqual(deltas[0]['turn'], 1)
+        self.assertEqual(deltas[0]['mission complete'], 'player win')
+        self.assertEqual(deltas[0]['moves']['goose_000']['is dead'], True)
+
+    def test_status_is_cached_until_state_changes(self):
+        """get_status should return the same object until the state changes.
+        """
+        state = self.mission_controller.get_status()
+        self.assertIs(state, self.mission_controller.get_status())
+
+        self.mission_controller.player_input('w')
+        new_state = self.mission_controller.get_status()
+        self.assertIsNot(state, new_state)
+        self.assertEqual(new_state["player input"], "w")
+
+    def test_turn_profiler_records_phases(self):
+        """With a turn profiler, each phase of the turn is timed and the collisions and kills are counted.
+        """
+        self.mission_controller.turn_profiler = profiling.TurnProfiler()
+
+        self.mission_controller.player_input('L')
+        self.mission_controller.move_ai_entities()
+
+        record = self.mission_controller.turn_profiler.last_turn_record
+        self.assertEqual(record['turn'], 1)
+        self.assertEqual(sorted(record['phases'].keys()), sorted(profiling.TURN_PHASES))
+        self.assertEqual(record['collisions'], 1)
+        self.assertEqual(record['retreats'], 0)
+        self.assertEqual(record['kills'], 1)
+        self.assertTrue(record['seconds'] >= sum(record['phases'].values()) - 1e-9)
+
+        histogram = self.mission_controller.turn_profiler.get_histogram('ai decision')
+        self.assertEqual(sum(histogram), 1)
+
     def test_check_mission_complete(self):
         """After killing the geese, did the mission complete?
         """
@@ -1120,6 +2104,65 @@ class MissionViewTests(unittest.TestCase):
         self.assertFalse(status["finished showing mission complete message"])
         self.assertIsNone(status["mission complete message id"])
 
+    def test_advance_waits_for_mission_start(self):
+        """Advancing the Mission View shows the Mission Start banner and waits for it to finish.
+        """
+        self.get_mission_controller_map_initialized()
+
+        self.mission_view.advance()
+        self.assertEqual(self.mission_view.get_state(), "showing mission start")
+
+        # Advancing again does nothing until the banner finishes.
+        self.mission_view.advance()
+        self.assertEqual(self.mission_view.get_state(), "showing mission start")
+
+        self.mission_view.finish_mission_start()
+        self.assertEqual(self.mission_view.get_state(), "waiting for player input")
+
+    def test_submit_player_input_moves_entities_immediately(self):
+        """Submitting player input moves the entities without waiting for another update.
+        """
+        self.get_mission_controller_player_input()
+        self.mission_view.advance()
+        self.mission_view.finish_mission_start()
+
+        self.mission_view.submit_player_input('w')
+        self.mission_view.mission_controller.move_ai_entities.assert_called_once_with()
+        self.assertEqual(self.mission_view.get_state(), "entities moved")
+
+        # Finishing the animation starts the new round.
+        self.mission_view.finish_moving_entities()
+        self.mission_view.mission_controller.reset_for_new_round.assert_called_once_with()
+        self.assertEqual(self.mission_view.get_state(), "waiting for player input")
+
+    def test_state_listeners_see_each_transition(self):
+        """State listeners are told about every state change.
+        """
+        self.get_mission_controller_player_input()
+        self.mock_mission_controller.get_status.return_value = {
+            'map initialized':True,
+            "other entities moves": self.entity_moves,
+            "mission complete": "player win"
+        }
+        transitions = []
+        self.mission_view.add_state_listener(lambda old_state, new_state: transitions.append(new_state))
+
+        self.mission_view.advance()
+        self.mission_view.finish_mission_start()
+        self.mission_view.submit_player_input('w')
+        self.mission_view.finish_moving_entities()
+        self.mission_view.finish_mission_complete()
+
+        self.assertEqual(transitions, [
+            "showing mission start",
+            "waiting for player input",
+            "moving entities",
+            "entities ready to move",
+            "mission complete",
+            "showing mission complete",
+            "mission over",
+        ])
+
 class MissionModelDynamicLoadTest(unittest.TestCase):
     """Tests that Mission Models can be dynamically loaded.
     """
@@ -1173,15 +2216,15 @@ missions:
 
         # Confirm Goose Entities were loaded.
         goose_data = {
-            'goose_000': {
+            'goose_0': {
                 'x': 1,
                 'y': 0,
             },
-            'goose_001': {
+            'goose_1': {
                 'x': 3,
                 'y': 0,
             },
-            'goose_002': {
+            'goose_2': {
                 'x': 2,
                 'y': 1,
             }
@@ -1201,5 +2244,789 @@ missions:
         for goose_id in goose_data:
             self.assertIn(goose_id, mission_model.all_ai_by_id['goose'].entity_ids)
 
+SIMULATION_IMPORT_CHECK = """
+import sys
+
+class KivyImportRecorder(object):
+    # Records attempts to import Kivy, then lets the import go on as usual.
+    def __init__(self):
+        self.attempts = []
+
+    def find_module(self, fullname, path=None):
+        if fullname == 'kivy' or fullname.startswith('kivy.'):
+            self.attempts.append(fullname)
+        return None
+
+recorder = KivyImportRecorder()
+sys.meta_path.insert(0, recorder)
+import simulation
+sys.stdout.write('%s %s' % (recorder.attempts, 'kivy' in sys.modules))
+"""
+"""Run by the simulation tests in a fresh interpreter. Prints the Kivy modules importing simulation tried to load."""
+
+class SimulationTest(unittest.TestCase):
+    """Tests that missions can be played without a user interface.
+    """
+    def test_run_mission_until_complete(self):
+        """Geese chasing a fox that always waits should win the default mission.
+        """
+        results = simulation.run_mission("mission 1", read_campaign())
+        self.assertEqual(results['mission id'], "mission 1")
+        self.assertEqual(results['result'], "player lose")
+        self.assertTrue(results['turns'] > 0)
+
+    def test_run_mission_stops_after_max_turns(self):
+        """Waiting geese can never finish the mission, so it stops after max_turns.
+        """
+        results = simulation.run_mission(
+            "mission 1",
+            read_campaign(),
+            goose_ai_class=ai_controllers.AlwaysWait,
+            max_turns=3
+        )
+        self.assertEqual(results['result'], "not finished")
+        self.assertEqual(results['turns'], 3)
+
+    def test_headless_import_does_not_load_kivy(self):
+        """Importing the simulation must not import Kivy, or even try to, whether or not Kivy is installed.
+        """
+        check_imports = subprocess.Popen(
+            [sys.executable, '-c', SIMULATION_IMPORT_CHECK],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE
+        )
+        output, _ = check_imports.communicate()
+        self.assertEqual(check_imports.returncode, 0)
+        self.assertEqual(output, "[] False")
+
+    def test_cold_start_within_target(self):
+        """A fresh process, interpreter startup included, plays a game and exits within the cold start target.
+        """
+        start_time = time.time()
+        play = subprocess.Popen(
+            [sys.executable, 'simulation.py', '--mission', 'mission 1', '--games', '1', '--max-turns', '1'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        output, errors = play.communicate()
+        self.assertEqual(play.returncode, 0, errors)
+        self.assertTrue(time.time() - start_time < simulation.COLD_START_TARGET_SECONDS)
+
+    def test_slow_start_exit_status(self):
+        """main reports a startup that missed the target in its exit status.
+        """
+        with patch.object(simulation, 'module_start_time', time.time() - simulation.COLD_START_TARGET_SECONDS - 1):
+            with patch('sys.stdout'), patch('sys.stderr'):
+                status = simulation.main(['--mission', 'mission 1', '--games', '1', '--max-turns', '1'])
+        self.assertEqual(status, simulation.SLOW_START_EXIT_STATUS)
+
+    def test_get_ai_class(self):
+        """AI classes can be named on their own or with their module.
+        """
+        self.assertIs(simulation.get_ai_class('ChaseTheFox'), ai_controllers.ChaseTheFox)
+        self.assertIs(simulation.get_ai_class('ai_controllers.AlwaysWait'), ai_controllers.AlwaysWait)
+        with self.assertRaises(ValueError):
+            simulation.get_ai_class('MissionModel')
+
+class TournamentTest(unittest.TestCase):
+    """Tests the tournament runner.
+    """
+    def setUp(self):
+        self.results_directory = tempfile.mkdtemp()
+        self.results_file = os.path.join(self.results_directory, "results.jsonl")
+        self.matches = tournament.make_matches(['AlwaysWait'], ['ChaseTheFox', 'AlwaysWait'], ["mission 1"], games=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.results_directory)
+
+    def test_make_matches(self):
+        """Every fox AI plays every goose AI on every mission.
+        """
+        self.assertEqual(len(self.matches), 6)
+        self.assertEqual(len(set([match['match'] for match in self.matches])), 6)
+
+    def test_run_and_summarize(self):
+        """Each pairing gets a summary of its games.
+        """
+        results = tournament.run_tournament(self.matches, read_campaign(), self.results_file, processes=2, max_turns=5)
+        self.assertEqual(len(results), 6)
+        self.assertEqual(len(tournament.read_results(self.results_file)), 6)
+
+        summaries = dict([(summary['goose ai'], summary) for summary in tournament.summarize_results(results)])
+        self.assertEqual(summaries['ChaseTheFox']['goose wins'], 3)
+        self.assertEqual(summaries['ChaseTheFox']['average turns'], 1.0)
+        self.assertEqual(summaries['AlwaysWait']['unfinished'], 3)
+        self.assertEqual(summaries['AlwaysWait']['average turns'], 5.0)
+        self.assertTrue(summaries['AlwaysWait']['fox ai seconds per turn'] >= 0)
+
+    def test_resume(self):
+        """Matches already in the results file are not played again. A half written line is dropped.
+        """
+        tournament.run_tournament(self.matches[:4], read_campaign(), self.results_file, processes=0, max_turns=5)
+        with open(self.results_file, 'a') as results_lines:
+            results_lines.write('{"match": "mission 1|Alw')
+
+        played = []
+        results = tournament.run_tournament(
+            self.matches, read_campaign(), self.results_file, processes=0, max_turns=5, progress=played.append
+        )
+        self.assertEqual(len(played), 2)
+        self.assertEqual(len(results), 6)
+        self.assertEqual(len(tournament.read_results(self.results_file)), 6)
+
+    def test_wilson_interval(self):
+        """The interval contains the observed rate and narrows with more games.
+        """
+        low, high = tournament.wilson_interval(5, 10)
+        self.assertTrue(low < 0.5 < high)
+        wide = high - low
+        low, high = tournament.wilson_interval(50, 100)
+        self.assertTrue(high - low < wide)
+        self.assertEqual(tournament.wilson_interval(0, 0), (0.0, 1.0))
+        self.assertEqual(tournament.wilson_interval(0, 10)[0], 0.0)
+
+class OpeningBookTest(unittest.TestCase):
+    """Tests building an opening book for the campaign and looking moves up in it.
+    """
+    def setUp(self):
+        self.book_directory = tempfile.mkdtemp()
+        self.campaign_file = os.path.join(self.book_directory, "campaign.yaml")
+        self.yaml_document = read_campaign()
+        with open(self.campaign_file, 'w') as campaign:
+            campaign.write(self.yaml_document)
+
+        directions_by_state = opening_book.build_book(self.yaml_document, ["mission 1"], plies=3, processes=0)
+        opening_book.write_book(
+            opening_book.get_book_path(self.campaign_file),
+            self.yaml_document,
+            ["mission 1"],
+            ai_controllers.ChaseTheFox,
+            3,
+            directions_by_state
+        )
+        self.opening_book = opening_book.load_campaign_book(self.campaign_file)
+
+    def tearDown(self):
+        self.opening_book.close()
+        shutil.rmtree(self.book_directory)
+
+    def test_book_moves_match_live_moves(self):
+        """A game seeded like the book finds every turn of the book, with the moves ChaseTheFox would decide.
+        """
+        for fox_direction in opening_book.DIRECTION_CODES:
+            mission_model, mission_controller = simulation.setup_mission(
+                "mission 1", self.yaml_document, ai_controllers.ManualInstructions, ai_controllers.ChaseTheFox, self.opening_book
+            )
+            mission_model.random.seed(opening_book.BOOK_SEED)
+            goose_ai = mission_model.all_ai_by_id['goose']
+            for turn in xrange(3):
+                book_moves = self.opening_book.get_moves(mission_model, goose_ai)
+                goose_ai.determine_next_moves()
+                live_moves = dict([
+                    (entity_id, direction) for entity_id, direction in goose_ai.get_next_moves().items()
+                    if not mission_model.all_entities_by_id[entity_id].is_dead
+                ])
+                self.assertEqual(book_moves, live_moves)
+
+                mission_model.all_ai_by_id['fox'].add_instruction(fox_direction)
+                mission_controller.move_ai_entities()
+                if mission_controller.get_status()['mission complete'] != 'not finished':
+                    break
+                mission_controller.reset_for_new_round()
+
+    def test_book_only_for_its_ai_id(self):
+        """A controller of the book's class under another ai id gets no book moves.
+        """
+        mission_model, mission_controller = simulation.setup_mission(
+            "mission 1", self.yaml_document, ai_controllers.AlwaysWait, ai_controllers.ChaseTheFox, self.opening_book
+        )
+        goose_ids = mission_model.all_ai_by_id['goose'].get_entity_ids()
+        other_ai = ai_controllers.ChaseTheFox(mission_model, goose_ids)
+        mission_model.all_ai_by_id['other geese'] = other_ai
+        self.assertIsNone(self.opening_book.get_moves(mission_model, other_ai))
+        self.assertIsNotNone(self.opening_book.get_moves(mission_model, mission_model.all_ai_by_id['goose']))
+
+    def test_decisions_skipped_while_in_book(self):
+        """AI controllers with book moves do not decide. Other controllers and later turns decide as usual.
+        """
+        mission_model, mission_controller = simulation.setup_mission(
+            "mission 1", self.yaml_document, ai_controllers.AlwaysWait, ai_controllers.ChaseTheFox, self.opening_book
+        )
+        with patch.object(ai_controllers.ChaseTheFox, 'determine_next_moves') as determine_next_moves:
+            mission_controller.move_ai_entities()
+            self.assertFalse(determine_next_moves.called)
+        self.assertEqual(self.opening_book.hits, 1)
+
+        # The book only covers the first 3 turns.
+        mission_model.all_entities_by_id.turn_count = 3
+        self.assertFalse(mission_model.all_ai_by_id['goose'].use_book_moves())
+
+        # A book for ChaseTheFox does not help other AIs.
+        self.assertFalse(mission_model.all_ai_by_id['fox'].use_book_moves())
+
+    def test_stale_book_ignored(self):
+        """A book built for another version of the campaign is not used.
+        """
+        with open(self.campaign_file, 'a') as campaign:
+            campaign.write("\n# changed\n")
+        self.assertIsNone(opening_book.load_campaign_book(self.campaign_file))
+        self.assertIsNone(opening_book.load_campaign_book(os.path.join(self.book_directory, "missing.yaml")))
+
+    def test_tournament_uses_book(self):
+        """Tournaments play the same games with and without the book.
+        """
+        match = tournament.make_matches(['AlwaysWait'], ['ChaseTheFox'], ["mission 1"])[0]
+        with_book = tournament.play_match(match, self.yaml_document, opening_book=self.opening_book)
+        without_book = tournament.play_match(match, self.yaml_document)
+        self.assertEqual(with_book['result'], without_book['result'])
+        self.assertTrue(self.opening_book.hits > 0)
+
+class BenchmarkTest(unittest.TestCase):
+    """Tests the benchmark suite runs and flags regressions.
+    """
+    def test_run_benchmarks(self):
+        """Every benchmark should report a time for each map size and goose count that fits.
+        """
+        results = benchmarks.run_benchmarks(map_sizes=[(2, 2), (5, 4)], goose_counts=[3, 10], repeat=1, iterations=2)
+
+        # 10 geese do not fit on a 2x2 map.
+        self.assertEqual(len(results['results']), len(benchmarks.BENCHMARK_NAMES) * 3)
+        for result in results['results']:
+            self.assertIn(result['name'], benchmarks.BENCHMARK_NAMES)
+            self.assertTrue(result['seconds'] >= 0)
+
+    def test_benchmark_iterations(self):
+        """Each run times every iteration on its own mission, and reports the time per call.
+        """
+        calls = []
+        def prepare(width, height, goose_count, phase):
+            return lambda: calls.append(phase)
+
+        with patch.object(benchmarks, '_prepare', side_effect=prepare) as mock_prepare:
+            with patch.object(benchmarks.timeit, 'default_timer', side_effect=[0.0, 4.0, 10.0, 12.0]):
+                result = benchmarks.time_benchmark('find_collisions', 5, 4, 3, repeat=2, iterations=4)
+        self.assertEqual(mock_prepare.call_count, 8)
+        self.assertEqual(len(calls), 8)
+        self.assertEqual(result['iterations'], 4)
+        self.assertEqual(result['seconds'], 0.5)
+        self.assertEqual(result['median seconds'], 1.0)
+
+    def test_decision_benchmark_is_warm(self):
+        """The timed decision is not the first one, which also looks the geese up.
+        """
+        benchmark = benchmarks._prepare(5, 4, 10, 'determine_next_moves')
+        goose_ai = benchmark.im_self
+        self.assertIsNotNone(goose_ai.entities)
+        self.assertIsNotNone(goose_ai.fox_entity)
+
+    def test_mission_yaml_matches_model(self):
+        """The yaml used to benchmark load_mission should describe the same mission as the prebuilt model.
+        """
+        mission_model = MissionModel()
+        mission_model.load_mission("benchmark", benchmarks.make_mission_yaml(4, 3, 5))
+        prebuilt_model = benchmarks.make_mission_model(4, 3, 5)
+
+        for entity_id in prebuilt_model.all_entities_by_id:
+            entity = mission_model.all_entities_by_id[entity_id]
+            prebuilt_entity = prebuilt_model.all_entities_by_id[entity_id]
+            self.assertEqual((entity.position_x, entity.position_y), (prebuilt_entity.position_x, prebuilt_entity.position_y))
+        self.assertEqual(len(mission_model.all_entities_by_id), 6)
+
+    def test_compare_flags_regressions(self):
+        """Benchmarks slower than the baseline by more than the tolerance are regressions.
+        """
+        baseline = {'results': [
+            {'name': 'find_collisions', 'width': 10, 'height': 10, 'geese': 3, 'seconds': 1.0},
+            {'name': 'move_all_entities', 'width': 10, 'height': 10, 'geese': 3, 'seconds': 1.0},
+        ]}
+        results = {'results': [
+            {'name': 'find_collisions', 'width': 10, 'height': 10, 'geese': 3, 'seconds': 1.5},
+            {'name': 'move_all_entities', 'width': 10, 'height': 10, 'geese': 3, 'seconds': 1.1},
+            {'name': 'load_mission', 'width': 10, 'height': 10, 'geese': 3, 'seconds': 9.0},
+        ]}
+
+        comparisons = benchmarks.compare_results(results, baseline, tolerance=0.25)
+        regressions = [comparison['name'] for comparison in comparisons if comparison['regression']]
+        self.assertEqual(len(comparisons), 2)
+        self.assertEqual(regressions, ['find_collisions'])
+
+    def test_encoding_benchmark(self):
+        """The binary encoding of a turn should be smaller than the JSON status.
+        """
+        result = benchmarks.time_encoding(5, 4, 10, repeat=1, iterations=1)
+        self.assertTrue(result['binary bytes'] < result['json bytes'])
+        self.assertTrue(result['binary decode seconds'] >= 0)
+
+    def test_serialization_benchmark(self):
+        """mission_state should be smaller than a pickled MissionModel, and quicker to write and read.
+        """
+        result = benchmarks.time_serialization(40, 30, 600, repeat=3)
+        self.assertTrue(result['state bytes'] < result['pickle bytes'])
+        self.assertTrue(result['state serialize seconds'] < result['pickle dump seconds'])
+        self.assertTrue(result['state deserialize seconds'] < result['pickle load seconds'])
+
+class MissionStateTest(unittest.TestCase):
+    """Tests the compact serialization of missions.
+    """
+    def setUp(self):
+        self.mission_model = benchmarks.make_mission_model(8, 6, 10)
+        self.mission_controller = MissionController(mission_model=self.mission_model)
+        self.mission_controller.move_ai_entities()
+        self.mission_controller.reset_for_new_round()
+
+    def test_round_trip(self):
+        """A deserialized mission has the same Entities, AI controllers and random state, and serializes the same.
+        """
+        self.mission_model.all_entities_by_id['goose_3'].is_dead = True
+        data = mission_state.serialize_mission(self.mission_model)
+        restored_model = mission_state.deserialize_mission(data)
+
+        self.assertEqual(mission_state.serialize_mission(restored_model), data)
+        self.assertEqual((restored_model.grid_width, restored_model.grid_height), (8, 6))
+        registry = self.mission_model.all_entities_by_id
+        restored_registry = restored_model.all_entities_by_id
+        self.assertEqual(restored_registry.get_entity_ids_in_order(), registry.get_entity_ids_in_order())
+        for entity_id, entity in registry.items():
+            restored_entity = restored_registry[entity_id]
+            self.assertEqual((restored_entity.position_x, restored_entity.position_y), (entity.position_x, entity.position_y))
+            self.assertEqual(restored_entity.entity_type, entity.entity_type)
+            self.assertEqual(restored_entity.resource_id, entity.resource_id)
+            self.assertEqual(restored_entity.is_dead, entity.is_dead)
+            self.assertIs(type(restored_entity.collision_behavior), type(entity.collision_behavior))
+        self.assertEqual(restored_registry.dead_entity_ids, set(['goose_3']))
+        fox = registry['fox']
+        self.assertEqual(restored_registry.grid.get_slots_at(fox.position_x, fox.position_y), [restored_registry['fox'].slot])
+
+        self.assertEqual(sorted(restored_model.all_ai_by_id.keys()), ['fox', 'goose'])
+        self.assertIsInstance(restored_model.all_ai_by_id['goose'], ai_controllers.ChaseTheFox)
+        self.assertEqual(restored_model.all_ai_by_id['goose'].get_state(), self.mission_model.all_ai_by_id['goose'].get_state())
+        self.assertEqual(restored_model.random.getstate(), self.mission_model.random.getstate())
+
+    def test_restored_mission_plays_on(self):
+        """The AI controllers of a deserialized mission decide the same moves as the original.
+        """
+        restored_model = mission_state.deserialize_mission(mission_state.serialize_mission(self.mission_model))
+        for mission_model in (self.mission_model, restored_model):
+            mission_model.all_ai_by_id['goose'].determine_next_moves()
+        self.assertEqual(
+            restored_model.all_ai_by_id['goose'].get_next_moves(),
+            self.mission_model.all_ai_by_id['goose'].get_next_moves()
+        )
+
+        restored_controller = MissionController(mission_model=restored_model)
+        restored_controller.move_ai_entities()
+        self.assertEqual(restored_model.all_entities_by_id.turn_count, 1)
+
+    def test_restored_mission_plays_identically(self):
+        """A deserialized mission plays the same turns as the original, collisions and all.
+        """
+        mission_model = benchmarks.make_mission_model(10, 8, 30)
+        data = mission_state.serialize_mission(mission_model)
+        restored_model = mission_state.deserialize_mission(data)
+        # Let the geese pick their collision winners at random, from the same random state.
+        mission_model.random.seed(5)
+        restored_model.random.seed(5)
+
+        mission_controllers = [MissionController(mission_model=model) for model in (mission_model, restored_model)]
+        for turn in xrange(8):
+            states = []
+            for mission_controller in mission_controllers:
+                mission_controller.move_ai_entities()
+                mission_controller.reset_for_new_round()
+                states.append(mission_state.serialize_mission(mission_controller.mission_model))
+            self.assertEqual(states[0], states[1])
+
+    def test_terrain(self):
+        """Terrain is kept.
+        """
+        mission_model = benchmarks.make_mission_model(12, 8, 5, terrain=True)
+        restored_model = mission_state.deserialize_mission(mission_state.serialize_mission(mission_model))
+        self.assertEqual(restored_model.terrain.terrain, mission_model.terrain.terrain)
+        self.assertEqual(restored_model.terrain.passable, mission_model.terrain.passable)
+        self.assertIsNotNone(restored_model.pathfinding)
+
+    def test_not_a_mission(self):
+        """Data that is not a serialized mission is rejected.
+        """
+        data = mission_state.serialize_mission(self.mission_model)
+        with self.assertRaises(ValueError):
+            mission_state.deserialize_mission('XXXX' + data[4:])
+        with self.assertRaises(ValueError):
+            mission_state.deserialize_mission(data[:5])
+
+    def test_pickle(self):
+        """A MissionModel can still be pickled.
+        """
+        import cPickle
+        restored_model = cPickle.loads(cPickle.dumps(self.mission_model, cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(mission_state.serialize_mission(restored_model), mission_state.serialize_mission(self.mission_model))
+
+class WireProtocolTest(unittest.TestCase):
+    """Tests the binary encoding of turn deltas.
+    """
+    def setUp(self):
+        self.codec = wire_protocol.TurnDeltaCodec(['goose_001', 'fox', 'goose_000'])
+        self.turn_delta = {
+            'turn': 7,
+            'mission complete': 'player win',
+            'moves': {
+                'fox': {'x': 2, 'y': 1, 'is dead': False},
+                'goose_001': {'x': 300, 'y': 4, 'is dead': True},
+            },
+        }
+
+    def test_round_trip(self):
+        """A decoded turn delta matches the one that was encoded.
+        """
+        buffer = self.codec.make_buffer()
+        size = self.codec.encode_into(buffer, self.turn_delta)
+        self.assertEqual(size, wire_protocol.HEADER.size + 2 * wire_protocol.RECORD.size)
+
+        turn_delta, read_size = self.codec.decode_from(buffer)
+        self.assertEqual(read_size, size)
+        self.assertEqual(turn_delta, self.turn_delta)
+
+    def test_encode_at_offset(self):
+        """Several turns can be packed into one buffer back to back.
+        """
+        buffer = bytearray(2 * self.codec.max_encoded_size())
+        first_size = self.codec.encode_into(buffer, self.turn_delta)
+        second_turn_delta = {'turn': 8, 'mission complete': 'not finished', 'moves': {}}
+        self.codec.encode_into(buffer, second_turn_delta, offset=first_size)
+
+        reused_turn_delta = {}
+        turn_delta, read_size = self.codec.decode_from(buffer, offset=first_size, turn_delta=reused_turn_delta)
+        self.assertIs(turn_delta, reused_turn_delta)
+        self.assertEqual(turn_delta, second_turn_delta)
+
+    def test_unsupported_version(self):
+        """Decoding a turn from another protocol version fails.
+        """
+        encoded = bytearray(self.codec.encode(self.turn_delta))
+        encoded[0] = wire_protocol.WIRE_PROTOCOL_VERSION + 1
+        with self.assertRaises(ValueError):
+            self.codec.decode_from(encoded)
+
+class TurnProfilerTest(unittest.TestCase):
+    """Tests the turn profiler's statistics.
+    """
+    def setUp(self):
+        # A fake clock that moves forward by the given number of seconds per reading.
+        self.time_steps = []
+        self.current_time = [0.0]
+        def clock():
+            if self.time_steps:
+                self.current_time[0] += self.time_steps.pop(0)
+            return self.current_time[0]
+        self.profiler = profiling.TurnProfiler(history_length=3, clock=clock)
+
+    def play_turn(self, ai_seconds, move_seconds):
+        self.time_steps = [0.0, ai_seconds, move_seconds, 0.0]
+        self.profiler.start_turn()
+        self.profiler.end_phase('ai decision')
+        self.profiler.end_phase('move all entities')
+        return self.profiler.end_turn(turn_number=1, collision_count=0, retreat_count=0, kill_count=0)
+
+    def test_phases_over_budget(self):
+        """The profiler should say which phases took longer than their budget, slowest first.
+        """
+        self.play_turn(ai_seconds=0.5, move_seconds=0.2)
+        self.assertEqual(
+            self.profiler.get_phases_over_budget({'ai decision': 0.1, 'move all entities': 0.1, 'find collisions': 0.1}),
+            ['ai decision', 'move all entities']
+        )
+        self.assertEqual(self.profiler.get_phases_over_budget({'ai decision': 1.0}), [])
+
+    def test_rolling_histogram_and_percentiles(self):
+        """Only the most recent turns are kept.
+        """
+        for ai_seconds in [5.0, 0.0001, 0.002, 0.002]:
+            self.play_turn(ai_seconds=ai_seconds, move_seconds=0.0)
+
+        histogram = self.profiler.get_histogram('ai decision', bucket_edges=[0.001, 0.01])
+        self.assertEqual(histogram, [1, 2, 0])
+        self.assertAlmostEqual(self.profiler.get_percentile('ai decision', 100), 0.002)
+        self.assertAlmostEqual(self.profiler.get_percentile('ai decision', 0), 0.0001)
+        self.assertIsNone(self.profiler.get_percentile('find collisions', 50))
+
+class MetricsTest(unittest.TestCase):
+    """Tests the simulation metrics and their export.
+    """
+    def test_metrics_count_turns_games_and_nodes(self):
+        """Playing a game with metrics counts its turns, result and the AI's work.
+        """
+        metrics_to_test = metrics.SimulationMetrics()
+        results = simulation.run_mission("mission 1", read_campaign(), metrics=metrics_to_test)
+
+        snapshot = metrics_to_test.snapshot()
+        self.assertEqual(snapshot['turns'], results['turns'])
+        self.assertEqual(snapshot['games'], 1)
+        self.assertEqual(snapshot['games by result']['player lose'], 1)
+        self.assertTrue(snapshot['ai nodes'] > 0)
+        self.assertEqual(len(snapshot['phase samples']['ai decision']), results['turns'])
+        self.assertEqual(snapshot['phase counts']['turn'], results['turns'])
+        self.assertAlmostEqual(snapshot['phase seconds']['turn'], sum(snapshot['phase samples']['turn']))
+
+    def test_merge_snapshots(self):
+        """Snapshots from several processes add up.
+        """
+        worker_metrics = []
+        for worker in xrange(2):
+            worker_metrics.append(metrics.SimulationMetrics())
+            simulation.run_mission("mission 1", read_campaign(), metrics=worker_metrics[-1])
+
+        merged = metrics.merge_snapshots([worker.snapshot() for worker in worker_metrics])
+        self.assertEqual(merged['processes'], 2)
+        self.assertEqual(merged['games'], 2)
+        self.assertEqual(merged['turns'], sum([worker.turns for worker in worker_metrics]))
+        self.assertEqual(len(merged['phase samples']['turn']), merged['turns'])
+        self.assertEqual(merged['phase counts']['turn'], merged['turns'])
+
+    def test_scrape_metrics_directory(self):
+        """A scraper reads the merged metrics of every worker that wrote to the directory.
+        """
+        metrics_directory = tempfile.mkdtemp()
+        try:
+            metrics_to_test = metrics.SimulationMetrics()
+            simulation.run_mission("mission 1", read_campaign(), metrics=metrics_to_test)
+            metrics.MetricsFileWriter(metrics_to_test, metrics_directory).write()
+
+            server = metrics.start_metrics_server(lambda: metrics.read_metrics_directory(metrics_directory))
+            try:
+                scraped = urllib2.urlopen("http://%s:%d/metrics" % server.server_address).read()
+            finally:
+                server.shutdown()
+                server.server_close()
+        finally:
+            shutil.rmtree(metrics_directory)
+
+        values = {}
+        for line in scraped.splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                values[name] = float(value)
+
+        self.assertEqual(values['fox_and_geese_processes'], 1.0)
+        self.assertEqual(values['fox_and_geese_turns_total'], metrics_to_test.turns)
+        self.assertEqual(values['fox_and_geese_games_total{result="player lose"}'], 1.0)
+        self.assertEqual(values['fox_and_geese_fox_win_ratio'], 0.0)
+        self.assertIn('fox_and_geese_turn_phase_seconds{phase="ai decision",quantile="0.99"}', values)
+        self.assertEqual(values['fox_and_geese_turn_phase_seconds_count{phase="ai decision"}'], metrics_to_test.turns)
+        self.assertAlmostEqual(values['fox_and_geese_turn_phase_seconds_sum{phase="turn"}'], metrics_to_test.phase_seconds['turn'])
+
+    def test_summary_totals_outlast_recent_samples(self):
+        """The summary's _sum and _count cover every turn, even after the oldest samples are dropped.
+        """
+        metrics_to_test = metrics.SimulationMetrics(history_length=2)
+        for turn_number in xrange(5):
+            metrics_to_test.turn_profiler.start_turn()
+            metrics_to_test.turn_profiler.end_phase('ai decision')
+            metrics_to_test.turn_profiler.end_turn(turn_number=turn_number, collision_count=0, retreat_count=0, kill_count=0)
+
+        snapshot = metrics_to_test.snapshot()
+        self.assertEqual(len(snapshot['phase samples']['ai decision']), 2)
+        text = metrics.render_prometheus(snapshot)
+        self.assertIn('fox_and_geese_turn_phase_seconds_count{phase="ai decision"} 5.0\n', text)
+        self.assertIn('fox_and_geese_turn_phase_seconds_count{phase="try to move"} 0.0\n', text)
+        self.assertIn('fox_and_geese_turn_phase_seconds_sum{phase="ai decision"} ', text)
+        self.assertEqual(text.count('# TYPE fox_and_geese_turn_phase_seconds summary'), 1)
+
+class GameServerTest(unittest.TestCase):
+    """Tests the multi mission server with real sockets on localhost.
+    """
+    def setUp(self):
+        self.ai_pool = None
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.game_server.close()
+        if self.ai_pool:
+            self.ai_pool.terminate()
+
+    def start_server(self, **kwargs):
+        self.game_server = server.GameServer(port=0, **kwargs)
+
+    def connect(self):
+        client = socket.create_connection(self.game_server.server_address)
+        client.setblocking(0)
+        self.clients.append(client)
+        self.game_server.run_once(0.01)
+        return client
+
+    def read_messages(self, client, count, ticks=200):
+        """Run the server until the client has received count messages.
+        """
+        received = ""
+        for tick in xrange(ticks):
+            self.game_server.run_once(0.01)
+            try:
+                received += client.recv(65536)
+            except socket.error:
+                pass
+            if received.count("\n") >= count:
+                break
+        return [json.loads(line) for line in received.splitlines()]
+
+    def test_play_a_turn(self):
+        """Clients get a welcome, then a turn delta for every move they send.
+        """
+        self.start_server()
+        client = self.connect()
+
+        welcome = self.read_messages(client, 1)[0]
+        self.assertEqual(welcome['type'], 'welcome')
+        self.assertEqual(welcome['entities']['fox'], {'x': 2, 'y': 0, 'type': 'fox'})
+
+        client.sendall("L\n")
+        turn = self.read_messages(client, 1)[0]
+        self.assertEqual(turn['type'], 'turn')
+        self.assertEqual(turn['turn'], 1)
+        self.assertEqual(turn['moves']['fox'], {'x': 1, 'y': 0, 'is dead': False})
+
+    def test_invalid_move(self):
+        """Unknown moves are answered with an error and do not play a turn.
+        """
+        self.start_server()
+        client = self.connect()
+        self.read_messages(client, 1)
+
+        client.sendall("JUMP\n")
+        error = self.read_messages(client, 1)[0]
+        self.assertEqual(error['type'], 'error')
+        self.assertEqual(self.game_server.turns_played, 0)
+
+    def test_sessions_batched_with_ai_pool(self):
+        """Turns for several clients are played together and the AI decides in the pool.
+        """
+        self.ai_pool = ThreadPool(2)
+        self.start_server(ai_pool=self.ai_pool)
+        clients = [self.connect() for i in xrange(3)]
+        for client in clients:
+            self.read_messages(client, 1)
+
+        for client in clients:
+            client.sendall("W\n")
+        turns = [self.read_messages(client, 1)[0] for client in clients]
+
+        self.assertEqual(self.game_server.turns_played, 3)
+        for turn in turns:
+            # The geese catch the waiting fox.
+            self.assertEqual(turn['moves']['fox'], {'x': 2, 'y': 0, 'is dead': True})
+            self.assertEqual(turn['mission complete'], 'player lose')
+
+    def test_backpressure(self):
+        """A client with too much unsent output is not read from until it catches up.
+        """
+        self.start_server(max_output_size=0)
+        client = self.connect()
+        self.read_messages(client, 1)
+
+        client.sendall("W\n")
+        self.assertEqual(self.read_messages(client, 1, ticks=20), [])
+        self.assertEqual(self.game_server.turns_played, 0)
+
+        self.game_server.max_output_size = 1024
+        self.assertEqual(self.read_messages(client, 1)[0]['type'], 'turn')
+
+    def test_pending_moves_per_line(self):
+        """Moves sent all at once are taken max_pending_moves at a time. The rest wait in the input buffer.
+        """
+        self.start_server(max_pending_moves=2)
+        self.game_server.play_turns = Mock()
+        client = self.connect()
+        self.read_messages(client, 1)
+
+        client.sendall("W\n" * 10)
+        self.read_messages(client, 1, ticks=20)
+        session = self.game_server.sessions_by_fd.values()[0]
+        self.assertEqual(session.pending_moves, ['W', 'W'])
+        self.assertEqual(session.input_buffer, "W\n" * 8)
+
+        # A played move makes room for the next one.
+        session.pending_moves.pop(0)
+        self.game_server.run_once(0.01)
+        self.assertEqual(session.pending_moves, ['W', 'W'])
+        self.assertEqual(session.input_buffer, "W\n" * 7)
+
+    def test_long_line_disconnects(self):
+        """A client sending a line longer than max_line_size is dropped, with or without the newline.
+        """
+        self.start_server(max_line_size=8)
+        clients = [self.connect() for i in xrange(2)]
+        for client in clients:
+            self.read_messages(client, 1)
+
+        clients[0].sendall("U" * 20 + "\n")
+        clients[1].sendall("U" * 20)
+        self.read_messages(clients[0], 1, ticks=20)
+        self.assertEqual(self.game_server.sessions_by_fd, {})
+        self.assertEqual(self.game_server.turns_played, 0)
+
+    def test_input_size_disconnects(self):
+        """A client sending more than max_input_size bytes at once is dropped.
+        """
+        self.start_server(max_input_size=16)
+        client = self.connect()
+        self.read_messages(client, 1)
+
+        client.sendall("W\n" * 20)
+        self.read_messages(client, 1, ticks=20)
+        self.assertEqual(self.game_server.sessions_by_fd, {})
+
+    def connect_slow_sessions(self, count):
+        # Connect clients whose geese keep thinking until they are told to stop. Returns their sessions.
+        for i in xrange(count):
+            self.read_messages(self.connect(), 1)
+        sessions = self.game_server.sessions_by_fd.values()
+        for session in sessions:
+            mission_model = session.mission_model
+            goose_ids = mission_model.all_ai_by_id['goose'].get_entity_ids()
+            mission_model.all_ai_by_id['goose'] = SlowChaseTheFox(mission_model, goose_ids)
+            session.pending_moves = ['W']
+        return sessions
+
+    def test_time_budget_shared_by_batch(self):
+        """Without a pool, the AI of every session in a batch decides at once under one deadline.
+        """
+        self.start_server(ai_time_budget_seconds=0.2)
+        sessions = self.connect_slow_sessions(4)
+
+        start_time = time.time()
+        self.game_server.play_turns(sessions)
+        self.assertTrue(time.time() - start_time < 0.6)
+        for session in sessions:
+            self.assertEqual(session.mission_model.timed_out_ai_ids, ['goose'])
+
+    def test_late_pool_decisions(self):
+        """Pool decisions start before they are sent, count as timed out when late, and get no new work until done.
+        """
+        self.ai_pool = Mock()
+        self.start_server(ai_pool=self.ai_pool, ai_time_budget_seconds=0.05)
+        session = self.connect_slow_sessions(1)[0]
+        goose_ai = session.mission_model.all_ai_by_id['goose']
+
+        deadlines = []
+        def late_decision(function, args):
+            deadlines.append(goose_ai.deadline)
+            async_result = Mock()
+            async_result.get.side_effect = multiprocessing.TimeoutError()
+            async_result.ready.return_value = False
+            return async_result
+        self.ai_pool.apply_async.side_effect = late_decision
+
+        self.game_server.play_turns([session])
+        self.assertEqual(len(deadlines), 1)
+        self.assertIsNotNone(deadlines[0])
+        self.assertEqual(session.mission_model.timed_out_ai_ids, ['goose'])
+
+        # The late decision still holds a worker, so the next turn falls back without sending more.
+        session.pending_moves = ['W']
+        self.game_server.play_turns([session])
+        self.assertEqual(self.ai_pool.apply_async.call_count, 1)
+        self.assertEqual(session.mission_model.timed_out_ai_ids, ['goose'])
+
 if __name__ == '__main__':
     unittest.main()
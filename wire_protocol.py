@@ -0,0 +1,123 @@
+"""A compact binary encoding of turn deltas for remote clients.
+
+A turn delta (see MissionController.get_turn_delta) is encoded as a header followed by one record per entity that moved or died.
+
+Header, little endian:
+    version: unsigned byte. WIRE_PROTOCOL_VERSION.
+    outcome: unsigned byte. See OUTCOME_CODES.
+    turn: unsigned int.
+    entity count: unsigned short.
+
+Each record:
+    entity index: unsigned short. The position of the entity id in the sorted list of the mission's entity ids.
+    cell: unsigned int. x in the high 16 bits, y in the low 16 bits.
+    is dead: unsigned byte. 1 if the entity died.
+
+Both ends build a TurnDeltaCodec from the same entity ids, usually sent once when the mission starts.
+Encoding and decoding work on buffers the caller allocates once:
+
+    codec = TurnDeltaCodec(mission_model.all_entities_by_id.keys())
+    buffer = codec.make_buffer()
+    size = codec.encode_into(buffer, mission_controller.get_turn_delta())
+    send(buffer[:size])
+"""
+import struct
+
+WIRE_PROTOCOL_VERSION = 1
+
+OUTCOME_CODES = {
+    None: 0,
+    'not finished': 1,
+    'player win': 2,
+    'player lose': 3,
+}
+"""Codes for MissionModel.get_mission_status results. None means no turn has finished yet."""
+
+OUTCOMES_BY_CODE = dict([(code, outcome) for outcome, code in OUTCOME_CODES.items()])
+
+HEADER = struct.Struct('<BBIH')
+RECORD = struct.Struct('<HIB')
+
+MAX_COORDINATE = 0xFFFF
+
+class TurnDeltaCodec(object):
+    """Encodes and decodes the turn deltas of one mission.
+    """
+    def __init__(self, entity_ids):
+        """entity_ids: Every entity id in the mission. Order does not matter.
+        """
+        self.entity_ids = sorted(entity_ids)
+        self.index_by_entity_id = dict([(entity_id, index) for index, entity_id in enumerate(self.entity_ids)])
+
+    def max_encoded_size(self):
+        """Returns the most bytes a turn delta can take, when every entity moved.
+        """
+        return HEADER.size + RECORD.size * len(self.entity_ids)
+
+    def make_buffer(self):
+        """Returns a buffer big enough for any turn delta of this mission.
+        """
+        return bytearray(self.max_encoded_size())
+
+    def encode_into(self, buffer, turn_delta, offset=0):
+        """Writes the turn delta into buffer at offset. Returns the number of bytes written.
+        """
+        moves = turn_delta['moves']
+        HEADER.pack_into(
+            buffer,
+            offset,
+            WIRE_PROTOCOL_VERSION,
+            OUTCOME_CODES[turn_delta['mission complete']],
+            turn_delta['turn'],
+            len(moves)
+        )
+
+        record_offset = offset + HEADER.size
+        index_by_entity_id = self.index_by_entity_id
+        pack_record = RECORD.pack_into
+        for entity_id in moves:
+            move = moves[entity_id]
+            x = move['x']
+            y = move['y']
+            if not (0 <= x <= MAX_COORDINATE and 0 <= y <= MAX_COORDINATE):
+                raise ValueError("Entity %s at (%d, %d) is out of range for the wire protocol." % (entity_id, x, y))
+            pack_record(buffer, record_offset, index_by_entity_id[entity_id], (x << 16) | y, 1 if move['is dead'] else 0)
+            record_offset += RECORD.size
+
+        return record_offset - offset
+
+    def encode(self, turn_delta):
+        """Returns the turn delta as a new string. encode_into avoids the allocation.
+        """
+        buffer = self.make_buffer()
+        size = self.encode_into(buffer, turn_delta)
+        return str(buffer[:size])
+
+    def decode_from(self, buffer, offset=0, turn_delta=None):
+        """Reads a turn delta from buffer at offset. Returns (turn delta, number of bytes read).
+        Pass a turn_delta dictionary to reuse it instead of making a new one.
+        """
+        version, outcome_code, turn, entity_count = HEADER.unpack_from(buffer, offset)
+        if version != WIRE_PROTOCOL_VERSION:
+            raise ValueError("Unsupported wire protocol version %d, expected %d." % (version, WIRE_PROTOCOL_VERSION))
+
+        if turn_delta is None:
+            turn_delta = {}
+        turn_delta['turn'] = turn
+        turn_delta['mission complete'] = OUTCOMES_BY_CODE[outcome_code]
+
+        moves = {}
+        record_offset = offset + HEADER.size
+        entity_ids = self.entity_ids
+        unpack_record = RECORD.unpack_from
+        for i in xrange(entity_count):
+            entity_index, cell, is_dead = unpack_record(buffer, record_offset)
+            moves[entity_ids[entity_index]] = {
+                'x': cell >> 16,
+                'y': cell & MAX_COORDINATE,
+                'is dead': is_dead == 1,
+            }
+            record_offset += RECORD.size
+        turn_delta['moves'] = moves
+
+        return turn_delta, record_offset - offset